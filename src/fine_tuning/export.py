@@ -0,0 +1,164 @@
+# Export of a causal classifier trained with train_phi_lora.py (or train_flan_lora.py) for CPU serving.
+# The LoRA adapters are merged into the base model and saved as a plain checkpoint (merged/), which is also exported to
+# ONNX (onnx/model.onnx, with the tokenizer). Dynamic int8 quantization needs no file: it is applied to the merged
+# checkpoint when loading it (inference.py --runtime int8).
+# The variants are then checked against each other on the held-out 10% split of the training scripts, and their CPU
+# throughput measured on it:
+#   fp32   PyTorch, merged checkpoint
+#   int8   PyTorch, linear layers quantized to int8 on the fly
+#   onnx   ONNX Runtime on the exported graph
+# Usage: python export.py --checkpoint test_trainer/checkpoint-500 --output_dir export [--max_examples 500]
+
+import argparse
+import json
+import os
+import time
+
+from inference import CausalClassifier, OnnxCausalClassifier, load_model, percentile
+
+
+default_data_file = "causalquest13k_labeled_causal_prompt_iteration_6_gpt-4-turbo-2024-04-09.jsonl"
+runtimes = ["fp32", "int8", "onnx"]
+
+
+def load_test_split(data_file=default_data_file):
+    """
+    The evaluation split of the training scripts: same label encoding, same stratified 10% split with seed 42
+    """
+    from datasets import load_dataset
+
+    dataset = load_dataset("json", data_files=data_file)["train"]
+    dataset = dataset.add_column("label", dataset["is_causal"])
+    dataset = dataset.class_encode_column("label")
+    dataset = dataset.train_test_split(test_size=0.1, stratify_by_column="label", seed=42)
+    return dataset["test"]
+
+
+def export_merged(checkpoint, output_dir, base_model=None, num_labels=2):
+    """
+    Merges the LoRA adapters of checkpoint into the base model and saves model and tokenizer in output_dir/merged
+    """
+    model, tokenizer = load_model(checkpoint, base_model, num_labels)
+    merged_dir = os.path.join(output_dir, "merged")
+    model.save_pretrained(merged_dir)
+    tokenizer.save_pretrained(merged_dir)
+    print(f"Merged checkpoint saved to {merged_dir}")
+    return merged_dir
+
+
+def export_onnx(merged_dir, output_dir, opset=17):
+    """
+    Exports the merged checkpoint to output_dir/onnx/model.onnx, with dynamic batch and sequence axes and the logits as
+    only output
+    """
+    import torch
+
+    model, tokenizer = load_model(merged_dir)
+    model.config.use_cache = False
+
+    class LogitsOnly(torch.nn.Module):
+        # the classification output also holds past_key_values, which the serving graph does not need
+        def __init__(self, model):
+            super().__init__()
+            self.model = model
+
+        def forward(self, input_ids, attention_mask):
+            return self.model(input_ids=input_ids, attention_mask=attention_mask).logits
+
+    onnx_dir = os.path.join(output_dir, "onnx")
+    os.makedirs(onnx_dir, exist_ok=True)
+    sample = tokenizer(["Why is the sky blue?", "How do vaccines work?"], padding="longest", return_tensors="pt")
+    # no_grad rather than inference_mode: tracing ops on inference tensors fails for some of them
+    with torch.no_grad():
+        torch.onnx.export(LogitsOnly(model), (sample["input_ids"], sample["attention_mask"]),
+                          os.path.join(onnx_dir, "model.onnx"), input_names=["input_ids", "attention_mask"],
+                          output_names=["logits"], opset_version=opset,
+                          dynamic_axes={"input_ids": {0: "batch", 1: "sequence"},
+                                        "attention_mask": {0: "batch", 1: "sequence"}, "logits": {0: "batch"}})
+    tokenizer.save_pretrained(onnx_dir)
+    print(f"ONNX model saved to {onnx_dir}")
+    return onnx_dir
+
+
+def evaluate_runtime(classifier, queries, labels, batch_size=32, latency_samples=200):
+    """
+    Predictions of classifier on queries, in batches of similar lengths, with its accuracy, its batched throughput and
+    its latency on single queries
+    """
+    encoded = [classifier.encode(query) for query in queries]
+    order = sorted(range(len(encoded)), key=lambda index: len(encoded[index]))
+    predictions = [None] * len(encoded)
+    start = time.perf_counter()
+    for offset in range(0, len(order), batch_size):
+        indices = order[offset:offset + batch_size]
+        for index, result in zip(indices, classifier.predict([encoded[index] for index in indices])):
+            predictions[index] = result["label"]
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for ids in encoded[:latency_samples]:
+        single_start = time.perf_counter()
+        classifier.predict([ids])
+        latencies.append(time.perf_counter() - single_start)
+
+    return predictions, {
+        "accuracy": sum(prediction == label for prediction, label in zip(predictions, labels)) / len(labels),
+        "throughput": len(queries) / elapsed,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000
+    }
+
+
+def check_parity(output_dir, merged_dir, onnx_dir=None, data_file=default_data_file, max_examples=None, batch_size=32,
+                 num_threads=None):
+    """
+    Accuracy, agreement with fp32 and CPU speed of every runtime on the test split. Saved to output_dir/parity_report.json
+    """
+    test = load_test_split(data_file)
+    if max_examples:
+        test = test.select(range(min(max_examples, len(test))))
+    label_names = test.features["label"].names
+    queries = test["query"]
+    labels = [label_names[label] for label in test["label"]]
+
+    report = {"examples": len(queries), "batch_size": batch_size}
+    reference = None
+    for runtime in runtimes:
+        if runtime == "onnx":
+            if onnx_dir is None:
+                continue
+            classifier = OnnxCausalClassifier(onnx_dir, label_names, num_threads=num_threads)
+        else:
+            classifier = CausalClassifier(merged_dir, labels=label_names, num_threads=num_threads, quantize=runtime == "int8")
+        predictions, results = evaluate_runtime(classifier, queries, labels, batch_size)
+        if reference is None:
+            reference = predictions
+        results["agreement_with_fp32"] = sum(a == b for a, b in zip(predictions, reference)) / len(reference)
+        report[runtime] = results
+        print(f"{runtime}: accuracy {results['accuracy']:.4f}, agreement with fp32 {results['agreement_with_fp32']:.2%}, "
+              f"{results['throughput']:.1f} queries/s in batches of {batch_size}, "
+              f"single query p50 {results['p50_ms']:.1f} ms p99 {results['p99_ms']:.1f} ms")
+        del classifier
+
+    with open(os.path.join(output_dir, "parity_report.json"), "w") as file:
+        json.dump(report, file, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge, export and benchmark a LoRA causal classifier for CPU serving')
+    parser.add_argument('--checkpoint', type=str, required=True, help='LoRA adapter folder (or merged checkpoint)')
+    parser.add_argument('--base_model', type=str, default=None, help='Read from adapter_config.json by default')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--skip_onnx', action='store_true', help='Only merge, and compare fp32 with int8')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--data_file', type=str, default=default_data_file, help='Labeled file the model was trained on')
+    parser.add_argument('--max_examples', type=int, default=None, help='Only check the first examples of the test split')
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--num_threads', type=int, default=None, help='CPU threads of PyTorch and ONNX Runtime')
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    merged_dir = export_merged(args.checkpoint, args.output_dir, args.base_model)
+    onnx_dir = None if args.skip_onnx else export_onnx(merged_dir, args.output_dir, args.opset)
+    check_parity(args.output_dir, merged_dir, onnx_dir, args.data_file, args.max_examples, args.batch_size, args.num_threads)
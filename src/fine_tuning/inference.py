@@ -0,0 +1,384 @@
+# CPU inference for the causal classifiers trained with train_flan_lora.py / train_phi_lora.py.
+# Requests are classified in micro-batches: each query is tokenized on arrival and queued in a bucket of similar
+# lengths, and a bucket is sent to the model as soon as it holds max_batch_size queries or its oldest query has waited
+# max_wait_ms. Batches of similar lengths waste little compute on padding, and the deadline bounds the latency added by
+# the batching when the traffic is low.
+#
+# Python API:
+#     service = InferenceService(CausalClassifier("checkpoint-500"), max_batch_size=32, max_wait_ms=10)
+#     service.classify(["why is the sky blue?"])  # [{"label": "True", "probability": 0.97}]
+#     service.submit("why is the sky blue?")      # concurrent.futures.Future of the same dict
+#     service.stats.report()
+# HTTP endpoint:
+#     python inference.py --checkpoint checkpoint-500 --port 8100
+#     POST /classify {"query": "..."} or {"queries": ["...", ...]}, GET /stats, GET /health
+# Benchmark (throughput and p50/p99 latency with concurrent clients):
+#     python inference.py --checkpoint checkpoint-500 --benchmark queries.jsonl --clients 16
+
+import argparse
+import bisect
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+default_bucket_bounds = (16, 32, 64, 128, 256, 512)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def load_model(checkpoint, base_model=None, num_labels=2):
+    """
+    Model and tokenizer of a merged checkpoint, or of a LoRA adapter folder (adapter_config.json) merged into base_model,
+    so that inference runs without the adapter layers. The tokenizer pads as in training: with eos when it has no
+    padding token (phi), on the left
+    """
+    from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+    adapter_config = os.path.join(checkpoint, "adapter_config.json")
+    if os.path.exists(adapter_config):
+        from peft import PeftModel
+        if base_model is None:
+            with open(adapter_config, "r") as file:
+                base_model = json.load(file)["base_model_name_or_path"]
+        model = AutoModelForSequenceClassification.from_pretrained(base_model, num_labels=num_labels)
+        model = PeftModel.from_pretrained(model, checkpoint).merge_and_unload()
+        tokenizer = AutoTokenizer.from_pretrained(base_model)
+    else:
+        model = AutoModelForSequenceClassification.from_pretrained(checkpoint, num_labels=num_labels)
+        tokenizer = AutoTokenizer.from_pretrained(checkpoint)
+
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+        tokenizer.padding_side = "left"
+    model.config.pad_token_id = tokenizer.pad_token_id
+    return model.eval(), tokenizer
+
+
+def top_labels(probabilities, labels):
+    results = []
+    for row in probabilities:
+        index = int(row.argmax())
+        results.append({"label": labels[index], "probability": float(row[index])})
+    return results
+
+
+class CausalClassifier:
+    """
+    A sequence classifier on the query, as trained in this folder, run with PyTorch (see load_model for checkpoint).
+    quantize=True applies dynamic int8 quantization to the linear layers (CPU only). labels are in the order of
+    class_encode_column in the training scripts
+    """
+
+    def __init__(self, checkpoint, base_model=None, labels=("False", "True"), device="cpu", max_length=512, num_threads=None,
+                 quantize=False):
+        import torch
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        model, tokenizer = load_model(checkpoint, base_model, len(labels))
+        if quantize:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        self.torch = torch
+        self.model = model.to(device)
+        self.tokenizer = tokenizer
+        self.labels = list(labels)
+        self.device = device
+        self.max_length = max_length
+
+    def encode(self, query):
+        """
+        Token ids of a query, unpadded
+        """
+        return self.tokenizer(query, max_length=self.max_length, truncation=True)["input_ids"]
+
+    def predict(self, batch):
+        """
+        batch is a list of token id lists, padded here to the longest of them. Returns one {"label", "probability"} per item
+        """
+        encoded = self.tokenizer.pad({"input_ids": batch}, padding="longest", return_tensors="pt")
+        with self.torch.inference_mode():
+            logits = self.model(**{key: value.to(self.device) for key, value in encoded.items()}).logits
+        return top_labels(logits.float().softmax(dim=-1).cpu(), self.labels)
+
+
+class OnnxCausalClassifier:
+    """
+    The same classifier exported by export.py, run with ONNX Runtime: model_dir holds model.onnx and the tokenizer
+    """
+
+    def __init__(self, model_dir, labels=("False", "True"), max_length=512, num_threads=None):
+        import numpy as np
+        import onnxruntime
+        from transformers import AutoTokenizer
+
+        options = onnxruntime.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.np = np
+        self.session = onnxruntime.InferenceSession(os.path.join(model_dir, "model.onnx"), options,
+                                                    providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.labels = list(labels)
+        self.max_length = max_length
+
+    def encode(self, query):
+        return self.tokenizer(query, max_length=self.max_length, truncation=True)["input_ids"]
+
+    def predict(self, batch):
+        encoded = self.tokenizer.pad({"input_ids": batch}, padding="longest", return_tensors="np")
+        logits = self.session.run(["logits"], {"input_ids": encoded["input_ids"].astype(self.np.int64),
+                                               "attention_mask": encoded["attention_mask"].astype(self.np.int64)})[0]
+        logits = logits - logits.max(axis=-1, keepdims=True)
+        probabilities = self.np.exp(logits) / self.np.exp(logits).sum(axis=-1, keepdims=True)
+        return top_labels(probabilities, self.labels)
+
+
+class InferenceStats:
+    """
+    Requests served, batches, padding and latencies (from submit to result) over a sliding window of requests
+    """
+
+    def __init__(self, window=100000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.requests = 0
+        self.batches = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.first = None
+        self.last = None
+
+    def add_batch(self, lengths, latencies):
+        now = time.perf_counter()
+        with self.lock:
+            if self.first is None:
+                self.first = now - max(latencies)
+            self.last = now
+            self.requests += len(latencies)
+            self.batches += 1
+            self.tokens += sum(lengths)
+            self.padded_tokens += max(lengths) * len(lengths)
+            self.latencies.extend(latencies)
+
+    def summary(self):
+        with self.lock:
+            elapsed = (self.last - self.first) if self.requests else 0
+            latencies = list(self.latencies)
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "mean_batch_size": self.requests / self.batches if self.batches else 0,
+                "padding_share": 1 - self.tokens / self.padded_tokens if self.padded_tokens else 0,
+                "throughput": self.requests / elapsed if elapsed > 0 else 0,
+                "p50_ms": percentile(latencies, 0.5) * 1000 if latencies else None,
+                "p99_ms": percentile(latencies, 0.99) * 1000 if latencies else None
+            }
+
+    def report(self):
+        summary = self.summary()
+        if summary["requests"]:
+            print(f"{summary['requests']} requests in {summary['batches']} batches (mean size {summary['mean_batch_size']:.1f}, "
+                  f"{summary['padding_share']:.1%} padding), {summary['throughput']:.1f} queries/s, "
+                  f"latency p50 {summary['p50_ms']:.1f} ms p99 {summary['p99_ms']:.1f} ms")
+        return summary
+
+
+class InferenceService:
+    """
+    Micro-batching front of a classifier (anything with encode(query) and predict(list of token ids)).
+    A single worker thread runs the model; submit can be called from any number of threads
+    """
+
+    def __init__(self, classifier, max_batch_size=32, max_wait_ms=10, bucket_bounds=default_bucket_bounds):
+        self.classifier = classifier
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_bounds = list(bucket_bounds)
+        # one queue of (arrival time, token ids, future) per length bucket, the last one for the longer queries
+        self.buckets = [collections.deque() for _ in range(len(self.bucket_bounds) + 1)]
+        self.condition = threading.Condition()
+        self.stats = InferenceStats()
+        self.closed = False
+        self.worker = threading.Thread(target=self.run, name="inference-worker", daemon=True)
+        self.worker.start()
+
+    def submit(self, query):
+        future = Future()
+        ids = self.classifier.encode(query)
+        bucket = self.buckets[bisect.bisect_left(self.bucket_bounds, len(ids))]
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The inference service is closed")
+            bucket.append((time.perf_counter(), ids, future))
+            self.condition.notify()
+        return future
+
+    def classify(self, queries, timeout=None):
+        futures = [self.submit(query) for query in queries]
+        return [future.result(timeout) for future in futures]
+
+    def next_batch(self):
+        """
+        Waits for a bucket that is full or whose oldest query reached its deadline, and takes up to max_batch_size
+        queries out of it. Returns None once the service is closed and every queue is empty
+        """
+        with self.condition:
+            while True:
+                now = time.perf_counter()
+                ready = None
+                next_deadline = None
+                for bucket in self.buckets:
+                    if not bucket:
+                        continue
+                    deadline = bucket[0][0] + self.max_wait
+                    if len(bucket) >= self.max_batch_size or deadline <= now or self.closed:
+                        # the most overdue bucket first
+                        if ready is None or bucket[0][0] < ready[0][0]:
+                            ready = bucket
+                    elif next_deadline is None or deadline < next_deadline:
+                        next_deadline = deadline
+                if ready is not None:
+                    return [ready.popleft() for _ in range(min(self.max_batch_size, len(ready)))]
+                if self.closed:
+                    return None
+                self.condition.wait(None if next_deadline is None else next_deadline - now)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            try:
+                results = self.classifier.predict([ids for _, ids, _ in batch])
+            except Exception as error:
+                for _, _, future in batch:
+                    future.set_exception(error)
+                continue
+            done = time.perf_counter()
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+            self.stats.add_batch([len(ids) for _, ids, _ in batch], [done - arrival for arrival, _, _ in batch])
+
+    def close(self):
+        """
+        Serves the queries already submitted and stops the worker
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.worker.join()
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.service.stats.summary())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/classify":
+            self.send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        except ValueError as error:
+            self.send_json(400, {"error": f"Invalid JSON: {error}"})
+            return
+        if isinstance(request.get("query"), str):
+            self.send_json(200, self.server.service.submit(request["query"]).result())
+        elif isinstance(request.get("queries"), list):
+            self.send_json(200, {"results": self.server.service.classify(request["queries"])})
+        else:
+            self.send_json(400, {"error": 'Expected {"query": "..."} or {"queries": ["...", ...]}'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(service, host="127.0.0.1", port=8100):
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.daemon_threads = True
+    server.service = service
+    print(f"Serving the classifier on http://{host}:{port}/classify")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        service.stats.report()
+
+
+def benchmark(service, queries, clients=16):
+    """
+    Sends every query through the service from clients threads, each waiting for its answer before sending the next
+    """
+    def client(offset):
+        for query in queries[offset::clients]:
+            service.submit(query).result()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(clients) as executor:
+        list(executor.map(client, range(clients)))
+    elapsed = time.perf_counter() - start
+    print(f"{len(queries)} queries with {clients} clients in {elapsed:.2f}s")
+    return service.stats.report()
+
+
+def read_queries(path, field="query"):
+    with open(path, "r") as file:
+        return [json.loads(line)[field] for line in file if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Micro-batched CPU inference of a causal classifier')
+    parser.add_argument('--checkpoint', type=str, required=True, help='Merged checkpoint or LoRA adapter folder, or ONNX export folder')
+    parser.add_argument('--base_model', type=str, default=None, help='Base model of a LoRA adapter, read from adapter_config.json by default')
+    parser.add_argument('--runtime', type=str, default="torch", choices=["torch", "int8", "onnx"],
+                        help='PyTorch fp32, PyTorch with dynamic int8 quantization, or ONNX Runtime on an export of export.py')
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='Longest wait of a query for its batch to fill up')
+    parser.add_argument('--max_length', type=int, default=512)
+    parser.add_argument('--num_threads', type=int, default=None, help='torch intra-op threads')
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--benchmark', type=str, default=None, help='JSONL file of queries to benchmark instead of serving')
+    parser.add_argument('--clients', type=int, default=16, help='Concurrent clients of the benchmark')
+    args = parser.parse_args()
+
+    if args.runtime == "onnx":
+        classifier = OnnxCausalClassifier(args.checkpoint, max_length=args.max_length, num_threads=args.num_threads)
+    else:
+        classifier = CausalClassifier(args.checkpoint, args.base_model, max_length=args.max_length, num_threads=args.num_threads,
+                                      quantize=args.runtime == "int8")
+    service = InferenceService(classifier, args.max_batch_size, args.max_wait_ms)
+    if args.benchmark:
+        benchmark(service, read_queries(args.benchmark), args.clients)
+        service.close()
+    else:
+        serve(service, args.host, args.port)
@@ -0,0 +1,73 @@
+# Dynamic padding for the training scripts: the queries are tokenized without padding and each batch is padded to its own
+# longest query by the collator, instead of every query being padded to max_length=512 (train_flan_lora) or to the
+# longest query of its map batch of 1000 (train_phi_lora). With group_by_length=True the Trainer also draws batches of
+# similar lengths, so most batches hold little padding. The loss ignores the padded positions either way (attention
+# mask), so the results are the same.
+# PaddingReport prints, per epoch and per evaluation, the tokens the model processed and how many of them were padding.
+
+from transformers import DataCollatorWithPadding, TrainerCallback
+
+
+def add_length(examples, input_column="input_ids", length_column="length"):
+    # the length column lets group_by_length sort the queries without tokenizing them again
+    examples[length_column] = [len(ids) for ids in examples[input_column]]
+    return examples
+
+
+class CountingCollator(DataCollatorWithPadding):
+    """
+    DataCollatorWithPadding that counts the real and padded tokens of the batches it builds
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tokens = 0
+        self.padded_tokens = 0
+
+    def __call__(self, features):
+        batch = super().__call__(features)
+        self.tokens += int(batch["attention_mask"].sum())
+        self.padded_tokens += batch["attention_mask"].numel()
+        return batch
+
+    def take_counts(self):
+        counts = (self.tokens, self.padded_tokens)
+        self.tokens = 0
+        self.padded_tokens = 0
+        return counts
+
+
+def padding_line(name, tokens, padded_tokens):
+    padding = padded_tokens - tokens
+    share = padding / padded_tokens if padded_tokens else 0
+    return f"{name}: {padded_tokens} tokens processed, {tokens} query tokens, {padding} padding tokens ({share:.1%})"
+
+
+class PaddingReport(TrainerCallback):
+    """
+    Reports the counts of a CountingCollator. The collator is shared by training and evaluation, so the training counts
+    are taken before every evaluation
+    """
+
+    def __init__(self, collator):
+        self.collator = collator
+        self.train_tokens = 0
+        self.train_padded_tokens = 0
+
+    def take_train_counts(self):
+        tokens, padded_tokens = self.collator.take_counts()
+        self.train_tokens += tokens
+        self.train_padded_tokens += padded_tokens
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self.take_train_counts()
+
+    def on_evaluate(self, args, state, control, **kwargs):
+        tokens, padded_tokens = self.collator.take_counts()
+        print(padding_line(f"Evaluation at step {state.global_step}", tokens, padded_tokens))
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        self.take_train_counts()
+        print(padding_line(f"Training epoch {round(state.epoch or 0)}", self.train_tokens, self.train_padded_tokens))
+        self.train_tokens = 0
+        self.train_padded_tokens = 0
@@ -6,6 +6,7 @@ from datasets import load_dataset
 from transformers import AutoTokenizer
 from transformers import AutoModelForSequenceClassification
 from transformers import set_seed
+from padding import CountingCollator, PaddingReport, add_length
 from transformers import TrainingArguments
 from peft import LoraConfig, get_peft_model, TaskType
 from transformers import TrainingArguments, Trainer
@@ -32,9 +33,13 @@ dataset = dataset.train_test_split(test_size=0.1, stratify_by_column="label", se
 
 tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
 def tokenize_function(examples):
-    return tokenizer(examples["query"], padding="max_length", max_length=512, truncation=True)
+    return tokenizer(examples["query"], max_length=512, truncation=True)
 
 tokenized_datasets = dataset.map(tokenize_function, batched=True)
+tokenized_datasets = tokenized_datasets.map(add_length, batched=True)
+
+# each batch is padded to its longest query, with queries of similar lengths batched together
+data_collator = CountingCollator(tokenizer=tokenizer)
 
 
 model = AutoModelForSequenceClassification.from_pretrained(
@@ -82,6 +87,7 @@ training_args = TrainingArguments(
     save_total_limit=1,
     gradient_accumulation_steps=4,
     learning_rate=2e-4,
+    group_by_length=True,
 )
 
 
@@ -91,6 +97,8 @@ trainer = Trainer(
     train_dataset=tokenized_datasets["train"],
     eval_dataset=tokenized_datasets["test"],
     compute_metrics=compute_metrics,
+    data_collator=data_collator,
+    callbacks=[PaddingReport(data_collator)],
 )
 
 trainer.train()
@@ -8,6 +8,7 @@ from transformers import AutoTokenizer
 from transformers import TrainingArguments
 from transformers import AutoModelForSequenceClassification
 from transformers import set_seed
+from padding import CountingCollator, PaddingReport, add_length
 from transformers import TrainingArguments, Trainer
 
 set_seed(42)
@@ -37,10 +38,14 @@ tokenizer.pad_token = tokenizer.eos_token
 tokenizer.padding_side = 'left'
 
 def tokenize_function(examples):
-    return tokenizer(examples["query"], padding="longest", max_length=512, truncation=True)
+    return tokenizer(examples["query"], max_length=512, truncation=True)
 
 
 tokenized_datasets = dataset.map(tokenize_function, batched=True)
+tokenized_datasets = tokenized_datasets.map(add_length, batched=True)
+
+# each batch is padded to its longest query, with queries of similar lengths batched together
+data_collator = CountingCollator(tokenizer=tokenizer)
 
 
 model = AutoModelForSequenceClassification.from_pretrained(
@@ -95,6 +100,7 @@ training_args = TrainingArguments(
     save_total_limit=1,
     gradient_accumulation_steps=1,
     learning_rate=2e-4,
+    group_by_length=True,
 )
 
 
@@ -104,6 +110,8 @@ trainer = Trainer(
     train_dataset=tokenized_datasets["train"],
     eval_dataset=tokenized_datasets["test"],
     compute_metrics=compute_metrics,
+    data_collator=data_collator,
+    callbacks=[PaddingReport(data_collator)],
 )
 
 trainer.train()
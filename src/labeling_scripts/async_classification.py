@@ -0,0 +1,178 @@
+# Async engine to run the classification of CausalQuest with several requests in flight.
+# Results are written to the output file in the same order as the input rows.
+
+import asyncio
+import collections
+import time
+from utils import build_row_prompt, parse_row_outcome, build_messages
+from dedup import PromptDeduplicator
+from retry_policy import error_class, is_api_error
+import utils
+
+
+def get_async_client(base_url=None):
+    """
+    Create the async OpenAI-compatible client. base_url can point to any compatible server, e.g. the local stub_server.py
+    """
+    from openai import AsyncOpenAI
+    # retries are done by send_chat_request_async
+    if base_url:
+        return AsyncOpenAI(base_url=base_url, max_retries=0)
+    return AsyncOpenAI(max_retries=0)
+
+
+async def get_gpt_response_async(client, prompt, model, system_prompt=None, prompt_version=None):
+    """
+    Async version of utils.get_gpt_response
+    """
+    messages = build_messages(prompt, system_prompt)
+    cache = utils.response_cache
+
+    if cache is not None:
+        cached = cache.get(model, messages, utils.max_tokens, utils.temperature, utils.seed)
+        if cached is not None:
+            return cached
+
+    content = await send_chat_request_async(client, messages, model)
+
+    if cache is not None:
+        cache.put(model, messages, utils.max_tokens, utils.temperature, utils.seed, content, prompt_version)
+    return content
+
+
+async def send_chat_request_async(client, messages, model):
+    """
+    Async version of utils.send_chat_request, with the same retry policy and circuit breaker shared by all the in-flight requests
+    """
+    attempts = {}
+    while True:
+        await utils.circuit_breaker.wait_async()
+        try:
+            content = await send_chat_request_once_async(client, messages, model)
+        except Exception as e:
+            kind = error_class(e)
+            if kind is not None:
+                utils.circuit_breaker.record(False)
+            if not utils.retry_policy.can_retry(kind, attempts):
+                raise
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            if kind == "rate_limit" and utils.rate_limiter is not None:
+                waited = utils.rate_limiter.pause(headers)
+                print(f"Rate limited, pausing requests for {waited:.1f}s")
+            else:
+                wait = utils.retry_policy.delay(attempts.get(kind, 0), headers)
+                print(f"Request failed ({kind}), retrying in {wait:.1f}s")
+                await asyncio.sleep(wait)
+            attempts[kind] = attempts.get(kind, 0) + 1
+            continue
+        utils.circuit_breaker.record(True)
+        return content
+
+
+async def send_chat_request_once_async(client, messages, model):
+    """
+    Async version of utils.send_chat_request_once
+    """
+    if utils.rate_limiter is None:
+        start = time.perf_counter()
+        response = await client.chat.completions.create(
+            model=model,
+            messages=messages,
+            max_tokens=utils.max_tokens,
+            temperature=utils.temperature,
+            seed=utils.seed
+        )
+        utils.usage_stats.add(response.usage, time.perf_counter() - start)
+        return response.choices[0].message.content
+
+    # same scheduling as utils.send_chat_request_once, shared across all the in-flight requests
+    cost = await utils.rate_limiter.acquire_async(messages, utils.max_tokens)
+    start = time.perf_counter()
+    try:
+        raw_response = await client.chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            max_tokens=utils.max_tokens,
+            temperature=utils.temperature,
+            seed=utils.seed
+        )
+    except Exception:
+        utils.rate_limiter.release(cost)
+        raise
+    utils.rate_limiter.release(cost, raw_response.headers)
+    response = raw_response.parse()
+    utils.usage_stats.add(response.usage, time.perf_counter() - start)
+    return response.choices[0].message.content
+
+
+async def classify_prompt_async(client, semaphore, prompt, system_prompt, model, classification_type, prompt_version=None):
+    """
+    Send one prompt, waiting for a free slot in the concurrency window. Returns (outcome, raw_outcome)
+    """
+    async with semaphore:
+        obtained_class = await get_gpt_response_async(client, prompt, model, system_prompt, prompt_version)
+
+    outcome = parse_row_outcome(obtained_class, classification_type)
+    return outcome, obtained_class
+
+
+async def classify_rows_async(rows, model, prompt_function_name, classification_type, system_prompt_flag, on_result,
+                              concurrency=8, max_buffered=None, base_url=None, client=None, dedup=False, on_error=None):
+    """
+    Classify the (index, row) pairs in rows keeping up to concurrency requests in flight.
+
+    on_result(index, row, outcome, raw_outcome) is called in input order. At most max_buffered rows (default 4 * concurrency)
+    are scheduled ahead of the oldest unfinished one, so a slow request does not make the reorder buffer grow without bound.
+    With dedup, rows with the same normalized prompt share a single request.
+    on_error(index, row, error), if given, is called instead of on_result for the rows whose request failed after all the
+    retries, and the run goes on; without it the error is raised.
+    """
+    own_client = client is None
+    if own_client:
+        client = get_async_client(base_url)
+    if max_buffered is None:
+        max_buffered = 4 * concurrency
+
+    semaphore = asyncio.Semaphore(concurrency)
+    pending = collections.deque()
+    deduplicator = PromptDeduplicator() if dedup else None
+    prompt_version = utils.prompt_version_id(prompt_function_name, classification_type, system_prompt_flag)
+
+    async def flush_head():
+        index, row, task = pending.popleft()
+        try:
+            outcome, raw_outcome = await task
+        except Exception as e:
+            if on_error is None or not is_api_error(e):
+                raise
+            on_error(index, row, e)
+            return
+        on_result(index, row, outcome, raw_outcome)
+
+    try:
+        for index, row in rows:
+            prompt, system_prompt = build_row_prompt(row, prompt_function_name, classification_type, system_prompt_flag)
+            task = None
+            if deduplicator is not None:
+                # the task of the first row with the same prompt, awaited by every row that shares it
+                key, task = deduplicator.lookup(build_messages(prompt, system_prompt))
+            if task is None:
+                task = asyncio.create_task(classify_prompt_async(client, semaphore, prompt, system_prompt, model,
+                                                                 classification_type, prompt_version))
+                if deduplicator is not None:
+                    deduplicator.store(key, task)
+            pending.append((index, row, task))
+
+            # write out everything that is already done at the head of the queue, and block when the buffer is full
+            while pending and (pending[0][2].done() or len(pending) >= max_buffered):
+                await flush_head()
+
+        while pending:
+            await flush_head()
+    finally:
+        for _, _, task in pending:
+            task.cancel()
+        if own_client:
+            await client.close()
+        if deduplicator is not None:
+            deduplicator.report()
@@ -0,0 +1,212 @@
+# Inference backends behind get_gpt_response / get_cat1_outcome / get_cat2_outcome.
+#
+# A backend classifies rows and returns (outcome, raw_outcome) per row, with the same outcome values as the OpenAI
+# prompts. The chat backends only have to implement complete(messages, model): the rows are turned into prompts with
+# the prompt registry and the answers parsed as usual. The other backends classify the rows directly:
+#   openai        the chat completions API (the default), with the rate limiter, cache and retries of utils
+#   openai_batch  the Batch API, through run_batchAPI.run_batch_job, for whole files of rows at once
+#   hf            a local Hugging Face sequence classifier, e.g. the LoRA models trained in fine_tuning/, on CPU workers
+#   fake          deterministic answers derived from the prompt, to exercise the pipeline without any model
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+
+backend_names = ["openai", "openai_batch", "hf", "fake"]
+
+
+class InferenceBackend:
+    """
+    Chat-style backend: subclasses implement complete. batch_size > 1 makes run_classification hand the rows over in
+    groups of batch_size to classify_rows
+    """
+
+    name = None
+    # whether the answers can be stored in the response cache under the model name
+    cacheable = False
+    batch_size = 1
+
+    def complete(self, messages, model):
+        raise NotImplementedError(f"The {self.name} backend does not answer single prompts")
+
+    def classify_row(self, row, model, prompt_function_name, classification_type, system_prompt_flag):
+        """
+        Returns (outcome, raw_outcome) for a row
+        """
+        from utils import build_row_prompt, get_gpt_response, parse_row_outcome, prompt_version_id
+        prompt, system_prompt = build_row_prompt(row, prompt_function_name, classification_type, system_prompt_flag)
+        version = prompt_version_id(prompt_function_name, classification_type, system_prompt_flag)
+        obtained_class = get_gpt_response(prompt, model, system_prompt, version)
+        return parse_row_outcome(obtained_class, classification_type), obtained_class
+
+    def classify_rows(self, rows, model, prompt_function_name, classification_type, system_prompt_flag):
+        """
+        Returns one (outcome, raw_outcome) per row, or the exception of the rows that failed
+        """
+        return [self.classify_row(row, model, prompt_function_name, classification_type, system_prompt_flag) for row in rows]
+
+
+class OpenAIChatBackend(InferenceBackend):
+    name = "openai"
+    cacheable = True
+
+    def complete(self, messages, model):
+        from utils import send_chat_request
+        return send_chat_request(messages, model)
+
+
+class FakeBackend(InferenceBackend):
+    """
+    Answers each prompt with one of the options of its answer format (the "Category: [A / B]" lines), chosen by a hash
+    of the prompt: the same prompt always gets the same answer, and the answers go through the usual parsing
+    """
+
+    name = "fake"
+
+    def complete(self, messages, model):
+        prompt = messages[-1]["content"]
+        digest = int(hashlib.sha1(prompt.encode("utf-8")).hexdigest(), 16)
+        lines = []
+        for label, options in re.findall(r'^\s*(\w+): \[(.+?)\]\s*$', prompt, re.MULTILINE):
+            if label == "Reasoning":
+                continue
+            options = [option.strip() for option in options.split("/")]
+            lines.append(f"{label}: {options[digest % len(options)]}")
+            digest //= len(options)
+        if not lines:
+            return "Category: <unknown>"
+        return "\n".join(lines)
+
+
+class OpenAIBatchBackend(InferenceBackend):
+    """
+    Sends the rows through the Batch API as one job. Meant for whole files: run_classification hands over up to
+    batch_size rows at a time, each group being a batch job in its own folder under work_dir. The folder is named after
+    the ids of the rows, so that a run started again with the same work_dir resumes the job from its manifest
+    """
+
+    name = "openai_batch"
+
+    def __init__(self, work_dir=None, batch_size=50000, enqueued_token_limit=None, poll_interval=30):
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix="openai_batch_backend_")
+        self.batch_size = batch_size
+        self.enqueued_token_limit = enqueued_token_limit
+        self.poll_interval = poll_interval
+
+    def classify_rows(self, rows, model, prompt_function_name, classification_type, system_prompt_flag):
+        from run_batchAPI import run_batch_job, feature_names
+        from utils import parse_row_outcome, prompts
+
+        if classification_type != "causal":
+            prompt_function_name = prompt_function_name + "_" + classification_type
+        ids_digest = hashlib.sha256("\n".join(str(row["id"]) for row in rows).encode("utf-8")).hexdigest()[:16]
+        job_folder = os.path.join(self.work_dir, f"job_{ids_digest}")
+        os.makedirs(job_folder, exist_ok=True)
+        input_file = os.path.join(job_folder, "input.jsonl")
+        with open(input_file, "w") as file:
+            for row in rows:
+                json.dump(dict(row), file, default=str)
+                file.write("\n")
+
+        joined_output_file = run_batch_job(input_file, classification_type, prompt_function_name, model, job_folder,
+                                           prompts.layout, enqueued_token_limit=self.enqueued_token_limit,
+                                           poll_interval=self.poll_interval, system_prompt_flag=system_prompt_flag)
+
+        # the raw answer is in <feature>_raw, or in the _raw of any of the three features for the combined mode
+        raw_field = "is_subjective_raw" if classification_type == "combined" else f"{feature_names[classification_type]}_raw"
+        answers = {}
+        with open(joined_output_file, "r") as file:
+            for line in file:
+                result = json.loads(line)
+                answers[str(result["id"])] = result[raw_field]
+
+        results = []
+        for row in rows:
+            raw = answers.get(str(row["id"]))
+            if raw is None:
+                # failed request, listed in received_outputs/failed_requests.jsonl of the job
+                results.append(RuntimeError(f"No batch result for row {row['id']}, see {job_folder}"))
+                continue
+            results.append((parse_row_outcome(raw, classification_type), raw))
+        return results
+
+
+class HFClassifierBackend(InferenceBackend):
+    """
+    Local sequence classifier on the query of each row, as trained in fine_tuning/ (is_causal only).
+    model_path is a full checkpoint or a LoRA adapter folder (adapter_config.json), loaded on top of base_model
+    """
+
+    name = "hf"
+
+    def __init__(self, model_path, base_model=None, labels=("False", "True"), device="cpu", batch_size=32, max_length=512,
+                 text_field="query"):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSequenceClassification
+
+        adapter_config = os.path.join(model_path, "adapter_config.json")
+        if os.path.exists(adapter_config):
+            from peft import PeftModel
+            if base_model is None:
+                with open(adapter_config, "r") as file:
+                    base_model = json.load(file)["base_model_name_or_path"]
+            model = AutoModelForSequenceClassification.from_pretrained(base_model, num_labels=len(labels))
+            model = PeftModel.from_pretrained(model, model_path)
+            tokenizer = AutoTokenizer.from_pretrained(base_model)
+        else:
+            model = AutoModelForSequenceClassification.from_pretrained(model_path, num_labels=len(labels))
+            tokenizer = AutoTokenizer.from_pretrained(model_path)
+
+        # same padding setup as the training scripts
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+        model.config.pad_token_id = tokenizer.pad_token_id
+
+        self.torch = torch
+        self.model = model.to(device).eval()
+        self.tokenizer = tokenizer
+        # label names in the order of class_encode_column in the training scripts (sorted)
+        self.labels = list(labels)
+        self.device = device
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.text_field = text_field
+
+    def predict(self, texts):
+        """
+        Returns (label, probability) for each text
+        """
+        encoded = self.tokenizer(texts, padding="longest", max_length=self.max_length, truncation=True, return_tensors="pt")
+        with self.torch.inference_mode():
+            logits = self.model(**{key: value.to(self.device) for key, value in encoded.items()}).logits
+        probabilities = logits.softmax(dim=-1).cpu()
+        predictions = []
+        for row_probabilities in probabilities:
+            index = int(row_probabilities.argmax())
+            predictions.append((self.labels[index], float(row_probabilities[index])))
+        return predictions
+
+    def classify_rows(self, rows, model, prompt_function_name, classification_type, system_prompt_flag):
+        if classification_type != "causal":
+            raise ValueError(f"The hf backend only has a classifier for causal, not {classification_type}")
+        predictions = self.predict([str(row[self.text_field]) for row in rows])
+        # is_causal is a bool, as in the outputs of the openai backends (process_output_CoT)
+        return [(label == "True", f"{label} ({probability:.4f})") for label, probability in predictions]
+
+    def classify_row(self, row, model, prompt_function_name, classification_type, system_prompt_flag):
+        return self.classify_rows([row], model, prompt_function_name, classification_type, system_prompt_flag)[0]
+
+
+def make_backend(name, **kwargs):
+    if name == "openai":
+        return OpenAIChatBackend()
+    if name == "openai_batch":
+        return OpenAIBatchBackend(**kwargs)
+    if name == "hf":
+        return HFClassifierBackend(**kwargs)
+    if name == "fake":
+        return FakeBackend()
+    raise ValueError(f"Unknown backend {name}, possible values: {', '.join(backend_names)}")
@@ -0,0 +1,138 @@
+# custom_id encoding of the Batch API requests, and the index used to join the batch results back to the input rows.
+#
+# custom_id is "{request index}:{source}:{query id}". The source never contains ":", and the query id is the last field,
+# so it is recovered as is whatever characters it contains (the old request_{n}_queryId_{id}_source_{src} format broke on
+# ids with underscores). The old format is still decoded, for jobs created before the change.
+#
+# Next to the formatted file, convert_to_openai_input writes <formatted file>.rows: the byte offset in the input JSONL of
+# the row of each request index, as 8-byte integers. The results can then be joined back to the full input rows in one
+# streaming pass over the (request-ordered) final output.
+# With deduplication, <formatted file>.dups lists, for the requests whose prompt was shared by later rows, the offsets of
+# those rows, one JSON line {"request_index": n, "offsets": [...]} each; the join writes the result to all of them.
+
+import json
+import os
+import re
+from array import array
+
+
+def encode_custom_id(request_index, query_id, source):
+    return f"{request_index}:{source}:{query_id}"
+
+
+def decode_custom_id(custom_id):
+    """
+    Returns (request index, query id, source)
+    """
+    legacy = re.fullmatch(r'request_(\d+)_queryId_(.*)_source_([^_]*)', custom_id)
+    if legacy is not None:
+        return int(legacy.group(1)), legacy.group(2), legacy.group(3)
+    request_index, source, query_id = custom_id.split(":", 2)
+    return int(request_index), query_id, source
+
+
+def row_index_path(formatted_file):
+    return formatted_file + ".rows"
+
+
+def write_row_index(offsets, formatted_file):
+    """
+    offsets[n] is the byte offset in the input file of the row sent as request n
+    """
+    with open(row_index_path(formatted_file), "wb") as file:
+        array("q", offsets).tofile(file)
+
+
+def read_row_index(formatted_file):
+    path = row_index_path(formatted_file)
+    offsets = array("q")
+    with open(path, "rb") as file:
+        offsets.fromfile(file, os.path.getsize(path) // offsets.itemsize)
+    return offsets
+
+
+def rebuild_row_index(formatted_file, input_file):
+    """
+    Writes the .rows sidecar again from the custom_ids of the formatted file, when it is missing (e.g. a job formatted
+    before the sidecar existed). The rows of the input are matched by source and query id, in file order
+    """
+    row_offsets = {}
+    offset = 0
+    with open(input_file, "rb") as rows:
+        for line in rows:
+            if line.strip():
+                row = json.loads(line)
+                row_offsets.setdefault((row["source"], str(row["id"])), []).append(offset)
+            offset += len(line)
+
+    offsets = []
+    with open(formatted_file, "r") as requests:
+        for line in requests:
+            if not line.strip():
+                continue
+            request_index, query_id, source = decode_custom_id(json.loads(line)["custom_id"])
+            if request_index != len(offsets):
+                raise ValueError(f"{formatted_file} is not in request order, its row index cannot be rebuilt")
+            # rows with the same id are sent in input order, so they are taken in the same order
+            matches = row_offsets.get((source, query_id))
+            if not matches:
+                raise ValueError(f"No row of {input_file} for request {request_index} (id {query_id}, source {source})")
+            offsets.append(matches.pop(0) if len(matches) > 1 else matches[0])
+    write_row_index(offsets, formatted_file)
+    print(f"Rebuilt the row index {row_index_path(formatted_file)} from the custom ids")
+    return offsets
+
+
+def duplicate_index_path(formatted_file):
+    return formatted_file + ".dups"
+
+
+def write_duplicate_index(duplicates, formatted_file):
+    """
+    duplicates maps a request index to the input offsets of the rows that were not sent because they had the same prompt
+    """
+    with open(duplicate_index_path(formatted_file), "w") as file:
+        for request_index in sorted(duplicates):
+            json.dump({"request_index": request_index, "offsets": duplicates[request_index]}, file)
+            file.write("\n")
+
+
+def read_duplicate_index(formatted_file):
+    path = duplicate_index_path(formatted_file)
+    duplicates = {}
+    if os.path.exists(path):
+        with open(path, "r") as file:
+            for line in file:
+                entry = json.loads(line)
+                duplicates[entry["request_index"]] = entry["offsets"]
+    return duplicates
+
+
+def join_batch_results(final_output_file, input_file, formatted_file, joined_output_file):
+    """
+    Add the fields of each batch result to its full input row. The final output is sorted by request index, so the input
+    file is read forward with one seek per result and nothing is loaded in memory besides the offsets.
+    Rows deduplicated by convert_to_openai_input get the result of their request, right after its own row.
+    A missing .rows sidecar is rebuilt from the formatted file
+    """
+    if os.path.exists(row_index_path(formatted_file)):
+        offsets = read_row_index(formatted_file)
+    else:
+        offsets = rebuild_row_index(formatted_file, input_file)
+    duplicates = read_duplicate_index(formatted_file)
+    joined = 0
+    with open(final_output_file, "r") as results, open(input_file, "rb") as rows, open(joined_output_file, "w") as outfile:
+        for line in results:
+            result = json.loads(line)
+            request_index = result["request_index"]
+            for offset in [offsets[request_index]] + duplicates.get(request_index, []):
+                rows.seek(offset)
+                row = json.loads(rows.readline())
+                for key, value in result.items():
+                    if key not in ("request_index", "query_id", "source"):
+                        row[key] = value
+                json.dump(row, outfile)
+                outfile.write("\n")
+                joined += 1
+    print(f"Joined {joined} results to their input rows, saved to {joined_output_file}")
+    return joined
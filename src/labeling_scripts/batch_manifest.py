@@ -0,0 +1,111 @@
+# Durable state of a Batch API job, in a single SQLite file inside the job folder.
+# It replaces filename_to_id.json / id_to_filename.json, log.txt and the chunk_N_sent.jsonl renames: every chunk has one row
+# with its state (formatted -> uploaded -> submitted -> completed -> downloaded -> parsed, or failed), the OpenAI ids
+# and a timestamp per state. Every update is a transaction, so a crash between two steps never leaves the job inconsistent
+# and each stage of run_batchAPI can skip what is already done.
+
+import datetime
+import json
+import sqlite3
+
+
+chunk_states = ["formatted", "uploaded", "submitted", "completed", "downloaded", "parsed"]
+
+
+class BatchManifest:
+    """
+    Chunk-level state of a batch job, plus the job-level stages (e.g. the formatting of the input file)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS stages (name TEXT PRIMARY KEY, value TEXT, done_at TEXT)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS chunks ("
+                "name TEXT PRIMARY KEY, number INTEGER, state TEXT, "
+                "requests INTEGER, tokens INTEGER, bytes INTEGER, sha256 TEXT, "
+                "file_id TEXT, batch_id TEXT, batch_status TEXT, errors TEXT, "
+                "output_file_id TEXT, error_file_id TEXT, output_bytes INTEGER, output_sha256 TEXT, "
+                + ", ".join(f"{state}_at TEXT" for state in chunk_states) + ", failed_at TEXT)"
+            )
+
+    def stage_done(self, name):
+        """
+        Returns the value stored for a completed job-level stage, None if the stage was not done
+        """
+        row = self.connection.execute("SELECT value FROM stages WHERE name = ?", (name,)).fetchone()
+        return row["value"] if row is not None else None
+
+    def mark_stage(self, name, value=""):
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO stages (name, value, done_at) VALUES (?, ?, ?)",
+                                    (name, value, now()))
+
+    def add_chunks(self, chunks):
+        """
+        Register the chunks written by chunkify, all in one transaction
+        """
+        with self.connection:
+            for chunk in chunks:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO chunks (name, number, state, requests, tokens, bytes, formatted_at) "
+                    "VALUES (?, ?, 'formatted', ?, ?, ?, ?)",
+                    (chunk["name"], chunk_number(chunk["name"]), chunk["requests"], chunk["tokens"], chunk["bytes"], now())
+                )
+
+    def chunks(self, *states):
+        """
+        Chunks in numeric order, optionally only those in the given states
+        """
+        if states:
+            placeholders = ", ".join("?" for _ in states)
+            rows = self.connection.execute(f"SELECT * FROM chunks WHERE state IN ({placeholders}) ORDER BY number", states)
+        else:
+            rows = self.connection.execute("SELECT * FROM chunks ORDER BY number")
+        return [dict(row) for row in rows]
+
+    def chunk(self, name):
+        row = self.connection.execute("SELECT * FROM chunks WHERE name = ?", (name,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def update_chunk(self, name, state=None, **fields):
+        """
+        Update the fields of a chunk and, if given, move it to state, stamping the time of the transition
+        """
+        if "errors" in fields and fields["errors"] is not None and not isinstance(fields["errors"], str):
+            fields["errors"] = json.dumps(fields["errors"])
+        if state is not None:
+            fields["state"] = state
+            fields[f"{state}_at"] = now()
+        assignments = ", ".join(f"{key} = ?" for key in fields)
+        with self.connection:
+            self.connection.execute(f"UPDATE chunks SET {assignments} WHERE name = ?", (*fields.values(), name))
+
+    def id_to_filename(self):
+        """
+        Uploaded file id -> chunk name, the mapping previously kept in id_to_filename.json
+        """
+        return {chunk["file_id"]: chunk["name"] for chunk in self.chunks() if chunk["file_id"]}
+
+    def summary(self):
+        counts = {}
+        for row in self.connection.execute("SELECT state, COUNT(*) AS n FROM chunks GROUP BY state"):
+            counts[row["state"]] = row["n"]
+        return counts
+
+    def close(self):
+        self.connection.close()
+
+
+def chunk_number(name):
+    # chunk_12.jsonl -> 12
+    return int(name.split("_")[1].split(".")[0])
+
+
+def now():
+    return datetime.datetime.now().isoformat()
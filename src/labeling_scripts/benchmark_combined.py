@@ -0,0 +1,66 @@
+# Benchmark of the input tokens and requests saved by the combined cat2 mode (one request for subjectivity, domain and action)
+# against three separate passes, one per category.
+# Usage: python benchmark_combined.py <input.jsonl> <model> [--prompt_function get_prompt_cat2] [--no_system_prompt]
+
+import argparse
+import json
+from utils import build_cat2_prompt, build_messages
+
+
+def count_message_tokens(enc, messages):
+    # same accounting as rate_limiter.RateLimitScheduler.estimate_tokens, without max_tokens
+    tokens = 3
+    for message in messages:
+        tokens += 4 + len(enc.encode(message['content']))
+    return tokens
+
+
+def benchmark_combined_tokens(input_file, model, prompt_function_name="get_prompt_cat2", system_prompt_flag=True):
+    """
+    Count requests and input tokens of the causal rows of input_file for the separate and the combined cat2 modes
+    """
+    import tiktoken
+    try:
+        enc = tiktoken.encoding_for_model(model)
+    except KeyError:
+        enc = tiktoken.get_encoding("cl100k_base")
+
+    separate_requests, separate_tokens = 0, 0
+    combined_requests, combined_tokens = 0, 0
+
+    with open(input_file, 'r') as infile:
+        for line in infile:
+            row = json.loads(line)
+            if row.get("is_causal") == False:
+                continue
+
+            for classification_type in ["subjectivity", "domain", "action"]:
+                prompt, system_prompt = build_cat2_prompt(row, prompt_function_name, classification_type, system_prompt_flag)
+                separate_tokens += count_message_tokens(enc, build_messages(prompt, system_prompt))
+                separate_requests += 1
+
+            prompt, system_prompt = build_cat2_prompt(row, prompt_function_name, "combined", system_prompt_flag)
+            combined_tokens += count_message_tokens(enc, build_messages(prompt, system_prompt))
+            combined_requests += 1
+
+    saved = 1 - combined_tokens / separate_tokens if separate_tokens else 0
+    print(f"Separate passes: {separate_requests} requests, {separate_tokens} input tokens")
+    print(f"Combined mode: {combined_requests} requests, {combined_tokens} input tokens")
+    print(f"Input tokens saved: {separate_tokens - combined_tokens} ({saved:.1%})")
+    return {
+        "separate_requests": separate_requests,
+        "separate_tokens": separate_tokens,
+        "combined_requests": combined_requests,
+        "combined_tokens": combined_tokens
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Token savings of the combined cat2 mode')
+    parser.add_argument('input_path', type=str, help='Path to the input dataset (JSONL)')
+    parser.add_argument('model', type=str, help='Model whose tokenizer is used for the count')
+    parser.add_argument('--prompt_function', type=str, default="get_prompt_cat2", help='Prefix of the cat2 prompt functions in utils.py')
+    parser.add_argument('--no_system_prompt', action='store_true', help='Count without the cat2 system prompt')
+    args = parser.parse_args()
+
+    benchmark_combined_tokens(args.input_path, args.model, args.prompt_function, not args.no_system_prompt)
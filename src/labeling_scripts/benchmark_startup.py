@@ -0,0 +1,65 @@
+# Benchmark of the import time of the labeling_scripts modules, each measured in a fresh interpreter.
+# It also checks which heavy modules (openai, tiktoken, ...) end up loaded by the import, and that no API key is needed.
+# Usage: python benchmark_startup.py [--runs 10] [module ...]
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+default_modules = ["utils", "dedup", "batch_ids", "checkpoint", "run_batchAPI", "run_classification", "async_classification"]
+heavy_modules = ["openai", "httpx", "tiktoken", "pandas"]
+
+probe = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+
+def time_import(module, runs=10):
+    """
+    Import module in runs fresh interpreters, without OPENAI_API_KEY. Returns the median and best import time and the heavy
+    modules it loaded
+    """
+    env = {key: value for key, value in os.environ.items() if key != "OPENAI_API_KEY"}
+    code = probe.format(module=module, heavy=heavy_modules)
+    times = []
+    loaded = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                capture_output=True, text=True)
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "unknown error"
+            return {"module": module, "error": error}
+        measure = json.loads(result.stdout.strip().splitlines()[-1])
+        times.append(measure["seconds"])
+        loaded = measure["loaded"]
+    return {"module": module, "median_ms": statistics.median(times) * 1000, "best_ms": min(times) * 1000, "loaded": loaded}
+
+
+def benchmark_startup(modules=None, runs=10):
+    results = []
+    for module in modules or default_modules:
+        result = time_import(module, runs)
+        if "error" in result:
+            print(f"{module}: import failed ({result['error']})")
+        else:
+            loaded = ", ".join(result["loaded"]) or "none"
+            print(f"{module}: median {result['median_ms']:.1f} ms, best {result['best_ms']:.1f} ms, heavy modules loaded: {loaded}")
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Import time of the labeling scripts')
+    parser.add_argument('modules', nargs='*', help='Modules to import, all the main ones by default')
+    parser.add_argument('--runs', type=int, default=10, help='Fresh interpreters per module')
+    args = parser.parse_args()
+
+    benchmark_startup(args.modules, args.runs)
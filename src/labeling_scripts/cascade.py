@@ -0,0 +1,253 @@
+# Cascade for the causal classification: cheap predictors answer the queries they are confident about, and only the
+# uncertain queries are sent to the LLM (get_cat1_outcome, or the Batch API with --backend openai_batch).
+#   1. the linguistic baseline (linguistic_baseline.causal_rules): a query is accepted as causal when one of the rules
+#      that fire on it is precise enough, and as non-causal when no rule fires, if that is precise enough too
+#   2. optionally a local classifier (an hf backend, e.g. a LoRA model of fine_tuning/): its prediction is accepted when
+#      its probability is above a threshold
+# What is "precise enough" is calibrated on an already labeled file, taking the LLM labels as the reference: every rule
+# (and the probability threshold) must agree with them on at least target_agreement of the queries it accepts.
+# The calibration reports, for a range of targets, the share of API calls avoided and the agreement lost over the file.
+# Calibrate the local classifier on queries it was not trained on (e.g. the test split of fine_tuning/export.py).
+# Usage: python cascade.py labeled.jsonl --output cascade.json [--target_agreement 0.98] [--local_model checkpoint]
+# then:  python run_classification.py causal ... --cascade cascade.json
+
+import argparse
+import json
+import os
+import sys
+
+
+default_targets = [0.9, 0.95, 0.98, 0.99]
+
+
+def load_baseline():
+    """
+    Returns a function giving the names of the baseline rules that fire on each of a list of queries
+    """
+    baseline_folder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "linguistic_baseline")
+    if baseline_folder not in sys.path:
+        sys.path.append(baseline_folder)
+    from linguistic_baseline import causal_rules_batch, get_causal_lexicons
+
+    causal_verbs, causal_keywords = get_causal_lexicons()
+    return lambda queries: causal_rules_batch(queries, causal_verbs, causal_keywords)
+
+
+def gold_label(value):
+    # is_causal is a boolean in the labeled files and in the outputs of run_classification, "True" / "False" in older files
+    if value is None:
+        return None
+    return str(value) == "True"
+
+
+def read_labeled_file(path):
+    rows = []
+    with open(path, "r") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            if row.get("query") and gold_label(row.get("is_causal")) is not None:
+                rows.append(row)
+    return rows
+
+
+class Cascade:
+    """
+    The calibrated thresholds (see calibrate) applied to rows: decide_rows returns (outcome, raw_outcome) for the rows the
+    cheap predictors are confident about, None for the rows to send to the LLM
+    """
+
+    def __init__(self, thresholds, baseline=None, local_model=None):
+        self.thresholds = thresholds
+        self.positive_rules = set(thresholds["positive_rules"])
+        self.accept_negative = thresholds["accept_negative"]
+        self.local_threshold = thresholds.get("local_threshold")
+        self.baseline = baseline
+        self.local_model = local_model
+        self.counts = {"baseline": 0, "local": 0, "llm": 0}
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, "r") as file:
+            thresholds = json.load(file)
+        local_model = None
+        if thresholds.get("local_model") and thresholds.get("local_threshold") is not None:
+            from backends import HFClassifierBackend
+            local_model = HFClassifierBackend(thresholds["local_model"], thresholds.get("base_model"))
+        return cls(thresholds, load_baseline(), local_model)
+
+    def baseline_decision(self, rules):
+        accepted = [rule for rule in rules if rule in self.positive_rules]
+        if accepted:
+            return True, "baseline: " + ", ".join(accepted)
+        if not rules and self.accept_negative:
+            return False, "baseline: no rule"
+        return None
+
+    def decide_rows(self, rows):
+        decisions = [self.baseline_decision(rules) for rules in self.baseline([str(row["query"]) for row in rows])]
+        self.counts["baseline"] += sum(decision is not None for decision in decisions)
+
+        if self.local_model is not None:
+            uncertain = [index for index, decision in enumerate(decisions) if decision is None]
+            for start in range(0, len(uncertain), self.local_model.batch_size):
+                indices = uncertain[start:start + self.local_model.batch_size]
+                predictions = self.local_model.predict([str(rows[index]["query"]) for index in indices])
+                for index, (label, probability) in zip(indices, predictions):
+                    if probability >= self.local_threshold:
+                        # same bool outcome as the LLM answers (process_output_CoT), the label names are strings
+                        decisions[index] = (label == "True", f"local: {label} ({probability:.4f})")
+                        self.counts["local"] += 1
+
+        self.counts["llm"] += sum(decision is None for decision in decisions)
+        return decisions
+
+    def report(self):
+        total = sum(self.counts.values())
+        if total:
+            print(f"Cascade: {self.counts['baseline']} rows answered by the baseline, {self.counts['local']} by the local model, "
+                  f"{self.counts['llm']} sent to the LLM ({1 - self.counts['llm'] / total:.1%} of the calls avoided)")
+        return dict(self.counts)
+
+
+def rule_stats(rules_per_row, gold):
+    """
+    For each rule, the rows it fires on and how many of them are causal. "none" stands for the rows no rule fires on
+    """
+    stats = {}
+    for rules, label in zip(rules_per_row, gold):
+        for rule in rules or ["none"]:
+            rule_counts = stats.setdefault(rule, {"support": 0, "causal": 0})
+            rule_counts["support"] += 1
+            rule_counts["causal"] += label
+    for rule, rule_counts in stats.items():
+        # precision of the prediction the rule makes: causal, or non-causal for "none"
+        agreeing = rule_counts["support"] - rule_counts["causal"] if rule == "none" else rule_counts["causal"]
+        rule_counts["precision"] = agreeing / rule_counts["support"]
+    return stats
+
+
+def local_threshold_for(predictions, gold, target_agreement, min_support):
+    """
+    Lowest probability such that the predictions at or above it agree with gold on at least target_agreement of the rows
+    (and cover at least min_support rows), None if there is none
+    """
+    ranked = sorted(zip(predictions, gold), key=lambda item: -item[0][1])
+    agreeing = 0
+    threshold = None
+    for count, ((label, probability), expected) in enumerate(ranked, start=1):
+        agreeing += (label == "True") == expected
+        # only cut between distinct probabilities, so that the threshold accepts exactly these rows
+        if count < len(ranked) and ranked[count][0][1] == probability:
+            continue
+        if count >= min_support and agreeing / count >= target_agreement:
+            threshold = probability
+    return threshold
+
+
+def simulate(thresholds, rules_per_row, gold, local_predictions=None):
+    """
+    Outcome of the cascade over the labeled rows: calls avoided, and agreement of the accepted rows with the LLM labels.
+    The rows sent to the LLM agree by definition, so agreement_lost is the share of all the rows the cascade gets wrong
+    """
+    cascade = Cascade(thresholds)
+    accepted = {"baseline": 0, "local": 0}
+    disagreements = 0
+    for index, (rules, expected) in enumerate(zip(rules_per_row, gold)):
+        decision = cascade.baseline_decision(rules)
+        stage = "baseline"
+        if decision is None and local_predictions is not None and thresholds.get("local_threshold") is not None:
+            label, probability = local_predictions[index]
+            if probability >= thresholds["local_threshold"]:
+                decision, stage = (label == "True", None), "local"
+        if decision is None:
+            continue
+        accepted[stage] += 1
+        disagreements += decision[0] != expected
+
+    total = len(gold)
+    answered = accepted["baseline"] + accepted["local"]
+    return {
+        "rows": total,
+        "answered_by_baseline": accepted["baseline"],
+        "answered_by_local_model": accepted["local"],
+        "llm_calls": total - answered,
+        "calls_avoided": answered / total if total else 0,
+        "agreement_on_answered": 1 - disagreements / answered if answered else None,
+        "agreement_lost": disagreements / total if total else 0
+    }
+
+
+def thresholds_for(stats, target_agreement, min_support, local_predictions=None, rules_per_row=None, gold=None):
+    thresholds = {
+        "target_agreement": target_agreement,
+        "min_support": min_support,
+        "positive_rules": sorted(rule for rule, rule_counts in stats.items() if rule != "none"
+                                 and rule_counts["support"] >= min_support and rule_counts["precision"] >= target_agreement),
+        "accept_negative": "none" in stats and stats["none"]["support"] >= min_support
+                           and stats["none"]["precision"] >= target_agreement
+    }
+    if local_predictions is not None:
+        # calibrated on the rows the baseline leaves to the local model
+        cascade = Cascade(thresholds)
+        remaining = [index for index, rules in enumerate(rules_per_row) if cascade.baseline_decision(rules) is None]
+        thresholds["local_threshold"] = local_threshold_for([local_predictions[index] for index in remaining],
+                                                            [gold[index] for index in remaining], target_agreement, min_support)
+    return thresholds
+
+
+def calibrate(labeled_file, output_path, target_agreement=0.98, min_support=20, local_model=None, base_model=None,
+              targets=default_targets):
+    """
+    Calibrates the cascade on labeled_file and saves the thresholds for target_agreement to output_path, with the
+    statistics of every rule and the trade-off between calls avoided and agreement lost for each of targets
+    """
+    rows = read_labeled_file(labeled_file)
+    gold = [gold_label(row["is_causal"]) for row in rows]
+    baseline = load_baseline()
+    rules_per_row = baseline([str(row["query"]) for row in rows])
+    stats = rule_stats(rules_per_row, gold)
+
+    local_predictions = None
+    if local_model:
+        from backends import HFClassifierBackend
+        classifier = HFClassifierBackend(local_model, base_model)
+        local_predictions = []
+        for start in range(0, len(rows), classifier.batch_size):
+            local_predictions.extend(classifier.predict([str(row["query"]) for row in rows[start:start + classifier.batch_size]]))
+
+    print(f"{len(rows)} labeled rows, {sum(gold)} causal")
+    for rule, rule_counts in sorted(stats.items(), key=lambda item: -item[1]["precision"]):
+        print(f"  {rule}: fires on {rule_counts['support']} rows, precision {rule_counts['precision']:.3f}")
+
+    tradeoff = []
+    for target in sorted(set(targets) | {target_agreement}):
+        target_thresholds = thresholds_for(stats, target, min_support, local_predictions, rules_per_row, gold)
+        result = simulate(target_thresholds, rules_per_row, gold, local_predictions)
+        result["target_agreement"] = target
+        tradeoff.append(result)
+        local = "" if local_predictions is None else f", local threshold {target_thresholds['local_threshold']}"
+        print(f"Target {target}: {result['calls_avoided']:.1%} of the API calls avoided, {result['agreement_lost']:.2%} "
+              f"agreement lost ({result['llm_calls']} calls left{local})")
+
+    thresholds = thresholds_for(stats, target_agreement, min_support, local_predictions, rules_per_row, gold)
+    thresholds.update(local_model=local_model, base_model=base_model, labeled_file=labeled_file, rule_stats=stats,
+                      tradeoff=tradeoff)
+    with open(output_path, "w") as file:
+        json.dump(thresholds, file, indent=2)
+    print(f"Thresholds for a target agreement of {target_agreement} saved to {output_path}")
+    return thresholds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Calibrate the cascade of the causal classification on a labeled file')
+    parser.add_argument('labeled_file', type=str, help='JSONL with query and the LLM label is_causal')
+    parser.add_argument('--output', type=str, required=True, help='Where to save the thresholds')
+    parser.add_argument('--target_agreement', type=float, default=0.98, help='Agreement with the LLM required of every accepted prediction')
+    parser.add_argument('--min_support', type=int, default=20, help='Rows a rule must fire on to be trusted')
+    parser.add_argument('--local_model', type=str, default=None, help='Checkpoint or LoRA adapter of a local classifier, as a second stage')
+    parser.add_argument('--base_model', type=str, default=None, help='Base model of the LoRA adapter')
+    args = parser.parse_args()
+
+    calibrate(args.labeled_file, args.output, args.target_agreement, args.min_support, args.local_model, args.base_model)
@@ -0,0 +1,116 @@
+# Sidecar checkpoint index for the output files of run_classification.
+# Next to <output>.jsonl we keep <output>.jsonl.ckpt, one line per processed input row: "<row id>\t<byte offset>".
+# The offset points at the row's line in the output file, -1 marks rows that were processed but not written
+# (e.g. non-causal rows in the cat2 runs). On resume only the small index is read, and the output file is
+# touched just at its tail, to check that the last indexed line is intact.
+
+import json
+import os
+
+
+class CheckpointIndex:
+    """
+    Tracks which input rows have already been processed, and appends new output lines together with their index entry
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.index_path = output_path + ".ckpt"
+        self.done = set()
+        self.last_id = None
+        self.last_offset = None
+        self.output_file = None
+        self.index_file = None
+
+    def load(self):
+        """
+        Load the index, rebuilding it from the output file if the output predates the index.
+        Returns the set of processed row ids (as strings)
+        """
+        if not os.path.exists(self.output_path):
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            return self.done
+
+        if not os.path.exists(self.index_path):
+            self.rebuild()
+
+        with open(self.index_path, "r") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # partially written entry, its row will be processed again
+                    break
+                row_id, offset = line.rstrip("\n").split("\t")
+                offset = int(offset)
+                self.done.add(row_id)
+                if offset >= 0:
+                    self.last_id, self.last_offset = row_id, offset
+
+        self.check_tail()
+        return self.done
+
+    def rebuild(self):
+        """
+        One-off scan of an output file written without the index
+        """
+        print(f"No checkpoint index for {self.output_path}, building it from the output file")
+        with open(self.output_path, "rb") as f, open(self.index_path, "w") as index:
+            offset = 0
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                row_id = json.loads(line)["id"]
+                index.write(f"{row_id}\t{offset}\n")
+                offset += len(line)
+
+    def check_tail(self):
+        """
+        Seek to the last indexed line, check that it belongs to the last indexed id and drop anything written after it
+        (a line whose index entry was never written, because the run stopped in between)
+        """
+        if self.last_offset is None:
+            end = 0
+        else:
+            with open(self.output_path, "rb") as f:
+                f.seek(self.last_offset)
+                line = f.readline()
+                if not line.endswith(b"\n") or str(json.loads(line)["id"]) != self.last_id:
+                    raise ValueError(f"Checkpoint index {self.index_path} does not match {self.output_path} at offset {self.last_offset}")
+                end = f.tell()
+
+        if os.path.getsize(self.output_path) > end:
+            print(f"Dropping {os.path.getsize(self.output_path) - end} bytes not covered by the checkpoint index")
+            with open(self.output_path, "r+b") as f:
+                f.truncate(end)
+
+    def __enter__(self):
+        self.output_file = open(self.output_path, "ab")
+        self.index_file = open(self.index_path, "a")
+        return self
+
+    def __exit__(self, *exc):
+        self.output_file.close()
+        self.index_file.close()
+
+    def write(self, row_id, data):
+        """
+        Append a line to the output and record it in the index. The output is flushed first, so an index entry
+        always points at a complete line
+        """
+        offset = self.output_file.tell()
+        self.output_file.write((json.dumps(data) + "\n").encode("utf-8"))
+        self.output_file.flush()
+        self.record(row_id, offset)
+
+    def skip(self, row_id):
+        """
+        Record a row that is processed without writing an output line
+        """
+        self.record(row_id, -1)
+
+    def record(self, row_id, offset):
+        self.index_file.write(f"{row_id}\t{offset}\n")
+        self.index_file.flush()
+        self.done.add(str(row_id))
+        if offset >= 0:
+            self.last_id, self.last_offset = str(row_id), offset
@@ -0,0 +1,43 @@
+# Deduplication of the rendered prompts before they are sent.
+# Many summaries repeat across the sources of CausalQuest (especially short Quora and MS MARCO questions), so rows whose
+# rendered prompt is the same, up to case and whitespace, are sent once and the answer is fanned out to all of them.
+
+import hashlib
+import re
+
+
+def normalize_prompt(messages):
+    text = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    return re.sub(r'\s+', ' ', text).strip().casefold()
+
+
+def prompt_key(messages):
+    return hashlib.sha1(normalize_prompt(messages).encode("utf-8")).hexdigest()
+
+
+class PromptDeduplicator:
+    """
+    Maps each normalized prompt to the first row that used it, and counts how many requests were saved
+    """
+
+    def __init__(self):
+        self.first_seen = {}
+        self.rows = 0
+
+    def lookup(self, messages):
+        """
+        Register a row. Returns its key and the value stored for the first row with the same prompt, None if it is new
+        """
+        key = prompt_key(messages)
+        self.rows += 1
+        return key, self.first_seen.get(key)
+
+    def store(self, key, value):
+        self.first_seen[key] = value
+
+    def report(self):
+        unique = len(self.first_seen)
+        saved = self.rows - unique
+        share = saved / self.rows if self.rows else 0
+        print(f"Deduplication: {self.rows} rows, {unique} unique prompts, {saved} requests saved ({share:.1%})")
+        return {"rows": self.rows, "unique_prompts": unique, "saved_requests": saved}
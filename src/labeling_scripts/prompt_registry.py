@@ -0,0 +1,152 @@
+# Catalog of the prompt functions of utils.py, compiled once into templates.
+# A prompt function is called a single time with a marker in place of each argument, and its output is split into the
+# literal text segments around the markers. Rendering a row is then a join of the segments with the row's values, instead
+# of rebuilding the multi-kilobyte f-string, and the registry knows which part of every prompt is static: its text, its
+# token count and a version id (a hash of the static text), so that cached responses and batch jobs can record exactly
+# which prompt produced them.
+#
+# The "prefix_cache" layout rewrites a template so that every variable field comes after the static instructions: the
+# "{website}" of the first sentence becomes a reference ("the website given below") and the value goes on its own line
+# next to the question. All the rows of a prompt family then share the same prefix (about 1k tokens for the causal
+# prompts), which the provider-side prompt cache can reuse, instead of diverging at the first sentence with the source.
+
+import hashlib
+import inspect
+
+
+prompt_layouts = ["default", "prefix_cache"]
+
+# how the prefix_cache layout refers to a moved field in the instructions, and the label of its line
+slot_references = {"website": "the website given below", "source": "the website given below"}
+slot_labels = {"website": "Website", "source": "Website"}
+
+
+class PromptTemplate:
+    """
+    A prompt function compiled into static segments and variable slots, named after the function's arguments
+    """
+
+    def __init__(self, name, function, layout="default"):
+        self.name = name
+        self.function = function
+        self.layout = layout
+        self.slots = list(inspect.signature(function).parameters)
+        markers = {slot: f"\x00{slot}\x00" for slot in self.slots}
+        text = function(**markers)
+
+        # segments[0] slots[0] segments[1] slots[1] ... segments[-1], with the slots in the order they appear in the text
+        self.segments = []
+        self.slot_order = []
+        position = 0
+        while True:
+            found = []
+            for slot, marker in markers.items():
+                start = text.find(marker, position)
+                if start >= 0:
+                    found.append((start, slot))
+            if not found:
+                break
+            start, slot = min(found)
+            self.segments.append(text[position:start])
+            self.slot_order.append(slot)
+            position = start + len(markers[slot])
+        self.segments.append(text[position:])
+        if layout == "prefix_cache":
+            self.move_slots_to_end()
+
+        label = name if layout == "default" else f"{name}:{layout}"
+        self.version = f"{label}@{hashlib.sha1(chr(0).join(self.segments + self.slot_order).encode('utf-8')).hexdigest()[:12]}"
+        self.token_counts = {}
+
+    def move_slots_to_end(self):
+        """
+        Keep only the last slot (the question) in place, replace the other slots in the text with a reference and give
+        them a line of their own just before the line of the last slot
+        """
+        if len(self.slot_order) < 2:
+            return
+        last = self.slot_order[-1]
+        moved = list(dict.fromkeys(slot for slot in self.slot_order[:-1] if slot != last))
+        text = self.segments[0]
+        for slot, segment in zip(self.slot_order[:-1], self.segments[1:-1]):
+            text += slot_references.get(slot, f"the {slot} given below") + segment
+        # text ends with the label of the last slot, e.g. "Question: "
+        head, newline, label = text.rpartition("\n")
+        indent = label[:len(label) - len(label.lstrip())]
+
+        segments = [f"{head}{newline}{indent}{slot_labels.get(moved[0], moved[0].capitalize())}: "]
+        for slot in moved[1:]:
+            segments.append(f"\n{indent}{slot_labels.get(slot, slot.capitalize())}: ")
+        segments.append("\n" + label)
+        segments.append(self.segments[-1])
+        self.segments = segments
+        self.slot_order = moved + [last]
+
+    @property
+    def static_prefix(self):
+        """
+        The text before the first slot, identical for every row
+        """
+        return self.segments[0]
+
+    @property
+    def static_text(self):
+        return "".join(self.segments)
+
+    def render(self, *args, **kwargs):
+        values = dict(zip(self.slots, args), **kwargs)
+        parts = [self.segments[0]]
+        for slot, segment in zip(self.slot_order, self.segments[1:]):
+            parts.append(f"{values[slot]}")
+            parts.append(segment)
+        return "".join(parts)
+
+    def static_tokens(self, model="gpt-4"):
+        """
+        Number of tokens of the static text of the prompt (all the segments, without the slots)
+        """
+        if model not in self.token_counts:
+            import tiktoken
+            try:
+                enc = tiktoken.encoding_for_model(model)
+            except KeyError:
+                enc = tiktoken.get_encoding("cl100k_base")
+            self.token_counts[model] = sum(len(enc.encode(segment)) for segment in self.segments)
+        return self.token_counts[model]
+
+
+class PromptRegistry:
+    """
+    Prompt templates by function name and layout, compiled the first time they are requested.
+    namespace is the dict the prompt functions are looked up in (the globals of utils), layout the default layout
+    """
+
+    prefixes = ("get_prompt_", "get_system_prompt_")
+
+    def __init__(self, namespace, layout="default"):
+        self.namespace = namespace
+        self.layout = layout
+        self.templates = {}
+
+    def names(self):
+        return sorted(name for name, value in self.namespace.items()
+                      if name.startswith(self.prefixes) and callable(value))
+
+    def get(self, name, layout=None):
+        layout = layout or self.layout
+        template = self.templates.get((name, layout))
+        if template is None:
+            if not name.startswith(self.prefixes) or name not in self.namespace:
+                raise KeyError(f"Unknown prompt function {name}")
+            template = PromptTemplate(name, self.namespace[name], layout)
+            self.templates[(name, layout)] = template
+        return template
+
+    def render(self, name, *args, **kwargs):
+        return self.get(name).render(*args, **kwargs)
+
+    def version(self, name):
+        return self.get(name).version
+
+    def versions(self):
+        return {name: self.version(name) for name in self.names()}
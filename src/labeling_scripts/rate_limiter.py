@@ -0,0 +1,192 @@
+# Client-side scheduler that keeps the live classification path within the account's requests/minute and tokens/minute quota.
+# The two limits are token buckets. Their level is corrected with the x-ratelimit-* headers returned by the API,
+# so that we can send requests right at the quota instead of far below it.
+
+import asyncio
+import re
+import threading
+import time
+
+
+def parse_reset_duration(value):
+    """
+    Parse the duration format of the x-ratelimit-reset-* headers (e.g. "1s", "6m0s", "20ms") into seconds
+    """
+    if value is None:
+        return None
+    total = 0.0
+    matched = False
+    for amount, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value):
+        matched = True
+        amount = float(amount)
+        if unit == "ms":
+            total += amount / 1000
+        elif unit == "s":
+            total += amount
+        elif unit == "m":
+            total += amount * 60
+        elif unit == "h":
+            total += amount * 3600
+    return total if matched else None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at capacity per minute
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount, now):
+        """
+        Seconds until amount can be consumed. Requests bigger than the whole bucket only wait for a full bucket
+        """
+        self.refill(now)
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def consume(self, amount):
+        self.level -= amount
+
+    def set_from_server(self, limit, remaining, now):
+        """
+        Align the bucket with the limit and remaining budget reported by the server
+        """
+        if limit:
+            self.capacity = float(limit)
+            self.rate = self.capacity / 60
+        self.level = min(self.capacity, float(remaining))
+        self.updated = now
+
+
+class RateLimitScheduler:
+    """
+    Blocks each request until both the requests/minute and the tokens/minute budget allow it.
+
+    Token cost of a request = estimated prompt tokens + max_tokens, which is how the API accounts requests against the limit.
+    Thread safe, and usable from asyncio through acquire_async.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, model):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.model = model
+        self.encoding = None
+        self.lock = threading.Lock()
+        self.in_flight_requests = 0
+        self.in_flight_tokens = 0
+        self.paused_until = 0.0
+
+    def get_encoding(self):
+        # same tokenizer lookup as run_batchAPI.chunkify, with a fallback for models tiktoken does not know
+        if self.encoding is None:
+            import tiktoken
+            try:
+                self.encoding = tiktoken.encoding_for_model(self.model)
+            except KeyError:
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+        return self.encoding
+
+    def estimate_tokens(self, messages, max_tokens):
+        """
+        Estimate the tokens a chat request counts against the tokens/minute limit
+        """
+        enc = self.get_encoding()
+        prompt_tokens = 3  # every reply is primed with <|start|>assistant<|message|>
+        for message in messages:
+            prompt_tokens += 4 + len(enc.encode(message['content']))
+        return prompt_tokens + max_tokens
+
+    def try_reserve(self, cost):
+        """
+        Reserve the budget for one request. Returns 0 if reserved, otherwise the seconds to wait before retrying
+        """
+        with self.lock:
+            now = time.monotonic()
+            wait = max(self.paused_until - now, self.requests.time_until(1, now), self.tokens.time_until(cost, now))
+            if wait > 0:
+                return wait
+            self.requests.consume(1)
+            self.tokens.consume(cost)
+            self.in_flight_requests += 1
+            self.in_flight_tokens += cost
+            return 0.0
+
+    def acquire(self, messages, max_tokens):
+        """
+        Block until the request can be sent. Returns its estimated cost, to be passed to release
+        """
+        cost = self.estimate_tokens(messages, max_tokens)
+        while True:
+            wait = self.try_reserve(cost)
+            if wait == 0:
+                return cost
+            time.sleep(wait)
+
+    async def acquire_async(self, messages, max_tokens):
+        """
+        Async version of acquire
+        """
+        cost = self.estimate_tokens(messages, max_tokens)
+        while True:
+            wait = self.try_reserve(cost)
+            if wait == 0:
+                return cost
+            await asyncio.sleep(wait)
+
+    def release(self, cost, headers=None):
+        """
+        Mark a request as answered and, if available, correct the buckets with its x-ratelimit-* headers
+        """
+        with self.lock:
+            self.in_flight_requests -= 1
+            self.in_flight_tokens -= cost
+            if headers is not None:
+                self.update_from_headers(headers)
+
+    def update_from_headers(self, headers):
+        """
+        The remaining budget in the headers already accounts for every request the server has seen;
+        we only subtract what is still in flight from our side. Must be called holding the lock.
+        """
+        now = time.monotonic()
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_requests is not None:
+            self.requests.set_from_server(headers.get("x-ratelimit-limit-requests"),
+                                          int(remaining_requests) - self.in_flight_requests, now)
+        if remaining_tokens is not None:
+            self.tokens.set_from_server(headers.get("x-ratelimit-limit-tokens"),
+                                        int(remaining_tokens) - self.in_flight_tokens, now)
+
+    def pause(self, headers=None, default_seconds=1.0):
+        """
+        Called on a 429: hold every request until the limit that was hit resets
+        """
+        seconds = None
+        if headers is not None:
+            if headers.get("retry-after-ms"):
+                seconds = float(headers["retry-after-ms"]) / 1000
+            elif headers.get("retry-after"):
+                seconds = float(headers["retry-after"])
+            else:
+                resets = [parse_reset_duration(headers.get(name)) for name in
+                          ("x-ratelimit-reset-requests", "x-ratelimit-reset-tokens")]
+                resets = [r for r in resets if r is not None]
+                if resets:
+                    seconds = max(resets)
+        if seconds is None:
+            seconds = default_seconds
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        return seconds
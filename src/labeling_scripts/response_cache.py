@@ -0,0 +1,132 @@
+# Persistent on-disk cache of the chat completions, so that reruns of the same prompts over the same summaries
+# (seed=42, temperature=0) do not pay the API latency and cost again.
+# Entries are keyed by a hash of (model, messages, max_tokens, temperature, seed) and evicted in LRU order
+# once the cache grows above max_bytes.
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+
+class CacheMiss(KeyError):
+    """
+    Raised in replay mode when a request is not in the cache
+    """
+
+
+def request_key(model, messages, max_tokens, temperature, seed):
+    """
+    Content address of a chat request
+    """
+    payload = json.dumps({
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "seed": seed
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    SQLite-backed LRU cache of response contents.
+
+    replay=True makes the cache read-only: misses raise CacheMiss instead of going to the API, for offline runs.
+    """
+
+    def __init__(self, path, max_bytes=1024 ** 3, replay=False):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, last_used REAL, prompt_version TEXT)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(responses)")]
+        if "prompt_version" not in columns:
+            # caches created before the prompt registry
+            self.connection.execute("ALTER TABLE responses ADD COLUMN prompt_version TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used)")
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, model, messages, max_tokens, temperature, seed):
+        """
+        Returns the cached response or None. In replay mode a miss raises CacheMiss
+        """
+        key = request_key(model, messages, max_tokens, temperature, seed)
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                if self.replay:
+                    raise CacheMiss(key)
+                return None
+            self.hits += 1
+            if not self.replay:
+                self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, model, messages, max_tokens, temperature, seed, response, prompt_version=None):
+        """
+        prompt_version is not part of the key (the messages already are), it records which registered prompt produced the entry.
+        A response without content (None, e.g. a refusal or a filtered answer) is not cached, get could not tell it from a miss
+        """
+        if self.replay or response is None:
+            return
+        key = request_key(model, messages, max_tokens, temperature, seed)
+        size = len(response.encode("utf-8")) + len(key)
+        with self.lock:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, size, last_used, prompt_version) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, size, time.time(), prompt_version)
+            )
+            self.total_bytes += size - (previous[0] if previous else 0)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        """
+        Drop the least recently used entries until the cache is back under max_bytes. Must be called holding the lock
+        """
+        evicted = 0
+        while self.total_bytes > self.max_bytes:
+            oldest = self.connection.execute("SELECT key, size FROM responses ORDER BY last_used LIMIT 256").fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                self.connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                evicted += 1
+        return evicted
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "entries": self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0],
+            "bytes": self.total_bytes
+        }
+
+    def prompt_versions(self):
+        """
+        Number of entries per prompt version
+        """
+        rows = self.connection.execute("SELECT prompt_version, COUNT(*) FROM responses GROUP BY prompt_version")
+        return {version: count for version, count in rows}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,157 @@
+# Retries of the chat requests: jittered exponential backoff that honours Retry-After, a retry budget per error class,
+# a circuit breaker shared by all the workers and a dead-letter file for the rows that still fail.
+# A transient error (rate limit, 5xx, timeout, dropped connection) is retried until the budget of its class is spent;
+# any other error (bad request, authentication, ...) is final at once and stops the run. When too many of the recent
+# requests failed, the breaker opens and every worker waits for the cooldown before sending again, instead of hammering
+# an API that is down. A row whose transient errors outlast the retries is written to the dead-letter JSONL and the run
+# goes on with the next rows.
+
+import asyncio
+import collections
+import datetime
+import json
+import random
+import threading
+import time
+
+
+default_budgets = {"rate_limit": 8, "server": 5, "timeout": 5, "connection": 5}
+
+
+def error_class(error):
+    """
+    Retry class of an exception raised by the OpenAI client, None for the errors that are not worth retrying
+    """
+    import openai
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, openai.APITimeoutError):
+        return "timeout"
+    if isinstance(error, openai.APIConnectionError):
+        return "connection"
+    if isinstance(error, openai.APIStatusError) and error.status_code >= 500:
+        return "server"
+    return None
+
+
+def is_retryable(error):
+    return error_class(error) is not None
+
+
+def is_api_error(error):
+    """
+    Errors that fail a single row (and go to the dead-letter file) rather than the whole run: transient errors whose
+    retries are exhausted, and replay cache misses. Authentication, permission, unknown model or bad request errors
+    would fail every row the same way, so they stop the run
+    """
+    from response_cache import CacheMiss
+    return is_retryable(error) or isinstance(error, CacheMiss)
+
+
+def retry_after(headers):
+    """
+    Seconds requested by the Retry-After (or retry-after-ms) header, None if there is none
+    """
+    if headers is None:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        # Retry-After can also be an HTTP date, which the API does not send
+        return None
+    return None
+
+
+class RetryPolicy:
+    """
+    Retry budgets per error class and the backoff between attempts: "full jitter", a uniform delay between 0 and
+    base_delay * 2 ** attempt capped at max_delay, unless the server asked for a specific delay
+    """
+
+    def __init__(self, budgets=None, base_delay=1.0, max_delay=60.0):
+        self.budgets = dict(default_budgets, **(budgets or {}))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def can_retry(self, kind, attempts):
+        """
+        kind is the error_class of the error, attempts counts the retries already done per error class
+        """
+        return kind is not None and attempts.get(kind, 0) < self.budgets.get(kind, 0)
+
+    def delay(self, attempt, headers=None):
+        requested = retry_after(headers)
+        if requested is not None:
+            return min(requested, self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """
+    Opens when at least error_rate of the last window requests failed (with min_requests of them seen), and then holds
+    every request for cooldown seconds. The window starts empty again after the cooldown
+    """
+
+    def __init__(self, window=20, min_requests=10, error_rate=0.5, cooldown=30.0):
+        self.outcomes = collections.deque(maxlen=window)
+        self.min_requests = min_requests
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.open_until = 0.0
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def record(self, success):
+        with self.lock:
+            self.outcomes.append(success)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_requests and failures >= self.error_rate * len(self.outcomes):
+                self.open_until = time.monotonic() + self.cooldown
+                self.trips += 1
+                self.outcomes.clear()
+                print(f"Circuit breaker open: {failures} of the last requests failed, pausing all requests for {self.cooldown:.1f}s")
+
+    def wait_time(self):
+        with self.lock:
+            return max(0.0, self.open_until - time.monotonic())
+
+    def wait(self):
+        seconds = self.wait_time()
+        while seconds > 0:
+            time.sleep(seconds)
+            seconds = self.wait_time()
+
+    async def wait_async(self):
+        seconds = self.wait_time()
+        while seconds > 0:
+            await asyncio.sleep(seconds)
+            seconds = self.wait_time()
+
+
+class DeadLetterQueue:
+    """
+    Append-only JSONL of the rows whose request failed for good, with the error, so that they can be inspected and rerun
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def write(self, row_id, classification_type, error):
+        record = {
+            "id": row_id,
+            "classification_type": classification_type,
+            "error_class": error_class(error),
+            "error_type": type(error).__name__,
+            "error": str(error),
+            "time": datetime.datetime.now().isoformat()
+        }
+        with self.lock:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(record, default=str) + "\n")
+            self.count += 1
+        print(f"Row {row_id} failed ({type(error).__name__}), written to {self.path}")
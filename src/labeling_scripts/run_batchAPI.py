@@ -7,15 +7,30 @@
 # the files are all uploaded to openai
 # then a function sends one by one the requests to openai
 # finally, the outputs are retrieved and processed
+# the state of every chunk is kept in manifest.sqlite inside the job folder (see batch_manifest.py), so that each stage
+# skips what is already done when the script is run again
 
-import datetime
-import tiktoken
+import hashlib
+import heapq
+import itertools
+import re
 import json
 import os
-from utils import get_system_prompt_cat_2,process_output_CoT, get_prompt_cat_1_iteration_4
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from batch_manifest import BatchManifest, chunk_number
+from batch_ids import encode_custom_id, decode_custom_id, write_row_index, write_duplicate_index, join_batch_results
+from dedup import PromptDeduplicator
+from utils import get_client, prompts, configure_prompt_layout, process_output_CoT, parse_cat2_outcome
+from usage_stats import UsageStats
 import time
 
+feature_names = {
+    "subjectivity": "is_subjective",
+    "domain": "domain_class",
+    "action": "action_class",
+    "causal": "is_causal"
+}
+
 source_mapping = {
     "sg": "ChatGPT",
     "wc": "ChatGPT",
@@ -25,21 +40,31 @@ source_mapping = {
 }
 
 
-def convert_to_openai_input(file_name, output_folder, cat, prompt_function, model):
+def convert_to_openai_input(file_name, output_folder, cat, prompt_function, model, manifest=None, dedup=False, system_prompt_flag=True):
     # transform the data in the format required by openai
+    # with dedup, rows whose prompt is the same as an earlier row's are not sent: their offsets are kept in the
+    # <formatted file>.dups sidecar and join_batch_results copies the answer of the first row to them
     cat1 = False
-    # if the file already exists, return it
+    # if the file was already formatted, return it
     formatted_file = os.path.join(output_folder, f'openai_batch_job_{cat}.jsonl')
-    # if os.path.exists(formatted_file):
-    #     print(f"File {formatted_file} already exists, returning it")
-    #     return formatted_file
+    if manifest is not None and manifest.stage_done("formatted"):
+        print(f"File {formatted_file} already formatted, returning it")
+        return formatted_file
 
     if cat == "causal":
         cat1 = True
 
     written_lines_counter = 0
-    with open(file_name, 'r') as infile, open(formatted_file, 'w') as outfile:
+    # byte offset in the input file of the row of each request, see batch_ids.py
+    row_offsets = []
+    # request index of the first row with the same prompt -> input offsets of the duplicate rows
+    duplicates = {}
+    deduplicator = PromptDeduplicator() if dedup else None
+    offset = 0
+    with open(file_name, 'rb') as infile, open(formatted_file, 'w') as outfile:
         for i, line in enumerate(infile):
+            line_offset = offset
+            offset += len(line)
             data = json.loads(line)
             
             if not cat1:
@@ -49,16 +74,25 @@ def convert_to_openai_input(file_name, output_folder, cat, prompt_function, mode
 
             summary = data["summary"]
             source = source_mapping[data['source']]
-            if cat1: 
+            if cat1 or not system_prompt_flag:
                 system_prompt = None
             else:     
-                system_prompt = get_system_prompt_cat_2()
+                system_prompt = prompts.render("get_system_prompt_cat_2")
 
             prompt = prompt_function(source, summary)
 
+            if deduplicator is not None:
+                messages = [{"role": "system", "content": system_prompt}] if system_prompt else []
+                messages.append({"role": "user", "content": prompt})
+                key, first_index = deduplicator.lookup(messages)
+                if first_index is not None:
+                    duplicates.setdefault(first_index, []).append(line_offset)
+                    continue
+                deduplicator.store(key, written_lines_counter)
+
             if system_prompt: 
                 output_data = {
-                    "custom_id": f"request_{written_lines_counter}_queryId_{data['id']}_source_{data['source']}",
+                    "custom_id": encode_custom_id(written_lines_counter, data['id'], data['source']),
                     "method": "POST",
                     "url": "/v1/chat/completions",
                     "body": {
@@ -71,7 +105,7 @@ def convert_to_openai_input(file_name, output_folder, cat, prompt_function, mode
                 }
             else:
                 output_data = {
-                    "custom_id": f"request_{written_lines_counter}_queryId_{data['id']}_source_{data['source']}",
+                    "custom_id": encode_custom_id(written_lines_counter, data['id'], data['source']),
                     "method": "POST",
                     "url": "/v1/chat/completions",
                     "body": {
@@ -82,70 +116,115 @@ def convert_to_openai_input(file_name, output_folder, cat, prompt_function, mode
                     }
                 }
             json.dump(output_data, outfile)
+            row_offsets.append(line_offset)
             written_lines_counter += 1
             print(f"Written {written_lines_counter} lines")
             outfile.write('\n')
+    write_row_index(row_offsets, formatted_file)
+    write_duplicate_index(duplicates, formatted_file)
+    if deduplicator is not None:
+        deduplicator.report()
+    if manifest is not None:
+        manifest.mark_stage("formatted", formatted_file)
     return formatted_file
     
     
-def chunkify(formatted_file, output_folder, n_tokens, model):
-    # divide the data in chunks of chunk_size tokens
+# per-file limits of the Batch API
+batch_max_requests = 50000
+batch_max_bytes = 200 * 1024 * 1024
 
-    # To get the tokeniser corresponding to a specific model in the OpenAI API:
-    enc = tiktoken.encoding_for_model(model)
 
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    
+def count_request_tokens(enc, lines, num_threads=8):
+    """
+    Token count of the messages of each request line, tokenizing the whole block at once with tiktoken's batch encoding
+    """
+    requests = [json.loads(line) for line in lines]
+    texts = [message['content'] for data in requests for message in data['body']['messages']]
+    encoded = enc.encode_batch(texts, num_threads=num_threads, disallowed_special=())
+    counts = []
+    position = 0
+    for data in requests:
+        n_messages = len(data['body']['messages'])
+        counts.append(sum(len(tokens) for tokens in encoded[position:position + n_messages]))
+        position += n_messages
+    return counts
+
+
+def chunkify(formatted_file, output_folder, n_tokens, model, manifest, max_requests=batch_max_requests, max_bytes=batch_max_bytes,
+             block_size=2000, num_threads=8):
+    """
+    Divide the requests in chunks of at most n_tokens tokens, max_requests requests and max_bytes bytes.
+
+    The file is streamed in blocks of block_size lines, each block tokenized with tiktoken's batch encoding, and every
+    request is written straight to its chunk file. A request is never split: if it does not fit in the current chunk,
+    the chunk is closed and the request opens the next one. The per-chunk counts are registered in the manifest,
+    in a single transaction once all the chunks are written
+    """
+
     # create a folder chunks in the output folder
     output_base_path = os.path.join(output_folder, "chunks")
-    if not os.path.exists(output_base_path):
-        os.makedirs(output_base_path)
-    else: 
+    if manifest.chunks():
         return output_base_path
-    
 
-    current_chunk = 0
-    current_token_count = 0
-    chunk_data = []
+    # To get the tokeniser corresponding to a specific model in the OpenAI API:
+    import tiktoken
+    enc = tiktoken.encoding_for_model(model)
 
-    with open(formatted_file, 'r') as infile:
+    if not os.path.exists(output_base_path):
+        os.makedirs(output_base_path)
+    else:
+        # leftovers of a run that stopped before registering its chunks
+        for name in os.listdir(output_base_path):
+            os.remove(os.path.join(output_base_path, name))
+
+    chunks = []
+    current = None
+
+    def close_chunk():
+        current["file"].close()
+        chunks.append({key: current[key] for key in ["name", "requests", "tokens", "bytes"]})
+        print(f"Chunk {len(chunks) - 1} has {current['tokens']} tokens, {current['requests']} requests, {current['bytes']} bytes.")
+
+    def open_chunk():
+        name = f'chunk_{len(chunks)}.jsonl'
+        return {"name": name, "file": open(os.path.join(output_base_path, name), 'wb'), "requests": 0, "tokens": 0, "bytes": 0}
+
+    def add_block(lines):
+        nonlocal current
+        for line, token_count in zip(lines, count_request_tokens(enc, lines, num_threads)):
+            if current is not None and current["requests"] > 0 and (
+                    current["tokens"] + token_count > n_tokens
+                    or current["requests"] + 1 > max_requests
+                    or current["bytes"] + len(line) > max_bytes):
+                close_chunk()
+                current = None
+            if current is None:
+                current = open_chunk()
+            current["file"].write(line)
+            current["requests"] += 1
+            current["tokens"] += token_count
+            current["bytes"] += len(line)
+
+    with open(formatted_file, 'rb') as infile:
+        block = []
         for line in infile:
-            # Parse the JSON line
-            data = json.loads(line)
-            # Process each message in the body
-            for message in data['body']['messages']:
-                tokens = enc.encode(message['content'])
-                token_count = len(tokens)
-                current_token_count += token_count
-            
-            # Check if the current token count has exceeded the limit
-            if current_token_count >= n_tokens:
-                # Write the current list of messages to a file
-                output_filename = os.path.join(output_base_path, f'chunk_{current_chunk}.jsonl')
-                with open(output_filename, 'w') as outfile:
-                    for item in chunk_data:
-                        json.dump(item, outfile)
-                        outfile.write('\n')
-                # print the number of tokens
-                print(f"Chunk {current_chunk} has {current_token_count} tokens.")
-
-                # Reset for the next chunk
-                chunk_data = []
-                current_chunk += 1
-                current_token_count = token_count  # Start new count with the current message
-
-            # Add the data to the current chunk's data list
-            chunk_data.append(data)
-
-    # Handle any remaining data that didn't reach the token limit
-    if chunk_data:
-        output_filename = os.path.join(output_base_path, f'chunk_{current_chunk}.jsonl')
-        with open(output_filename, 'w') as outfile:
-            for item in chunk_data:
-                json.dump(item, outfile)
-                outfile.write('\n')
-        print(f"Chunk {current_chunk} has {current_token_count} tokens.")
+            if not line.strip():
+                continue
+            if not line.endswith(b"\n"):
+                line += b"\n"
+            block.append(line)
+            if len(block) == block_size:
+                add_block(block)
+                block = []
+        if block:
+            add_block(block)
+
+    if current is not None:
+        close_chunk()
+
+    manifest.add_chunks(chunks)
+    manifest.mark_stage("chunked", json.dumps({"model": model, "n_tokens": n_tokens}))
+
     return output_base_path
 
 
@@ -161,87 +240,90 @@ def delete_all_files_in_openai(client):
     assert len(client.files.list().data) == 0
 
 
-def files_upload_to_openai(chunk_path, client):
-    # upload all the files to openai
-
-    dicts_path = os.path.dirname(chunk_path)
-    
-    # if in chunk_path there are already id_to_filename and filename_to_id, load them
-    if os.path.exists(os.path.join(dicts_path, "filename_to_id.json")):
-        with open(os.path.join(dicts_path, "filename_to_id.json"), "r") as file:
-            filename_to_id = json.load(file)
-        with open(os.path.join(dicts_path, "id_to_filename.json"), "r") as file:
-            id_to_filename = json.load(file)
-        return filename_to_id, id_to_filename
-    
-    filename_to_id = {}
-    id_to_filename = {}
+def file_sha256(path, block_size=1024 * 1024):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
 
-    for filename in os.listdir(chunk_path):
 
+def upload_chunk(client, chunk_path, filename):
+    """
+    Upload one chunk, streaming it from disk, and check that the server received all of its bytes
+    """
+    path = os.path.join(chunk_path, filename)
+    size = os.path.getsize(path)
+    checksum = file_sha256(path)
+    with open(path, "rb") as chunk_file:
         file = client.files.create(
-        file=open(os.path.join(chunk_path, filename), "rb"),
+        file=chunk_file,
         purpose="batch"
         )
+    if file.bytes is not None and file.bytes != size:
+        raise Exception(f"Upload of {filename} is incomplete: {file.bytes} bytes received, {size} expected")
+    return file.id, checksum
 
-        file_id = file.id
-        filename_to_id[filename] = file_id
-        id_to_filename[file_id] = filename
-        print(f"Uploaded {filename} with ID: {file_id}")
-        
-    # save the two dicts in a file
-    with open(os.path.join(dicts_path, "filename_to_id.json"), "w") as file:
-        json.dump(filename_to_id, file)
-    with open(os.path.join(dicts_path, "id_to_filename.json"), "w") as file:
-        json.dump(id_to_filename, file)
 
-    return filename_to_id, id_to_filename
+def files_upload_to_openai(chunk_path, client, manifest, max_workers=4):
+    # upload the chunks that are not uploaded yet, max_workers at a time
+
+    filenames = [chunk["name"] for chunk in manifest.chunks("formatted")]
+    if len(filenames) == 0:
+        print("All chunks have been uploaded")
+        return
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(upload_chunk, client, chunk_path, filename): filename for filename in filenames}
+        for future in as_completed(futures):
+            filename = futures[future]
+            file_id, checksum = future.result()
+            manifest.update_chunk(filename, "uploaded", file_id=file_id, sha256=checksum)
+            print(f"Uploaded {filename} with ID: {file_id}")
 
 
-def send_requests_to_openai(client,filename_to_id, folder_path):
+running_statuses = {"validating", "in_progress", "finalizing", "cancelling"}
+
+
+def refresh_chunk(client, manifest, chunk):
+    """
+    Retrieve the batch of a submitted chunk and record its status. Returns the batch
     """
-        Takes file per file in a local folder, retrieves the id that OpenAI assigned to the file when I uploaded it, and then 
-        sends the request to OpenAI.
+    batch = client.batches.retrieve(chunk["batch_id"])
+    if batch.status == chunk["batch_status"]:
+        return batch
+    if batch.status == "completed":
+        manifest.update_chunk(chunk["name"], "completed", batch_status=batch.status,
+                              output_file_id=batch.output_file_id, error_file_id=batch.error_file_id)
+    elif batch.status in running_statuses:
+        manifest.update_chunk(chunk["name"], batch_status=batch.status)
+    else:
+        errors = [error.code for error in batch.errors.data] if batch.errors and batch.errors.data else []
+        manifest.update_chunk(chunk["name"], "failed", batch_status=batch.status, errors=errors)
+    print(f"Batch {batch.id} for {chunk['name']}: {batch.status}")
+    return batch
+
+
+def send_requests_to_openai(client, manifest, poll_interval=30):
+    """
+        Sends the uploaded chunks to OpenAI one at a time, waiting for each batch to complete before sending the next one.
+        Chunks already submitted in a previous run are waited for first.
     
     """
 
-    # create a log.txt file 
-    log_file_path = f"{os.path.dirname(folder_path)}/log.txt"
-    if not os.path.exists(log_file_path):
-        log_file = open(log_file_path, "w")
-        log_file.write("Log of batch jobs\n\n")
-        log_file.write("Filename to ID mapping:\n")
-        for filename, file_id in filename_to_id.items():
-            log_file.write(f"{filename}: {file_id}\n")
-        log_file.close()
-
-
-    # Get the list of files in the folder
-    files = os.listdir(folder_path)
-
-    missing_chunk_numbers = []
-    for file in files:
-        if "jsonl" in file and "_sent" not in file:
-            file = file[:-6]
-            chunk_n = file.split("_")[1]
-            missing_chunk_numbers.append(int(chunk_n))
-    
-    if len(missing_chunk_numbers) == 0:
+    for chunk in manifest.chunks("submitted"):
+        print(f"Waiting for {chunk['name']}, sent in a previous run")
+        wait_for_chunk(client, manifest, chunk["name"], poll_interval)
+
+    missing_chunks = manifest.chunks("uploaded")
+    if len(missing_chunks) == 0:
         print("All chunks have been sent to OpenAI")
         return
-    
-    # sort 
-    missing_chunk_numbers.sort()
-
-    for chunk_n in missing_chunk_numbers:
-        print(f"Sending chunk {chunk_n}")
-        batch_id = run_chunk(chunk_n, client, filename_to_id, chunk_path, log_file_path)
-        # check status
-        status = client.batches.retrieve(batch_id).status
-        while status == "in_progress" or status == "finalizing":
-            time.sleep(30)
-            status = client.batches.retrieve(batch_id).status
-            print(status)
+
+    for chunk in missing_chunks:
+        print(f"Sending {chunk['name']}")
+        batch_id = run_chunk(chunk["name"], client, manifest)
+        status = wait_for_chunk(client, manifest, chunk["name"], poll_interval)
         if status == "failed":
             raise Exception(f"Batch job failed, ID is {batch_id}")
         elif status == "completed":
@@ -251,22 +333,28 @@ def send_requests_to_openai(client,filename_to_id, folder_path):
             print("Something is off")
             break
 
-    time.sleep(60) # sleep for 1 minute before sending the next chunk
+
+def wait_for_chunk(client, manifest, name, poll_interval=30):
+    # check status until the batch is done
+    status = refresh_chunk(client, manifest, manifest.chunk(name)).status
+    while status in running_statuses:
+        time.sleep(poll_interval)
+        status = refresh_chunk(client, manifest, manifest.chunk(name)).status
+    return status
 
 
-def run_chunk(chunk_n, client, filename_to_id, chunk_path, log_file_path):
-  current_file_name = f"chunk_{chunk_n}.jsonl"
-  new_file_name = f"chunk_{chunk_n}_sent.jsonl"
-  file_id = filename_to_id[current_file_name]
+def run_chunk(name, client, manifest):
+  chunk = manifest.chunk(name)
 
   # Create a batch job
   batch = client.batches.create(
-    input_file_id=file_id,
+    input_file_id=chunk["file_id"],
     endpoint="/v1/chat/completions",
     completion_window="24h"
   )
 
   print(f"Created batch job with ID: {batch.id}")
+  manifest.update_chunk(name, "submitted", batch_id=batch.id, batch_status=batch.status)
   status = client.batches.retrieve(batch.id).status
   while status == "validating":
     time.sleep(5)
@@ -276,118 +364,382 @@ def run_chunk(chunk_n, client, filename_to_id, chunk_path, log_file_path):
   if status == "failed":
       raise Exception(f"Batch job failed, ID is {batch.id}")
   else: 
-    os.rename(os.path.join(chunk_path, current_file_name), os.path.join(chunk_path, new_file_name))
-    print(f"Renamed {current_file_name} to {new_file_name}")
-    current_datetime = datetime.datetime.now()
-    formatted_datetime = current_datetime.strftime('%A, %B %d, %Y - %H:%M:%S')
-    print(f"Sent {current_file_name} to OpenAI, batch id is {batch.id}, date is {formatted_datetime}")
-    # save it to th log file passed as arg
-    log_file = open(log_file_path, "a")
-    log_file.write(f"\nSuccessfully sent {current_file_name} to OpenAI, batch id is {batch.id}, date is {formatted_datetime}\n")
-    log_file.close()
+    print(f"Sent {name} to OpenAI, batch id is {batch.id}")
     return batch.id
+
+
+def send_requests_pipelined(client, manifest, enqueued_token_limit, poll_interval=30, max_limit_retries=3):
+    """
+        Keeps as many batches in flight as the enqueued token limit allows, and submits the next chunk as soon as a running
+        batch completes and frees capacity, instead of waiting for each batch before sending the next one.
+
+        Chunks whose batch fails with token_limit_exceeded go back to the uploaded state and the limit is lowered to the
+        tokens the other batches in flight got accepted with. A chunk rejected while it was the only one in flight (it is
+        above the limit on its own) or more than max_limit_retries times stays failed. Failures are reported at the end.
+    """
+
+    limit_retries = {}
+    while True:
+        # refresh the batches in flight
+        in_flight = manifest.chunks("submitted")
+        rejected = []
+        for chunk in in_flight:
+            batch = refresh_chunk(client, manifest, chunk)
+            errors = json.loads(manifest.chunk(chunk["name"])["errors"] or "[]")
+            if batch.status == "failed" and "token_limit_exceeded" in errors:
+                rejected.append(chunk)
+
+        if rejected:
+            # our token counts or the configured limit are off: lower the limit to what the other batches were accepted
+            # with, or to the smallest rejected chunk so that they are sent one at a time
+            rejected_names = {chunk["name"] for chunk in rejected}
+            accepted = sum(chunk["tokens"] for chunk in in_flight if chunk["name"] not in rejected_names)
+            enqueued_token_limit = min(enqueued_token_limit, accepted or min(chunk["tokens"] for chunk in rejected))
+            for chunk in rejected:
+                limit_retries[chunk["name"]] = limit_retries.get(chunk["name"], 0) + 1
+                if len(in_flight) == 1:
+                    print(f"{chunk['name']} ({chunk['tokens']} tokens) is above the enqueued token limit on its own, leaving it failed")
+                    continue
+                if limit_retries[chunk["name"]] > max_limit_retries:
+                    print(f"{chunk['name']} hit the enqueued token limit {limit_retries[chunk['name']]} times, leaving it failed")
+                    continue
+                print(f"{chunk['name']} hit the enqueued token limit, queueing it again (limit now {enqueued_token_limit})")
+                manifest.update_chunk(chunk["name"], "uploaded", batch_id=None, batch_status=None, errors=None)
+
+        in_flight = manifest.chunks("submitted")
+        queued = manifest.chunks("uploaded")
+        if not in_flight and not queued:
+            break
+
+        # submit while there is capacity; a chunk bigger than the limit is sent alone
+        enqueued_tokens = sum(chunk["tokens"] for chunk in in_flight)
+        for chunk in queued:
+            if in_flight and enqueued_tokens + chunk["tokens"] > enqueued_token_limit:
+                break
+            batch = client.batches.create(
+                input_file_id=chunk["file_id"],
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            manifest.update_chunk(chunk["name"], "submitted", batch_id=batch.id, batch_status=batch.status)
+            in_flight.append(chunk)
+            enqueued_tokens += chunk["tokens"]
+            print(f"Sent {chunk['name']} to OpenAI, batch id is {batch.id}, {enqueued_tokens} tokens enqueued")
+
+        time.sleep(poll_interval)
+
+    for chunk in manifest.chunks("failed"):
+        print(f"Chunk {chunk['name']} failed, errors: {chunk['errors']}")
+    print(f"Chunk states: {manifest.summary()}")
+
   
-def print_status(client, id_to_filename):
-    # prints the status of the batches
-    for batch in client.batches.list():
-        batch_id = batch.id
-        errors = batch.errors
-        input_file_id = batch.input_file_id
-        output_file_id = batch.output_file_id
-        status = batch.status
-        if input_file_id in id_to_filename and output_file_id:
-            input_file_name = id_to_filename[input_file_id]
-            print(f"Batch {batch_id} is successful, status: {status}")
-            print(f"Input file: {input_file_name}")
-            print(f"Output file id: {output_file_id}")
-            print("\n")
-        elif input_file_id in id_to_filename and not output_file_id:
-            input_file_name = id_to_filename[input_file_id]
-            print(f"Batch {batch_id} has no output file - probably it is still running")
-            print(f"Input file: {input_file_name}")
-            print(f"Status: {status}")
-            print("\n")
-
-#
-def download_results(client, output_folder_path, id_to_filename):
-    # saves the outputs
+def print_status(client, manifest):
+    # prints the status of the batches of this job
+    for chunk in manifest.chunks():
+        if chunk["batch_id"] is None:
+            print(f"{chunk['name']}: {chunk['state']}")
+            continue
+        batch = client.batches.retrieve(chunk["batch_id"])
+        print(f"Batch {batch.id} status: {batch.status}")
+        print(f"Input file: {chunk['name']}")
+        if batch.output_file_id:
+            print(f"Output file id: {batch.output_file_id}")
+        else:
+            print("No output file - probably it is still running")
+        print("\n")
+
+
+def download_output_file(client, output_file_id, output_path, block_size=1024 * 1024):
+    """
+    Stream a batch output file to disk in blocks of block_size bytes. The file is written under a temporary name and
+    renamed only once complete. Returns its size and sha256
+    """
+    expected_size = client.files.retrieve(output_file_id).bytes
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp_path = output_path + ".part"
+    with client.files.with_streaming_response.content(output_file_id) as response, open(tmp_path, "wb") as file:
+        for block in response.iter_bytes(block_size):
+            file.write(block)
+            sha256.update(block)
+            size += len(block)
+    if expected_size is not None and size != expected_size:
+        os.remove(tmp_path)
+        raise Exception(f"Download of {output_file_id} is incomplete: {size} bytes received, {expected_size} expected")
+    os.replace(tmp_path, output_path)
+    return size, sha256.hexdigest()
+
+
+def download_results(client, output_folder_path, manifest, max_workers=4, block_size=1024 * 1024):
+    # saves the outputs (and error files) of the completed chunks that are not downloaded yet, max_workers files at a time
 
     if not os.path.exists(output_folder_path):
         os.makedirs(output_folder_path)
 
-
-    # if in output_folder_path there are already files called like all values of id_to_filename, return
-    if all([os.path.exists(os.path.join(output_folder_path, filename)) for filename in id_to_filename.values()]):
-        print("All files have already been downloaded")
+    to_download = manifest.chunks("completed")
+    if len(to_download) == 0:
+        print(f"Nothing to download, chunk states: {manifest.summary()}")
         return
-    
 
-    # total batches status
-    counter = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for chunk in to_download:
+            # the requests that failed inside a completed batch are in its error file, saved as chunk_N_errors.jsonl
+            output_future, error_future = None, None
+            if chunk["error_file_id"]:
+                error_path = os.path.join(output_folder_path, chunk["name"].replace(".jsonl", "_errors.jsonl"))
+                error_future = executor.submit(download_output_file, client, chunk["error_file_id"], error_path, block_size)
+            # a batch whose requests all failed has no output file, only the error file
+            if chunk["output_file_id"]:
+                output_future = executor.submit(download_output_file, client, chunk["output_file_id"],
+                                                os.path.join(output_folder_path, chunk["name"]), block_size)
+            if output_future is None and error_future is None:
+                manifest.update_chunk(chunk["name"], "downloaded", output_bytes=0)
+                continue
+            futures[output_future or error_future] = (chunk["name"], output_future, error_future)
+        for future in as_completed(futures):
+            name, output_future, error_future = futures[future]
+            output_bytes, output_sha256 = output_future.result() if output_future is not None else (0, None)
+            if error_future is not None:
+                error_future.result()
+            manifest.update_chunk(name, "downloaded", output_bytes=output_bytes, output_sha256=output_sha256)
+            if output_future is not None:
+                print(f"Output file saved to {os.path.join(output_folder_path, name)}")
+            else:
+                print(f"{name} has no output file, every request failed")
 
-    for batch in client.batches.list():
-        counter += 1
-        batch_id = batch.id
-        errors = batch.errors
-        input_file_id = batch.input_file_id
-        output_file_id = batch.output_file_id
-        status = batch.status
-        if input_file_id in id_to_filename and output_file_id:
-            input_file_name = id_to_filename[input_file_id]
-            content = client.files.content(output_file_id)
-            file_data_bytes = content.read()
-            output_path = os.path.join(output_folder_path, id_to_filename[input_file_id])
-            with open(output_path, "wb") as file:
-                file.write(file_data_bytes)
-            print(f"Output file saved to {output_path}")
-        elif input_file_id in id_to_filename and not output_file_id:
-            input_file_name = id_to_filename[input_file_id]
-            print(f"Batch {batch_id} has no output file - probably it is still running")
+    print(f"Chunk states: {manifest.summary()}")
 
 
+def request_index(custom_id):
+    return decode_custom_id(custom_id)[0]
 
-    print(f"Total number of batches: {counter}")
 
+def iterate_sorted_by_request(path):
+    """
+    Yield (request index, parsed line) of a batch output file in request order. Only the (index, byte offset) pairs are
+    sorted in memory, the lines are read back one at a time
+    """
+    entries = []
+    with open(path, "rb") as file:
+        offset = 0
+        for line in file:
+            if line.strip():
+                entries.append((request_index(json.loads(line)["custom_id"]), offset))
+            offset += len(line)
+    entries.sort()
+
+    with open(path, "rb") as file:
+        for index, offset in entries:
+            file.seek(offset)
+            yield index, json.loads(file.readline())
+
+
+def get_response_error(data):
+    """
+    None for a successful response, otherwise a description of what went wrong
+    """
+    if data.get("error"):
+        return data["error"]
+    response = data.get("response") or {}
+    if response.get("status_code") != 200:
+        return {"status_code": response.get("status_code"), "body": response.get("body")}
+    choices = (response.get("body") or {}).get("choices")
+    if not choices or choices[0].get("message", {}).get("content") is None:
+        return {"status_code": response.get("status_code"), "message": "no answer in the response"}
+    return None
+
+
+def build_batch_output(data, cat):
+    index, query_id, source = decode_custom_id(data["custom_id"])
+    raw_answer = data["response"]["body"]["choices"][0]["message"]["content"]
+    output_data = {
+        "request_index": index,
+        "query_id": query_id,
+        "source": source
+    }
+    if cat == "causal":
+        output_data["is_causal_raw"] = raw_answer
+        output_data["is_causal"] = process_output_CoT(raw_answer)
+    elif cat == "combined":
+        for cat2, outcome in parse_cat2_outcome(raw_answer, cat).items():
+            output_data[f"{feature_names[cat2]}_raw"] = raw_answer
+            output_data[feature_names[cat2]] = outcome
+    else:
+        output_data[f"{feature_names[cat]}_raw"] = raw_answer
+        output_data[feature_names[cat]] = parse_cat2_outcome(raw_answer, cat)
+    return output_data
+
+
+def write_retry_chunks(formatted_file, failed_custom_ids, chunk_path, first_number, tokens_per_byte,
+                       max_requests=batch_max_requests, max_bytes=batch_max_bytes):
+    """
+    Copy the requests of the failed custom ids from the formatted file into new chunk files of chunk_path, numbered from
+    first_number, so that only those are sent again. Returns the chunks to register in the manifest. Their tokens are
+    estimated from their bytes, the pipelined submission lowers its limit if the estimate is off
+    """
+    chunks = []
+    current = None
+
+    def close_chunk():
+        current["file"].close()
+        current["tokens"] = round(current["bytes"] * tokens_per_byte)
+        chunks.append({key: current[key] for key in ["name", "requests", "tokens", "bytes"]})
 
-def process_chunks(folder_path):
+    with open(formatted_file, "rb") as infile:
+        for line in infile:
+            if not line.strip() or json.loads(line)["custom_id"] not in failed_custom_ids:
+                continue
+            if current is not None and (current["requests"] + 1 > max_requests or current["bytes"] + len(line) > max_bytes):
+                close_chunk()
+                current = None
+            if current is None:
+                name = f"chunk_{first_number + len(chunks)}.jsonl"
+                current = {"name": name, "file": open(os.path.join(chunk_path, name), "wb"), "requests": 0, "bytes": 0}
+            current["file"].write(line)
+            current["requests"] += 1
+            current["bytes"] += len(line)
+    if current is not None:
+        close_chunk()
+
+    for chunk in chunks:
+        print(f"Retry chunk {chunk['name']} with {chunk['requests']} requests saved to {chunk_path}")
+    return chunks
+
+
+def process_chunks(folder_path, cat="causal", manifest=None, formatted_file=None, max_retry_rounds=2):
     """
         takes as input the folder containing the output files from the batch job in OpenAI, outputs a unique file
+        for cat2 categories (and the combined cat2 mode) the output has the same column names as run_classification
+
+        the chunk output files (and their error files) are merged in a streaming k-way merge, so the final output is
+        sorted by the request index of the custom_id. A request answered in any chunk (e.g. a retry chunk) is written
+        once, the others go to failed_requests.jsonl.
+        with a manifest, the downloaded chunks are marked as parsed and the merge is done again only when chunks were
+        downloaded since the last one. If the formatted_file is given too, the original requests of the failed ones
+        are registered as new chunks, at most max_retry_rounds times per job, for the upload, submit and download
+        stages to send again. Returns the names of these retry chunks
     
     """
-    output_files = os.listdir(folder_path)
     final_output_file = os.path.join(folder_path, "final_output.jsonl")
+    failed_output_file = os.path.join(folder_path, "failed_requests.jsonl")
+
+    if os.path.exists(final_output_file) and (manifest is None or not manifest.chunks("downloaded")):
+        print("Every downloaded chunk is already merged in the output")
+        return []
+
+    output_files = sorted(name for name in os.listdir(folder_path) if re.fullmatch(r'chunk_\d+(_errors)?\.jsonl', name))
+    streams = [iterate_sorted_by_request(os.path.join(folder_path, name)) for name in output_files]
+
+    written, failed_custom_ids = 0, set()
+    usage = UsageStats()
+    tmp_output_file = final_output_file + ".part"
+    with open(tmp_output_file, 'w') as outfile, open(failed_output_file, 'w') as failed_file:
+        # a request that failed and was sent again in a retry chunk has several lines with the same index
+        for index, attempts in itertools.groupby(heapq.merge(*streams, key=lambda item: item[0]), key=lambda item: item[0]):
+            answer, error = None, None
+            for _, data in attempts:
+                data_error = get_response_error(data)
+                if data_error is None:
+                    answer = answer or data
+                else:
+                    error = (data, data_error)
+            if answer is None:
+                data, data_error = error
+                failed_custom_ids.add(data["custom_id"])
+                json.dump({"custom_id": data["custom_id"], "error": data_error}, failed_file)
+                failed_file.write('\n')
+                continue
+            json.dump(build_batch_output(answer, cat), outfile)
+            outfile.write('\n')
+            written += 1
+            usage.add(answer["response"]["body"].get("usage"))
+    # renamed only when complete, so an existing final output is always a full one
+    os.replace(tmp_output_file, final_output_file)
+    print(f"Merged {len(output_files)} files, {written} answers, {len(failed_custom_ids)} failed requests")
+    usage.report()
+
+    retry_chunks = []
+    if manifest is not None:
+        for chunk in manifest.chunks("downloaded"):
+            manifest.update_chunk(chunk["name"], "parsed")
+
+        retry_rounds = int(manifest.stage_done("retry_rounds") or 0)
+        if failed_custom_ids and formatted_file is not None:
+            if retry_rounds < max_retry_rounds:
+                chunks = manifest.chunks()
+                tokens_per_byte = sum(chunk["tokens"] for chunk in chunks) / max(1, sum(chunk["bytes"] for chunk in chunks))
+                first_number = max(chunk_number(chunk["name"]) for chunk in chunks) + 1
+                chunk_path = os.path.join(os.path.dirname(os.path.normpath(folder_path)), "chunks")
+                retry_chunks = write_retry_chunks(formatted_file, failed_custom_ids, chunk_path, first_number, tokens_per_byte)
+                manifest.add_chunks(retry_chunks)
+                manifest.mark_stage("retry_rounds", str(retry_rounds + 1))
+            else:
+                print(f"{len(failed_custom_ids)} requests still failed after {retry_rounds} retry rounds, see {failed_output_file}")
+    print(f"Final output file saved to {final_output_file}")
+    return [chunk["name"] for chunk in retry_chunks]
 
-    if os.path.exists(final_output_file): 
-        print("Output already exists, exiting")
-        return
 
 
-    for current_file_name in output_files:
-        with open(os.path.join(folder_path, current_file_name), 'r') as infile, open(final_output_file, 'a') as outfile:
-            for line in infile:
-                data = json.loads(line)
-                custom_id = data["custom_id"]
+def run_batch_job(input_file, cat, prompt_function_name, model, output_folder=None, prompt_layout="default", dedup=False,
+                  enqueued_token_limit=None, poll_interval=30, system_prompt_flag=True):
+    """
+        Runs every stage of a batch job (formatting, chunking, upload, submission, download and merge) and returns the path
+        of joined_output.jsonl, the input rows with the batch results. Stages already done, according to the manifest
+        of the job folder, are skipped. system_prompt_flag=False sends the cat2 requests without the cat2 system prompt
+    """
 
-                # Split the string by underscores
-                split_string = custom_id.split("_")
+    # precompiled template of the prompt function, see prompt_registry.py
+    configure_prompt_layout(prompt_layout)
+    prompt_function = prompts.get(prompt_function_name).render
+    prompt_version = prompts.version(prompt_function_name)
+    if cat != "causal" and system_prompt_flag:
+        prompt_version += "+" + prompts.version("get_system_prompt_cat_2")
+
+    if output_folder is None:
+        output_folder = f"openai_batch_job_{cat}_{model}_{prompt_function_name}"
+        if prompt_layout != "default":
+            output_folder += f"_{prompt_layout}"
+        if not system_prompt_flag:
+            output_folder += "_sysprompt_False"
+    # create a folder 
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
 
-                # Extract the query ID and source
-                query_id = split_string[3]
-                source = split_string[5]
-                raw_answer = data["response"]["body"]["choices"][0]["message"]["content"]
-                processed_answer = process_output_CoT(raw_answer)
-                output_data = {
-                    "query_id": query_id,
-                    "source": source,
-                    "is_causal_raw": raw_answer,
-                    "is_causal": processed_answer
-                }
-                json.dump(output_data, outfile)
-                outfile.write('\n')
-            print(f"Processed {current_file_name}")
-    
-    print(f"Final output file saved to {final_output_file}")
+    manifest = BatchManifest(os.path.join(output_folder, "manifest.sqlite"))
+    recorded_version = manifest.stage_done("prompt")
+    if recorded_version and recorded_version != prompt_version:
+        raise ValueError(f"The job in {output_folder} was formatted with {recorded_version}, the prompts are now {prompt_version}")
+    manifest.mark_stage("prompt", prompt_version)
+    print(f"Prompt version {prompt_version}")
 
+    formatted_file = convert_to_openai_input(input_file, output_folder, cat, prompt_function, model, manifest, dedup,
+                                             system_prompt_flag)
+
+    chunk_path = chunkify(formatted_file, output_folder, 150000, model, manifest)
+
+    # shared client of utils, its pooled connections are reused by the upload and download threads
+    client = get_client()
+    received_outputs_folder = os.path.join(output_folder, "received_outputs")
+    # the failed requests come back from process_chunks as retry chunks, which go through the same stages
+    retry_chunks = True
+    while retry_chunks:
+        files_upload_to_openai(chunk_path, client, manifest)
+
+        if enqueued_token_limit:
+            send_requests_pipelined(client, manifest, enqueued_token_limit, poll_interval)
+        else:
+            send_requests_to_openai(client, manifest, poll_interval)
+        print_status(client, manifest)
+        download_results(client, received_outputs_folder, manifest)
+        retry_chunks = process_chunks(received_outputs_folder, cat, manifest, formatted_file)
+    final_output_file = os.path.join(received_outputs_folder, "final_output.jsonl")
+    joined_output_file = os.path.join(output_folder, "joined_output.jsonl")
+    # joined again when chunks were merged since the last join
+    if not os.path.exists(joined_output_file) or os.path.getmtime(joined_output_file) < os.path.getmtime(final_output_file):
+        join_batch_results(final_output_file, input_file, formatted_file, joined_output_file)
+    manifest.close()
+    return joined_output_file
 
 
 if __name__ == "__main__":
@@ -395,29 +747,14 @@ if __name__ == "__main__":
     # parse arguments for cat and prompt function
     import argparse
     parser = argparse.ArgumentParser(description='Run the cat batch API')
-    parser.add_argument('-cat', type=str, help='The cat category to be filled')
+    parser.add_argument('-cat', type=str, help='The cat category to be filled. "combined" fills subjectivity, domain and action with one request per query')
     parser.add_argument('-prompt_function', type=str, help='The prompt function to be used')
     parser.add_argument('-model', type=str, help='The model to be used')
     parser.add_argument('-input', type=str, help='The input file to be used')
+    parser.add_argument('-prompt_layout', type=str, default="default", choices=["default", "prefix_cache"], help='"prefix_cache" moves the variable fields after the static instructions, so that the provider can cache the shared prompt prefix')
+    parser.add_argument('-dedup', action='store_true', help='Send rows with the same prompt once, the answer is copied to the duplicates when joining the results')
+    parser.add_argument('-enqueued_token_limit', type=int, default=None, help='Enqueued token limit of the account. If given, batches are pipelined up to this limit instead of sent one at a time')
     args = parser.parse_args()
-    cat, prompt_function_name, model, input_file = args.cat, args.prompt_function, args.model, args.input
-
-    prompt_function = globals()[prompt_function_name]
 
-    output_folder = f"openai_batch_job_{cat}_{model}_{prompt_function_name}"
-    # create a folder 
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-
-    formatted_file = convert_to_openai_input(input_file, output_folder, cat, prompt_function, model)
-
-    chunk_path = chunkify(formatted_file, output_folder, 150000, model)
-
-    client = OpenAI()
-    filename_to_id, id_to_filename = files_upload_to_openai(chunk_path, client)
-
-    send_requests_to_openai(client, filename_to_id, chunk_path)
-    received_outputs_folder = os.path.join(output_folder, "received_outputs")
-    print_status(client, id_to_filename)
-    download_results(client, received_outputs_folder, id_to_filename)
-    process_chunks(received_outputs_folder)
\ No newline at end of file
+    run_batch_job(args.input, args.cat, args.prompt_function, args.model, prompt_layout=args.prompt_layout, dedup=args.dedup,
+                  enqueued_token_limit=args.enqueued_token_limit)
@@ -1,11 +1,15 @@
 # Script to run classification of CausalQuest using the normal OpenAI API
 
-import jsonlines
 import sys
-from utils import get_cat1_outcome, get_cat2_outcome, get_prompt_cat_1_iteration_3_CoT, get_prompt_cat_1_iteration_3, get_prompt_cat_1_iteration_4, get_prompt_cat_1_iteration_4_cot, get_prompt_cat_1_iteration_5, get_prompt_cat_1_iteration_6
+import utils
+from utils import get_cat1_outcome, get_cat2_outcome, build_row_prompt, parse_row_outcome, build_messages, get_gpt_response, prompt_version_id, configure_rate_limits, configure_response_cache, configure_prompt_layout, configure_retries, configure_backend, configure_cascade, get_prompt_cat_1_iteration_3_CoT, get_prompt_cat_1_iteration_3, get_prompt_cat_1_iteration_4, get_prompt_cat_1_iteration_4_cot, get_prompt_cat_1_iteration_5, get_prompt_cat_1_iteration_6
 import pandas as pd
+from checkpoint import CheckpointIndex
+from dedup import PromptDeduplicator
+from retry_policy import DeadLetterQueue, is_api_error
 import os
 import argparse
+import shlex
 import time
 
 feature_names = {
@@ -15,14 +19,59 @@ feature_names = {
     "causal": "is_causal"
 }
 
-cat2_names = ["subjectivity", "domain", "action"]
+cat2_names = ["subjectivity", "domain", "action", "combined"]
 
-def run(classification_type, input_path, output_path, model, prompt_function=None, system_prompt_flag=True):
+def build_output_record(row):
+    """
+    Build the output line for a row, carrying over the labels that are already present in the input
+    """
+    data = {
+        "source": row["source"],
+        "query": row["query"],
+        "summary": row["summary"],
+        "id": row["id"],
+        "is_causal": row["is_causal"] if "is_causal" in row else None,
+        "is_subjective": row["is_subjective"] if "is_subjective" in row else None,
+        "domain_class": row["domain_class"] if "domain_class" in row else None,
+        "action_class": row["action_class"] if "action_class" in row else None,
+        "is_causal_raw": row["is_causal_raw"] if "is_causal_raw" in row else None,
+        "is_subjective_raw": row["is_subjective_raw"] if "is_subjective_raw" in row else None,
+        "domain_class_raw": row["domain_class_raw"] if "domain_class_raw" in row else None,
+        "action_class_raw": row["action_class_raw"] if "action_class_raw" in row else None
+    }
+    return data
+
+
+def add_outcome(data, classification_type, outcome, raw_outcome):
+    """
+    Store the outcome in the output line. The combined cat2 mode fills the three cat2 columns from a single answer
+    """
+    if classification_type == "combined":
+        for cat, cat_outcome in outcome.items():
+            feature_key = feature_names[cat]
+            data[feature_key] = cat_outcome
+            data[f"{feature_key}_raw"] = raw_outcome
+    else:
+        feature_key = feature_names[classification_type]
+        data[feature_key] = outcome
+        data[f"{feature_key}_raw"] = raw_outcome
+
+
+def run(classification_type, input_path, output_path, model, prompt_function_name=None, system_prompt_flag=True, concurrency=1, base_url=None, dedup=False, dead_letter_path=None, rerun_command=None):
     """
     Run the classification for the given classification type
 
     Args:
-    classification_type: str, the type of classification to run. Possible values: "subjectivity", "action", "domain", "causal"
+    classification_type: str, the type of classification to run. Possible values: "subjectivity", "action", "domain", "causal",
+        or "combined" to get subjectivity, domain and action from a single request per row
+    concurrency: int, number of requests kept in flight. With concurrency > 1 the async engine is used, results are still written in input order
+    base_url: str, optional OpenAI-compatible endpoint for the async engine (e.g. the local stub_server.py)
+    dedup: bool, send rows whose rendered prompt is the same (up to case and whitespace) once, and copy the answer to the others
+    dead_letter_path: str, JSONL where the rows whose request failed after all the retries are written (default <output>.dead.jsonl).
+        They are not recorded in the checkpoint, so running again retries them
+    rerun_command: str, command printed with the dead-letter report to run again (the command line of the script)
+    With a cascade configured (utils.configure_cascade), the causal rows the cheap predictors are confident about are
+    answered first and only the others go to the backend
 
     Returns:
     None
@@ -38,26 +87,15 @@ def run(classification_type, input_path, output_path, model, prompt_function=Non
         return
     
 
-    if os.path.exists(output_path):
-        with jsonlines.open(output_path, mode='r') as reader:
-            # get the number of lines
-            lines = list(reader)
-            if len(lines) == 0:
-                print("The file is empty. Proceeding")
-            else:
-                # take the query of the last processed line
-                last_query = lines[-1]['query']
-                print(f"Number of existing lines: {len(lines)}")
-
-                # check that the last line of db is the previous instance of the last line
-                if db.iloc[len(lines)-1]['query'] != last_query:
-                    print("The last line of the json file is not the same as the last line of the dataframe. Exiting")
-                    return
-                else:
-                    print("The last line of the json file is the same as the last line of the dataframe. Proceeding")
-
-                db = db.iloc[len(lines):].copy()
-
+    # resume from the checkpoint index kept next to the output file
+    checkpoint = CheckpointIndex(output_path)
+    done = checkpoint.load()
+    if len(done) > 0:
+        print(f"Number of already processed rows: {len(done)}")
+        db = db[~db["id"].astype(str).isin(done)]
+        if len(db) == 0:
+            print(f"Every row is already processed in {output_path}")
+            return
 
     if classification_type not in cat2_names:
         cat1 = True
@@ -65,49 +103,170 @@ def run(classification_type, input_path, output_path, model, prompt_function=Non
         cat1 = False
 
     print(f"To be processes: {len(db)} rows")
+    dead_letter = DeadLetterQueue(dead_letter_path or output_path + ".dead.jsonl")
+
+    with checkpoint:
+        if not cat1:
+            # non-causal rows are not classified further, but they are recorded so that resume skips them too
+            non_causal = db["is_causal"] == False
+            for row_id in db.loc[non_causal, "id"]:
+                checkpoint.skip(row_id)
+            db = db[~non_causal]
+
+        if classification_type == "causal" and utils.cascade is not None:
+            db = run_cascade(db, checkpoint, utils.cascade)
+
+        backend = utils.get_backend()
+        if backend.batch_size > 1:
+            run_batched(db, classification_type, checkpoint, model, prompt_function_name, system_prompt_flag, backend, dead_letter)
+            report_dead_letter(dead_letter, rerun_command)
+            print("Done")
+            return
+
+        if concurrency > 1 and backend.name != "openai":
+            print(f"The async engine only runs with the openai backend, running the {backend.name} backend sequentially")
+            concurrency = 1
+
+        if concurrency > 1:
+            run_concurrent(db, classification_type, checkpoint, model, prompt_function_name, system_prompt_flag, concurrency, base_url, dedup, dead_letter)
+            report_dead_letter(dead_letter, rerun_command)
+            print("Done")
+            return
+
+        deduplicator = PromptDeduplicator() if dedup else None
+        prompt_version = prompt_version_id(prompt_function_name, classification_type, system_prompt_flag)
 
-    # Open the JSON file in append mode
-    with jsonlines.open(output_path, mode='a') as writer:
         # Generate JSON lines on the fly and append them to the file
         for i, row in db.iterrows():
-            data = {
-                "source": row["source"],
-                "query": row["query"],
-                "summary": row["summary"],
-                "id": row["id"],
-                "is_causal": row["is_causal"] if "is_causal" in row else None,
-                "is_subjective": row["is_subjective"] if "is_subjective" in row else None,
-                "domain_class": row["domain_class"] if "domain_class" in row else None,
-                "action_class": row["action_class"] if "action_class" in row else None,
-                "is_causal_raw": row["is_causal_raw"] if "is_causal_raw" in row else None,
-                "is_subjective_raw": row["is_subjective_raw"] if "is_subjective_raw" in row else None,
-                "domain_class_raw": row["domain_class_raw"] if "domain_class_raw" in row else None,
-                "action_class_raw": row["action_class_raw"] if "action_class_raw" in row else None
-            }
-
-            if cat1: 
-                outcome, raw_outcome = get_cat1_outcome(row, model, prompt_function_name)
-            else:
-                if row["is_causal"] == False:
-                    continue
-                outcome, raw_outcome = get_cat2_outcome(row, model, prompt_function_name, classification_type, system_prompt_flag)
-
-            feature_key = feature_names[classification_type]
-            data[feature_key] = outcome
-            data[f"{feature_key}_raw"] = raw_outcome
+            data = build_output_record(row)
+
+            try:
+                if deduplicator is not None:
+                    prompt, system_prompt = build_row_prompt(row, prompt_function_name, classification_type, system_prompt_flag)
+                    key, raw_outcome = deduplicator.lookup(build_messages(prompt, system_prompt))
+                    if raw_outcome is None:
+                        raw_outcome = get_gpt_response(prompt, model, system_prompt, prompt_version)
+                        deduplicator.store(key, raw_outcome)
+                    outcome = parse_row_outcome(raw_outcome, classification_type)
+                elif cat1: 
+                    outcome, raw_outcome = get_cat1_outcome(row, model, prompt_function_name)
+                else:
+                    outcome, raw_outcome = get_cat2_outcome(row, model, prompt_function_name, classification_type, system_prompt_flag)
+            except Exception as e:
+                # the retries are exhausted (or the error is not transient): keep going with the next rows
+                if not is_api_error(e):
+                    raise
+                dead_letter.write(row["id"], classification_type, e)
+                continue
+
+            add_outcome(data, classification_type, outcome, raw_outcome)
 
             # Write the data as a JSON line to the file
-            writer.write(data)
+            checkpoint.write(row["id"], data)
             print(f"Processed {i+1} rows")
 
+        if deduplicator is not None:
+            deduplicator.report()
+
+    report_dead_letter(dead_letter, rerun_command)
     print("Done")
 
+
+def run_batched(db, classification_type, checkpoint, model, prompt_function_name, system_prompt_flag, backend, dead_letter):
+    """
+    Run the classification handing the rows to the backend in groups of backend.batch_size (local classifier, Batch API)
+    """
+    rows = [row for _, row in db.iterrows()]
+    processed = 0
+    for start in range(0, len(rows), backend.batch_size):
+        group = rows[start:start + backend.batch_size]
+        try:
+            results = backend.classify_rows(group, model, prompt_function_name, classification_type, system_prompt_flag)
+        except Exception as e:
+            if not is_api_error(e):
+                raise
+            results = [e] * len(group)
+
+        for row, result in zip(group, results):
+            if isinstance(result, Exception):
+                dead_letter.write(row["id"], classification_type, result)
+                continue
+            outcome, raw_outcome = result
+            data = build_output_record(row)
+            add_outcome(data, classification_type, outcome, raw_outcome)
+            checkpoint.write(row["id"], data)
+            processed += 1
+        print(f"Processed {processed} rows")
+
+
+def run_cascade(db, checkpoint, cascade):
+    """
+    Writes the rows the cascade answers and returns the rows left for the backend
+    """
+    rows = [row for _, row in db.iterrows()]
+    decisions = cascade.decide_rows(rows)
+    for row, decision in zip(rows, decisions):
+        if decision is None:
+            continue
+        outcome, raw_outcome = decision
+        data = build_output_record(row)
+        add_outcome(data, "causal", outcome, raw_outcome)
+        checkpoint.write(row["id"], data)
+    cascade.report()
+    return db[[decision is None for decision in decisions]]
+
+
+def report_dead_letter(dead_letter, rerun_command=None):
+    if dead_letter.count:
+        # the failed rows are not in the checkpoint index, so the same command resumes with them
+        retry = f": {rerun_command}" if rerun_command else ""
+        print(f"{dead_letter.count} rows failed and were written to {dead_letter.path}, run again to retry them{retry}")
+
+def run_concurrent(db, classification_type, checkpoint, model, prompt_function_name, system_prompt_flag, concurrency, base_url=None, dedup=False,
+                   dead_letter=None):
+    """
+    Run the classification with the async engine, keeping concurrency requests in flight
+    """
+    import asyncio
+    from async_classification import classify_rows_async
+
+    def on_result(i, row, outcome, raw_outcome):
+        data = build_output_record(row)
+        add_outcome(data, classification_type, outcome, raw_outcome)
+        checkpoint.write(row["id"], data)
+        print(f"Processed {i+1} rows")
+
+    def on_error(i, row, error):
+        dead_letter.write(row["id"], classification_type, error)
+
+    asyncio.run(classify_rows_async(db.iterrows(), model, prompt_function_name, classification_type, system_prompt_flag,
+                                    on_result, concurrency=concurrency, base_url=base_url, dedup=dedup,
+                                    on_error=on_error if dead_letter is not None else None))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run classification on a dataset')
     parser.add_argument('input_path', type=str, help='Path to the input dataset')
-    parser.add_argument('classification_type', type=str, help='Type of classification to run. Possible values: "subjectivity", "action", "domain", "causal"')
-    parser.add_argument('model', type=str, help='OpenAI model to use. Model used: "gpt-4-turbo-2024-04-09", "gpt-3.5-turbo"')
+    parser.add_argument('classification_type', type=str, help='Type of classification to run. Possible values: "subjectivity", "action", "domain", "causal", "combined"')
+    parser.add_argument('model', type=str, help='OpenAI model to use. Model used: "gpt-4-turbo-2024-04-09", "gpt-3.5-turbo". With --backend hf, the path of the fine-tuned checkpoint or LoRA adapter')
     parser.add_argument('prompt_function', type=str, help='Name of the prompt function to use among the ones in utils.py')
+    parser.add_argument('--backend', type=str, default="openai", choices=["openai", "openai_batch", "hf", "fake"], help='Inference backend: OpenAI chat API, OpenAI Batch API, local Hugging Face classifier or deterministic fake')
+    parser.add_argument('--batch_work_dir', type=str, default=None, help='Job folders of the openai_batch backend, <output>_batch_jobs by default. Running again with the same folder resumes the jobs from their manifests')
+    parser.add_argument('--batch_size', type=int, default=None, help='Rows per call of the hf backend (default 32) or per job of the openai_batch backend (default 50000)')
+    parser.add_argument('--base_model', type=str, default=None, help='Base model of a LoRA adapter for the hf backend, read from the adapter config if not given')
+    parser.add_argument('--device', type=str, default="cpu", help='Device of the hf backend')
+    parser.add_argument('--concurrency', type=int, default=1, help='Number of requests kept in flight. Values > 1 use the async engine')
+    parser.add_argument('--base_url', type=str, default=None, help='OpenAI-compatible endpoint for the async engine, e.g. the local stub_server.py')
+    parser.add_argument('--rpm', type=int, default=None, help='Requests/minute limit of the account. Enables the rate limit scheduler together with --tpm')
+    parser.add_argument('--tpm', type=int, default=None, help='Tokens/minute limit of the account. Enables the rate limit scheduler together with --rpm')
+    parser.add_argument('--cache_path', type=str, default=None, help='Path of the on-disk response cache (SQLite). Disabled if not given')
+    parser.add_argument('--cache_max_mb', type=int, default=1024, help='Size bound of the response cache in MB, LRU entries are evicted above it')
+    parser.add_argument('--prompt_layout', type=str, default="default", choices=["default", "prefix_cache"], help='"prefix_cache" moves the variable fields after the static instructions, so that the provider can cache the shared prompt prefix')
+    parser.add_argument('--max_retries', type=int, default=None, help='Retry budget of each transient error class (rate limit, server error, timeout, connection)')
+    parser.add_argument('--dead_letter_path', type=str, default=None, help='JSONL of the rows that failed after all the retries, <output>.dead.jsonl by default')
+    parser.add_argument('--dedup', action='store_true', help='Send rows with the same rendered prompt once and copy the answer to the duplicates')
+    parser.add_argument('--cascade', type=str, default=None, help='Thresholds calibrated by cascade.py: causal rows the linguistic baseline (or a local model) is confident about skip the LLM')
+    parser.add_argument('--replay', action='store_true', help='Read-only cache mode for offline runs: requests missing from the cache raise an error')
     args = parser.parse_args()
     
     input_path, model, classification_type, prompt_function_name = args.input_path, args.model, args.classification_type, args.prompt_function
@@ -117,13 +276,41 @@ if __name__ == "__main__":
 
 
     print(f"Running classification type {classification_type}, normal API, prompt function {prompt_function_name}, model {model}\n")
-    output_path = f"{output_folder_path}/{file_name}_{classification_type}_{prompt_function_name}_{model}_sysprompt_{system_prompt_flag}.jsonl"
+    layout_suffix = "" if args.prompt_layout == "default" else f"_{args.prompt_layout}"
+    cascade_suffix = "_cascade" if args.cascade and classification_type == "causal" else ""
+    # with --backend hf the model is a checkpoint path, only its folder name goes in the file name
+    model_name = os.path.basename(os.path.normpath(model)) if args.backend == "hf" else model
+    output_path = f"{output_folder_path}/{file_name}_{classification_type}_{prompt_function_name}_{model_name}_sysprompt_{system_prompt_flag}{layout_suffix}{cascade_suffix}.jsonl"
+    configure_prompt_layout(args.prompt_layout)
+    backend_options = {}
+    if args.batch_size:
+        backend_options["batch_size"] = args.batch_size
+    if args.backend == "hf":
+        backend_options.update(model_path=model, base_model=args.base_model, device=args.device)
+    if args.backend == "openai_batch":
+        backend_options["work_dir"] = args.batch_work_dir or os.path.splitext(output_path)[0] + "_batch_jobs"
+    configure_backend(args.backend, **backend_options)
+    if cascade_suffix:
+        configure_cascade(args.cascade)
+        print(f"Cascade thresholds: {args.cascade}\n")
+    if args.max_retries is not None:
+        configure_retries({kind: args.max_retries for kind in ["rate_limit", "server", "timeout", "connection"]})
     print(f"Output file {output_path}\n")
 
-    # if output path exists, stop
-    if os.path.exists(output_path):
-        print("Output file already exists. Exiting")
-        sys.exit(1)
-    
-    run(classification_type, input_path, output_path, model, system_prompt_flag=system_prompt_flag)
+    if args.rpm and args.tpm:
+        configure_rate_limits(args.rpm, args.tpm, model)
+        print(f"Rate limits: {args.rpm} requests/minute, {args.tpm} tokens/minute\n")
+
+    if args.cache_path:
+        configure_response_cache(args.cache_path, args.cache_max_mb * 1024 ** 2, replay=args.replay)
+        print(f"Response cache: {args.cache_path}, replay mode {args.replay}\n")
+
+    # an existing output is resumed from its checkpoint index, see run
+    run(classification_type, input_path, output_path, model, prompt_function_name, system_prompt_flag=system_prompt_flag,
+        concurrency=args.concurrency, base_url=args.base_url, dedup=args.dedup,
+        dead_letter_path=args.dead_letter_path, rerun_command=shlex.join(["python"] + sys.argv))
+
+    utils.usage_stats.report()
+    if args.cache_path:
+        print(f"Response cache stats: {utils.response_cache.stats()}")
     
@@ -0,0 +1,372 @@
+# Local stub of the OpenAI chat completions endpoint and of the Batch API (files and batches), used to exercise the
+# classification and batch scripts without the real API.
+# Usage: python stub_server.py --port 8000 --latency 0.5 [--rpm 500] [--batch_seconds 5] [--enqueued_token_limit 90000] [--prompt_cache_min 1024]
+#        [--fault_rate 0.1] [--fault_statuses 500,503,0] [--outage 100,50]
+# then point the client to it, e.g. OPENAI_BASE_URL=http://127.0.0.1:8000/v1 OPENAI_API_KEY=stub
+
+import argparse
+import collections
+import json
+import random
+import socket
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+STUB_ANSWER = "Reasoning: stub answer\nCategory: Causal"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    Answers every chat completion with STUB_ANSWER after sleeping for the configured latency.
+    If the server has a requests/minute limit, it sends the x-ratelimit-* headers and answers 429 above the limit.
+    Batches go from validating to in_progress to completed according to the elapsed time, and fail with
+    token_limit_exceeded if they would exceed the enqueued token limit.
+    The usage reports as cached_tokens the longest prefix of the prompt, in blocks of 128 words from prompt_cache_min
+    (1024) on, already seen in an earlier request, like the provider-side prompt cache (words stand in for tokens)
+    Faults are injected in the chat completions: a fault_rate share of the requests, picked at random, get one of the
+    fault_statuses (0 drops the connection without an answer), and every request numbered in outage = (first, count)
+    gets a 503 with a Retry-After header, to simulate an outage of the API.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self):
+        self.send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        path = self.path.split("?")[0].rstrip("/")
+        if path.endswith("/chat/completions"):
+            self.handle_chat_completion()
+        elif path.endswith("/files"):
+            self.handle_file_upload()
+        elif path.endswith("/batches"):
+            self.handle_batch_create()
+        else:
+            self.send_not_found()
+
+    def do_GET(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        server = self.server
+        with server.lock:
+            if parts[-1] == "files":
+                self.send_json(200, {"object": "list", "data": list(server.files.values()), "has_more": False})
+            elif parts[-2] == "files" and parts[-1] in server.files:
+                self.send_json(200, server.files[parts[-1]])
+            elif parts[-1] == "content" and parts[-2] in server.file_contents:
+                self.send_bytes(200, server.file_contents[parts[-2]])
+            elif parts[-1] == "batches":
+                batches = [self.refresh_batch(server, batch) for batch in server.batches.values()]
+                self.send_json(200, {"object": "list", "data": batches[::-1], "has_more": False})
+            elif parts[-2] == "batches" and parts[-1] in server.batches:
+                self.send_json(200, self.refresh_batch(server, server.batches[parts[-1]]))
+            else:
+                self.send_not_found()
+
+    def do_DELETE(self):
+        parts = self.path.split("?")[0].rstrip("/").split("/")
+        server = self.server
+        with server.lock:
+            if parts[-2] == "files" and parts[-1] in server.files:
+                del server.files[parts[-1]]
+                server.file_contents.pop(parts[-1], None)
+                self.send_json(200, {"id": parts[-1], "object": "file", "deleted": True})
+            else:
+                self.send_not_found()
+
+    def send_bytes(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_file_upload(self):
+        """
+        multipart/form-data upload with a "file" and a "purpose" field
+        """
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8")
+        message = BytesParser(policy=default_policy).parsebytes(header + body)
+        fields = {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+
+        filename, content = fields["file"]
+        purpose = fields.get("purpose", (None, b"batch"))[1].decode("utf-8")
+        server = self.server
+        with server.lock:
+            file_object = self.add_file(server, filename, content, purpose)
+        self.send_json(200, file_object)
+
+    def add_file(self, server, filename, content, purpose):
+        """
+        Must be called holding server.lock
+        """
+        server.object_count += 1
+        file_id = f"file-stub-{server.object_count}"
+        file_object = {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed"
+        }
+        server.files[file_id] = file_object
+        server.file_contents[file_id] = content
+        return file_object
+
+    def handle_batch_create(self):
+        request = self.read_json_body()
+        server = self.server
+        with server.lock:
+            input_file_id = request["input_file_id"]
+            if input_file_id not in server.file_contents:
+                self.send_json(404, {"error": {"message": f"No such File object: {input_file_id}", "type": "invalid_request_error"}})
+                return
+            server.object_count += 1
+            lines = [line for line in server.file_contents[input_file_id].splitlines() if line.strip()]
+            batch = {
+                "id": f"batch_stub_{server.object_count}",
+                "object": "batch",
+                "endpoint": request["endpoint"],
+                "input_file_id": input_file_id,
+                "completion_window": request["completion_window"],
+                "status": "validating",
+                "created_at": int(time.time()),
+                "output_file_id": None,
+                "error_file_id": None,
+                "errors": None,
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+                "metadata": request.get("metadata")
+            }
+            # enqueued tokens are approximated with the number of words of the messages
+            batch["_tokens"] = sum(len(message["content"].split())
+                                   for line in lines for message in json.loads(line)["body"]["messages"])
+            batch["_started"] = time.monotonic()
+            server.batches[batch["id"]] = batch
+            self.send_json(200, self.public_batch(batch))
+
+    def refresh_batch(self, server, batch):
+        """
+        Move the batch along validating -> in_progress -> completed according to the elapsed time.
+        Must be called holding server.lock
+        """
+        elapsed = time.monotonic() - batch["_started"]
+        if batch["status"] == "validating" and elapsed >= server.validate_seconds:
+            enqueued = sum(other["_tokens"] for other in server.batches.values()
+                           if other["status"] in ("in_progress", "finalizing"))
+            if server.enqueued_token_limit and enqueued + batch["_tokens"] > server.enqueued_token_limit:
+                batch["status"] = "failed"
+                batch["errors"] = {"object": "list", "data": [{
+                    "code": "token_limit_exceeded",
+                    "message": f"Enqueued token limit reached. Limit: {server.enqueued_token_limit} enqueued tokens."
+                }]}
+            else:
+                batch["status"] = "in_progress"
+        if batch["status"] == "in_progress" and elapsed >= server.validate_seconds + server.batch_seconds:
+            self.complete_batch(server, batch)
+        return self.public_batch(batch)
+
+    def complete_batch(self, server, batch):
+        output = []
+        for line in server.file_contents[batch["input_file_id"]].splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            output.append(json.dumps({
+                "id": f"batch_req_{request['custom_id']}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "request_id": request["custom_id"],
+                    "body": self.chat_completion_body(server, request["body"], request["custom_id"])
+                },
+                "error": None
+            }))
+        output_file = self.add_file(server, f"{batch['id']}_output.jsonl", ("\n".join(output) + "\n").encode("utf-8"), "batch_output")
+        batch["output_file_id"] = output_file["id"]
+        batch["status"] = "completed"
+        batch["request_counts"]["completed"] = batch["request_counts"]["total"]
+
+    def public_batch(self, batch):
+        return {key: value for key, value in batch.items() if not key.startswith("_")}
+
+    def cached_prefix_tokens(self, server, words):
+        cached = 0
+        with server.lock:
+            for end in range(server.prompt_cache_min, len(words) + 1, 128):
+                prefix = hash(tuple(words[:end]))
+                if prefix in server.prefixes:
+                    cached = end
+                server.prefixes.add(prefix)
+        return cached
+
+    def chat_completion_body(self, server, request, n):
+        # the whole conversation counts for the prompt cache, the system prompt comes first
+        words = " ".join(message["content"] for message in request["messages"]).split()
+        return {
+            "id": f"chatcmpl-stub-{n}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": server.answer},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": len(words),
+                "prompt_tokens_details": {"cached_tokens": self.cached_prefix_tokens(server, words)},
+                "completion_tokens": len(server.answer.split()),
+                "total_tokens": len(words) + len(server.answer.split())
+            }
+        }
+
+    def handle_chat_completion(self):
+        request = self.read_json_body()
+        server = self.server
+
+        with server.lock:
+            server.request_count += 1
+            n = server.request_count
+            headers = self.rate_limit_headers(server)
+        if headers is not None and int(headers["x-ratelimit-remaining-requests"]) < 0:
+            headers["x-ratelimit-remaining-requests"] = "0"
+            self.send_json(429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}, headers)
+            return
+
+        status = self.injected_fault(server, n)
+        if status == 0:
+            # dropped connection, the client sees a connection error
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if status is not None:
+            fault_headers = dict(headers or {})
+            if status == 503:
+                fault_headers["retry-after"] = "1"
+            self.send_json(status, {"error": {"message": "Injected fault", "type": "server_error", "code": None}}, fault_headers)
+            return
+
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        self.send_json(200, self.chat_completion_body(server, request, n), headers)
+
+    def injected_fault(self, server, n):
+        """
+        Status of the fault injected in the n-th request, None to answer normally
+        """
+        if server.outage is not None and server.outage[0] <= n < server.outage[0] + server.outage[1]:
+            return 503
+        if server.fault_rate and random.random() < server.fault_rate:
+            return random.choice(server.fault_statuses)
+        return None
+
+    def rate_limit_headers(self, server):
+        """
+        Sliding window of the last 60 seconds of requests. Must be called holding server.lock
+        """
+        if not server.rpm:
+            return None
+        now = time.monotonic()
+        window = server.request_times
+        while window and now - window[0] > 60:
+            window.popleft()
+        remaining = server.rpm - len(window) - 1
+        if remaining >= 0:
+            window.append(now)
+        reset = 60 - (now - window[0]) if window else 0
+        return {
+            "x-ratelimit-limit-requests": str(server.rpm),
+            "x-ratelimit-remaining-requests": str(remaining),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s"
+        }
+
+
+def make_stub_server(port=0, latency=0.5, jitter=0.0, answer=STUB_ANSWER, rpm=None, validate_seconds=1.0, batch_seconds=5.0,
+                     enqueued_token_limit=None, prompt_cache_min=1024, fault_rate=0.0, fault_statuses=(500, 503), outage=None):
+    """
+    Create (without starting) a stub server. port=0 picks a free port, available as server.server_address[1]
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.answer = answer
+    server.lock = threading.RLock()  # reentrant: completing a batch computes the usage of its requests under the lock
+    server.request_count = 0
+    server.rpm = rpm
+    server.request_times = collections.deque()
+    # hashes of the prompt prefixes seen so far, for the cached_tokens of the usage
+    server.prefixes = set()
+    server.prompt_cache_min = prompt_cache_min
+    # fault injection
+    server.fault_rate = fault_rate
+    server.fault_statuses = list(fault_statuses)
+    server.outage = outage
+    # Batch API
+    server.files = {}
+    server.file_contents = {}
+    server.batches = {}
+    server.object_count = 0
+    server.validate_seconds = validate_seconds
+    server.batch_seconds = batch_seconds
+    server.enqueued_token_limit = enqueued_token_limit
+    return server
+
+
+def start_stub_server_in_thread(**kwargs):
+    """
+    Start a stub server in a background thread. Returns the server and its base url
+    """
+    server = make_stub_server(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    return server, base_url
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a local stub of the OpenAI API')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--latency', type=float, default=0.5, help='Seconds to wait before answering each request')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Extra random latency, uniform in [0, jitter] seconds')
+    parser.add_argument('--rpm', type=int, default=None, help='Simulated requests/minute limit, answered with 429 when exceeded')
+    parser.add_argument('--batch_seconds', type=float, default=5.0, help='Seconds a batch stays in_progress before completing')
+    parser.add_argument('--enqueued_token_limit', type=int, default=None, help='Simulated enqueued token limit, batches above it fail with token_limit_exceeded')
+    parser.add_argument('--prompt_cache_min', type=int, default=1024, help='Shortest prompt prefix (in words) reported as cached_tokens')
+    parser.add_argument('--fault_rate', type=float, default=0.0, help='Share of the chat completions answered with an injected fault')
+    parser.add_argument('--fault_statuses', type=str, default="500,503", help='Comma-separated statuses of the injected faults, 0 drops the connection')
+    parser.add_argument('--outage', type=str, default=None, help='"first,count": the requests with these numbers all get a 503')
+    args = parser.parse_args()
+    outage = tuple(int(value) for value in args.outage.split(",")) if args.outage else None
+
+    server = make_stub_server(args.port, args.latency, args.jitter, rpm=args.rpm, batch_seconds=args.batch_seconds,
+                              enqueued_token_limit=args.enqueued_token_limit, prompt_cache_min=args.prompt_cache_min,
+                              fault_rate=args.fault_rate, fault_statuses=[int(status) for status in args.fault_statuses.split(",")],
+                              outage=outage)
+    print(f"Stub server listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    server.serve_forever()
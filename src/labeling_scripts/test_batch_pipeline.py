@@ -0,0 +1,173 @@
+# Pipelined submission of the Batch API chunks against stub_server.py with a simulated enqueued token limit, and the
+# merge of the chunk outputs with the retry of the failed requests.
+# Usage: python -m pytest test_batch_pipeline.py
+
+import json
+import os
+
+import pytest
+from openai import OpenAI
+
+from batch_ids import encode_custom_id, join_batch_results, read_row_index, row_index_path
+from batch_manifest import BatchManifest
+from run_batchAPI import download_results, files_upload_to_openai, process_chunks, send_requests_pipelined
+from stub_server import start_stub_server_in_thread
+
+
+@pytest.fixture
+def stub():
+    server, base_url = start_stub_server_in_thread(latency=0.0, validate_seconds=0.05, batch_seconds=0.2)
+    yield server, OpenAI(base_url=base_url, api_key="stub", max_retries=0)
+    server.shutdown()
+    server.server_close()
+
+
+def write_chunks(folder, words_per_chunk):
+    """
+    One request per chunk, whose prompt has the given number of words (the enqueued tokens of the stub)
+    """
+    chunk_path = os.path.join(folder, "chunks")
+    os.makedirs(chunk_path)
+    manifest = BatchManifest(os.path.join(folder, "manifest.sqlite"))
+    chunks = []
+    for number, words in enumerate(words_per_chunk):
+        name = f"chunk_{number}.jsonl"
+        line = json.dumps({"custom_id": f"{number}", "method": "POST", "url": "/v1/chat/completions",
+                           "body": {"model": "gpt-4o-mini", "messages": [{"role": "user", "content": " ".join(["word"] * words)}]}})
+        with open(os.path.join(chunk_path, name), "w") as file:
+            file.write(line + "\n")
+        chunks.append({"name": name, "requests": 1, "tokens": words, "bytes": len(line) + 1})
+    manifest.add_chunks(chunks)
+    return chunk_path, manifest
+
+
+def test_lone_chunk_above_limit_fails(stub, tmp_path):
+    server, client = stub
+    server.enqueued_token_limit = 5
+    chunk_path, manifest = write_chunks(str(tmp_path), [10])
+    files_upload_to_openai(chunk_path, client, manifest)
+
+    send_requests_pipelined(client, manifest, enqueued_token_limit=100, poll_interval=0.05)
+
+    assert manifest.summary() == {"failed": 1}
+    assert json.loads(manifest.chunk("chunk_0.jsonl")["errors"]) == ["token_limit_exceeded"]
+    # not resubmitted: it was the only batch in flight
+    assert len(server.batches) == 1
+
+
+def test_rejected_chunk_requeued_under_accepted_tokens(stub, tmp_path, capsys):
+    server, client = stub
+    server.enqueued_token_limit = 10
+    chunk_path, manifest = write_chunks(str(tmp_path), [6, 6])
+    files_upload_to_openai(chunk_path, client, manifest)
+
+    send_requests_pipelined(client, manifest, enqueued_token_limit=100, poll_interval=0.05)
+
+    assert manifest.summary() == {"completed": 2}
+    # chunk_1 is rejected once, then sent again alone once chunk_0 is done
+    assert len(server.batches) == 3
+    # the limit is lowered to the tokens of chunk_0, without those of the rejected chunk
+    assert "queueing it again (limit now 6)" in capsys.readouterr().out
+
+
+def test_chunk_rejected_too_often_fails(stub, tmp_path):
+    server, client = stub
+    server.enqueued_token_limit = 10
+    chunk_path, manifest = write_chunks(str(tmp_path), [6, 6])
+    files_upload_to_openai(chunk_path, client, manifest)
+
+    # no retry allowed: chunk_1 stays failed after its first rejection
+    send_requests_pipelined(client, manifest, enqueued_token_limit=100, poll_interval=0.05, max_limit_retries=0)
+
+    assert manifest.chunk("chunk_0.jsonl")["state"] == "completed"
+    assert manifest.chunk("chunk_1.jsonl")["state"] == "failed"
+    assert len(server.batches) == 2
+
+
+def batch_line(custom_id, content=None, status_code=200):
+    body = {"choices": [{"message": {"role": "assistant", "content": content}}]} if status_code == 200 else {"error": "server"}
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": status_code, "body": body}, "error": None}) + "\n"
+
+
+def test_failed_requests_sent_again_as_retry_chunk(tmp_path):
+    folder = str(tmp_path)
+    chunk_path, manifest = write_chunks(folder, [3, 3])
+    formatted_file = os.path.join(folder, "openai_batch_job_causal.jsonl")
+    custom_ids = [encode_custom_id(index, f"q{index}", "quora") for index in range(2)]
+    with open(formatted_file, "w") as file:
+        for custom_id in custom_ids:
+            file.write(json.dumps({"custom_id": custom_id, "body": {"messages": []}}) + "\n")
+    received = os.path.join(folder, "received_outputs")
+    os.makedirs(received)
+    with open(os.path.join(received, "chunk_0.jsonl"), "w") as file:
+        file.write(batch_line(custom_ids[0], "Category: Causal"))
+    with open(os.path.join(received, "chunk_1.jsonl"), "w") as file:
+        file.write(batch_line(custom_ids[1], status_code=500))
+    manifest.update_chunk("chunk_0.jsonl", "downloaded")
+    manifest.update_chunk("chunk_1.jsonl", "downloaded")
+
+    # the failed request becomes chunk_2, queued for upload
+    assert process_chunks(received, "causal", manifest, formatted_file) == ["chunk_2.jsonl"]
+    assert manifest.chunk("chunk_2.jsonl")["state"] == "formatted"
+    with open(os.path.join(chunk_path, "chunk_2.jsonl")) as file:
+        assert [json.loads(line)["custom_id"] for line in file] == [custom_ids[1]]
+
+    # nothing downloaded since the merge
+    assert process_chunks(received, "causal", manifest, formatted_file) == []
+
+    # the retry is answered: merged with the first answer, the failure is gone
+    with open(os.path.join(received, "chunk_2.jsonl"), "w") as file:
+        file.write(batch_line(custom_ids[1], "Category: Not causal"))
+    manifest.update_chunk("chunk_2.jsonl", "downloaded")
+    assert process_chunks(received, "causal", manifest, formatted_file) == []
+    with open(os.path.join(received, "final_output.jsonl")) as file:
+        assert [json.loads(line)["query_id"] for line in file] == ["q0", "q1"]
+    assert os.path.getsize(os.path.join(received, "failed_requests.jsonl")) == 0
+    assert manifest.summary() == {"parsed": 3}
+
+
+def test_join_rebuilds_missing_row_index(tmp_path):
+    input_file = str(tmp_path / "input.jsonl")
+    rows = [{"id": 1, "source": "quora", "query": "Why?"}, {"id": 2, "source": "nq", "query": "How?"},
+            {"id": 1, "source": "nq", "query": "What?"}]
+    with open(input_file, "w") as file:
+        for row in rows:
+            file.write(json.dumps(row) + "\n")
+    formatted_file = str(tmp_path / "openai_batch_job_causal.jsonl")
+    # the second row was not sent
+    with open(formatted_file, "w") as file:
+        for index, row in enumerate([rows[0], rows[2]]):
+            file.write(json.dumps({"custom_id": encode_custom_id(index, row["id"], row["source"])}) + "\n")
+    final_output_file = str(tmp_path / "final_output.jsonl")
+    with open(final_output_file, "w") as file:
+        for index, answer in enumerate(["True", "False"]):
+            file.write(json.dumps({"request_index": index, "query_id": "1", "source": "", "is_causal": answer}) + "\n")
+    joined_output_file = str(tmp_path / "joined_output.jsonl")
+
+    assert not os.path.exists(row_index_path(formatted_file))
+    assert join_batch_results(final_output_file, input_file, formatted_file, joined_output_file) == 2
+    with open(joined_output_file) as file:
+        joined = [json.loads(line) for line in file]
+    assert [(row["query"], row["is_causal"]) for row in joined] == [("Why?", "True"), ("What?", "False")]
+    assert list(read_row_index(formatted_file)) == [0, len(json.dumps(rows[0])) + len(json.dumps(rows[1])) + 2]
+
+
+def test_download_batch_without_output_file(stub, tmp_path):
+    server, client = stub
+    folder = str(tmp_path)
+    _, manifest = write_chunks(folder, [3])
+    custom_id = encode_custom_id(0, "q0", "quora")
+    with open(os.path.join(folder, "errors.jsonl"), "w") as file:
+        file.write(batch_line(custom_id, status_code=500))
+    with open(os.path.join(folder, "errors.jsonl"), "rb") as file:
+        error_file = client.files.create(file=file, purpose="batch")
+    # every request of the batch failed: there is an error file and no output file
+    manifest.update_chunk("chunk_0.jsonl", "completed", output_file_id=None, error_file_id=error_file.id)
+    received = os.path.join(folder, "received_outputs")
+
+    download_results(client, received, manifest)
+
+    assert manifest.chunk("chunk_0.jsonl")["state"] == "downloaded"
+    assert sorted(os.listdir(received)) == ["chunk_0_errors.jsonl"]
+    with open(os.path.join(received, "chunk_0_errors.jsonl")) as file:
+        assert json.loads(file.readline())["custom_id"] == custom_id
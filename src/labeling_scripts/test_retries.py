@@ -0,0 +1,120 @@
+# Retries, circuit breaker and dead-letter file against stub_server.py with injected faults.
+# Usage: python -m pytest test_retries.py
+
+import json
+import os
+import time
+
+import pytest
+from openai import OpenAI, RateLimitError, InternalServerError
+
+import utils
+from stub_server import STUB_ANSWER, start_stub_server_in_thread
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """
+    Starts a stub server and points the shared client at it. The test sets the faults on the returned server
+    """
+    server, base_url = start_stub_server_in_thread(latency=0.0)
+    monkeypatch.setattr(utils, "client", OpenAI(base_url=base_url, api_key="stub", max_retries=0))
+    monkeypatch.setattr(utils, "backend", None)
+    monkeypatch.setattr(utils, "rate_limiter", None)
+    monkeypatch.setattr(utils, "response_cache", None)
+    # short delays, and a breaker that does not open unless the test asks for it
+    utils.configure_retries({"rate_limit": 2, "server": 3}, base_delay=0.01, max_delay=0.01, breaker_error_rate=1.1)
+    yield server
+    server.shutdown()
+    server.server_close()
+    utils.configure_retries()
+
+
+def messages():
+    return [{"role": "user", "content": "Is this question causal?"}]
+
+
+def test_rate_limit_retried_up_to_budget(stub):
+    stub.fault_rate = 1.0
+    stub.fault_statuses = [429]
+    with pytest.raises(RateLimitError):
+        utils.send_chat_request(messages(), "gpt-4o-mini")
+    # the first attempt and the 2 retries of the rate_limit budget
+    assert stub.request_count == 3
+
+
+def test_server_error_retried_up_to_budget(stub):
+    stub.fault_rate = 1.0
+    stub.fault_statuses = [500]
+    with pytest.raises(InternalServerError):
+        utils.send_chat_request(messages(), "gpt-4o-mini")
+    assert stub.request_count == 4
+
+
+def test_outage_recovers_within_budget(stub):
+    stub.outage = (1, 3)
+    assert utils.send_chat_request(messages(), "gpt-4o-mini") == STUB_ANSWER
+    assert stub.request_count == 4
+
+
+def test_circuit_breaker_pauses_requests(stub):
+    _, breaker = utils.configure_retries({"server": 20}, base_delay=0.01, max_delay=0.01, breaker_error_rate=0.5,
+                                         breaker_cooldown=0.5)
+    # 10 failures in a row reach min_requests of the breaker with every request failed
+    stub.outage = (1, 10)
+    start = time.monotonic()
+    assert utils.send_chat_request(messages(), "gpt-4o-mini") == STUB_ANSWER
+    elapsed = time.monotonic() - start
+    assert breaker.trips == 1
+    assert elapsed >= 0.5
+    assert stub.request_count == 11
+
+
+def test_failed_rows_dead_lettered_and_rerun(stub, tmp_path, capsys):
+    from run_classification import run
+
+    input_path = tmp_path / "input.jsonl"
+    with open(input_path, "w") as file:
+        for index in range(3):
+            file.write(json.dumps({"id": f"q{index}", "source": "quora", "query": f"Why {index}?", "summary": f"Why {index}?"}) + "\n")
+    output_path = str(tmp_path / "output.jsonl")
+    rerun_command = f"python run_classification.py {input_path} causal gpt-4o-mini get_prompt_cat_1_iteration_6"
+
+    stub.fault_rate = 1.0
+    stub.fault_statuses = [500]
+    run("causal", str(input_path), output_path, "gpt-4o-mini", "get_prompt_cat_1_iteration_6", rerun_command=rerun_command)
+
+    with open(output_path + ".dead.jsonl") as file:
+        dead = [json.loads(line) for line in file]
+    assert [record["id"] for record in dead] == ["q0", "q1", "q2"]
+    assert all(record["error_class"] == "server" for record in dead)
+    # every row used its whole server budget
+    assert stub.request_count == 3 * 4
+    assert f"3 rows failed and were written to {output_path}.dead.jsonl, run again to retry them: {rerun_command}" in capsys.readouterr().out
+
+    # the dead-lettered rows are not in the checkpoint, running again classifies them
+    stub.fault_rate = 0.0
+    run("causal", str(input_path), output_path, "gpt-4o-mini", "get_prompt_cat_1_iteration_6", rerun_command=rerun_command)
+    with open(output_path) as file:
+        rows = [json.loads(line) for line in file]
+    assert sorted(row["id"] for row in rows) == ["q0", "q1", "q2"]
+    assert all(row["is_causal"] is True for row in rows)
+
+
+def test_authentication_error_stops_the_run(stub, tmp_path):
+    from openai import AuthenticationError
+    from run_classification import run
+
+    input_path = tmp_path / "input.jsonl"
+    with open(input_path, "w") as file:
+        for index in range(3):
+            file.write(json.dumps({"id": f"q{index}", "source": "quora", "query": f"Why {index}?", "summary": f"Why {index}?"}) + "\n")
+    output_path = str(tmp_path / "output.jsonl")
+
+    # a bad key fails every row the same way: not retried, not dead-lettered
+    stub.fault_rate = 1.0
+    stub.fault_statuses = [401]
+    with pytest.raises(AuthenticationError):
+        run("causal", str(input_path), output_path, "gpt-4o-mini", "get_prompt_cat_1_iteration_6")
+    assert stub.request_count == 1
+    assert not os.path.exists(output_path + ".dead.jsonl")
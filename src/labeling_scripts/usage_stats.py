@@ -0,0 +1,67 @@
+# Token usage reported by the API, accumulated over a run: prompt, cached and completion tokens, plus the request latency.
+# cached_tokens (usage.prompt_tokens_details.cached_tokens) is the part of the prompt served from the provider-side prefix
+# cache, which is billed at a discount and lowers the time to the first token; see the prefix_cache prompt layout in
+# prompt_registry.py.
+
+import statistics
+import threading
+
+
+def usage_field(usage, name, default=0):
+    # usage is the SDK object of a chat completion or the "usage" dict of a batch output line
+    if usage is None:
+        return default
+    if isinstance(usage, dict):
+        value = usage.get(name, default)
+    else:
+        value = getattr(usage, name, default)
+    return default if value is None else value
+
+
+class UsageStats:
+    """
+    Running totals of the usage of the chat completions
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = []
+
+    def add(self, usage, latency=None):
+        details = usage_field(usage, "prompt_tokens_details", None)
+        with self.lock:
+            self.requests += 1
+            self.prompt_tokens += usage_field(usage, "prompt_tokens")
+            self.cached_tokens += usage_field(details, "cached_tokens")
+            self.completion_tokens += usage_field(usage, "completion_tokens")
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def summary(self):
+        with self.lock:
+            summary = {
+                "requests": self.requests,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "cached_share": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0,
+                "completion_tokens": self.completion_tokens
+            }
+            if self.latencies:
+                summary["mean_latency"] = statistics.mean(self.latencies)
+                summary["median_latency"] = statistics.median(self.latencies)
+        return summary
+
+    def report(self):
+        summary = self.summary()
+        if not summary["requests"]:
+            return summary
+        line = (f"Usage: {summary['requests']} requests, {summary['prompt_tokens']} prompt tokens of which "
+                f"{summary['cached_tokens']} cached ({summary['cached_share']:.1%}), {summary['completion_tokens']} completion tokens")
+        if "mean_latency" in summary:
+            line += f", latency mean {summary['mean_latency']:.2f}s median {summary['median_latency']:.2f}s"
+        print(line)
+        return summary
@@ -1,7 +1,33 @@
 # This file contains utility functions and prompts that are used in the main scripts to generate causalquest. 
+# openai and tiktoken are only imported when a request is actually sent, so offline tools that only need the prompts or
+# the output parsing (e.g. process_output_CoT) import this module without an API key and without the SDK import cost.
 
+import time
+from prompt_registry import PromptRegistry, prompt_layouts
+from usage_stats import UsageStats
+from retry_policy import RetryPolicy, CircuitBreaker, error_class
 
 
+seed = 42
+temperature = 0
+max_tokens = 1000
+# created on first use by get_client
+client = None
+# inference backend of get_gpt_response and get_cat*_outcome, see backends.py. The OpenAI chat API if not configured
+backend = None
+rate_limiter = None
+response_cache = None
+# cheap predictors answering the confident causal rows before the backend, see cascade.py
+cascade = None
+# retries of the transient errors, see retry_policy.py. The client's own retries are disabled, these replace them
+retry_policy = RetryPolicy()
+circuit_breaker = CircuitBreaker()
+# token usage (including the prefix-cached tokens) and latency of the requests sent in this process
+usage_stats = UsageStats()
+
+# prompt functions of this module by name, compiled into templates on first use (see prompt_registry.py)
+prompts = PromptRegistry(globals())
+
 source_mapping = {
     "sg": "ChatGPT",
     "wc": "ChatGPT",
@@ -34,46 +60,113 @@ def process_output_CoT(text):
 
 
 
-def get_cat1_outcome(row, model, prompt_function_name):
+def build_cat1_prompt(row, prompt_function_name):
     """
-    Get the outcome for Category 1 classification task (causal vs non causal)
+    Build the prompt for Category 1 classification task (causal vs non causal). Returns the prompt and the system prompt.
     """
 
-    prompt_function = globals()[prompt_function_name]
     source = source_mapping[row['source']]
     q_summary = row['summary']
     system_prompt = None
-    prompt = prompt_function(source, q_summary) 
-    obtained_class = get_gpt_response(prompt, model, system_prompt)
+    prompt = prompts.render(prompt_function_name, source, q_summary)
+
+    return prompt, system_prompt
+
+
+def parse_cat1_outcome(obtained_class):
+    """
+    Map the raw model output of the Category 1 classification task to the stored outcome
+    """
+
     processed_class = process_output_CoT(obtained_class)
-    
     outcome = "True" if processed_class == "Causal" else "False" if processed_class == "Non-causal" else processed_class
 
-    return outcome, obtained_class
+    return outcome
 
 
-def get_cat2_outcome(row, model, prompt_function_name, classification_type, system_prompt_flag):
+def get_cat1_outcome(row, model, prompt_function_name):
+    """
+    Get the outcome for Category 1 classification task (causal vs non causal), from the configured backend
+    """
+
+    return get_backend().classify_row(row, model, prompt_function_name, "causal", False)
+
+
+def build_cat2_prompt(row, prompt_function_name, classification_type, system_prompt_flag):
     """
-    Get the outcome for Category 2 classification task (action, domain, subjectivity)
+    Build the prompt for Category 2 classification task (action, domain, subjectivity). Returns the prompt and the system prompt.
     """
 
     source = source_mapping[row['source']]
     q_summary = row['summary']
     if system_prompt_flag:
-        system_prompt = get_system_prompt_cat_2()
+        system_prompt = prompts.render("get_system_prompt_cat_2")
     else:
         system_prompt = None
     full_prompt_function_name = prompt_function_name + "_" + classification_type
-    prompt_function = globals()[full_prompt_function_name]
-    prompt = prompt_function(source, q_summary)
-    obtained_class = get_gpt_response(prompt, model, system_prompt)
+    prompt = prompts.render(full_prompt_function_name, source, q_summary)
+
+    return prompt, system_prompt
+
+
+def parse_cat2_outcome(obtained_class, classification_type):
+    """
+    Map the raw model output of the Category 2 classification task to the stored outcome.
+    For the combined prompt the outcome is a dict with one entry per classification type
+    """
+
+    if classification_type == "combined":
+        return parse_cat2_combined(obtained_class)
+
     processed_class = process_output_CoT(obtained_class)
     if classification_type == "subjectivity":
         outcome = "True" if processed_class == "Subjective" else "False" if processed_class == "Objective" else processed_class
     else:
         outcome = processed_class
 
-    return outcome, obtained_class
+    return outcome
+
+
+def build_row_prompt(row, prompt_function_name, classification_type, system_prompt_flag):
+    """
+    Build the prompt of a row for any classification type. Returns the prompt and the system prompt.
+    """
+
+    if classification_type == "causal":
+        return build_cat1_prompt(row, prompt_function_name)
+    return build_cat2_prompt(row, prompt_function_name, classification_type, system_prompt_flag)
+
+
+def prompt_version_id(prompt_function_name, classification_type, system_prompt_flag=False):
+    """
+    Version id of the prompts used for a classification type, e.g. "get_prompt_cat2_action@1a2b3c4d5e6f" (joined with "+"
+    to the version of the system prompt, if there is one). Stored with the cached responses and in the batch manifests
+    """
+
+    if classification_type == "causal":
+        return prompts.version(prompt_function_name)
+    version = prompts.version(prompt_function_name + "_" + classification_type)
+    if system_prompt_flag:
+        version += "+" + prompts.version("get_system_prompt_cat_2")
+    return version
+
+
+def parse_row_outcome(obtained_class, classification_type):
+    """
+    Map the raw model output to the stored outcome for any classification type
+    """
+
+    if classification_type == "causal":
+        return parse_cat1_outcome(obtained_class)
+    return parse_cat2_outcome(obtained_class, classification_type)
+
+
+def get_cat2_outcome(row, model, prompt_function_name, classification_type, system_prompt_flag):
+    """
+    Get the outcome for Category 2 classification task (action, domain, subjectivity), from the configured backend
+    """
+
+    return get_backend().classify_row(row, model, prompt_function_name, classification_type, system_prompt_flag)
 
 
 
@@ -466,6 +559,67 @@ Category:"""
 
 
 
+def get_cat2_definitions(prompt_function):
+    """
+    Extract the category definitions and the answer options of a single-task cat2 prompt, so that the combined prompt
+    uses exactly the same definitions as the separate ones.
+    """
+    import re
+    prompt = prompt_function("{website}", "{question}")
+    start = prompt.index("categories:") + len("categories:")
+    end = prompt.index("Assign one of") if "Assign one of" in prompt else prompt.index("Is the question asking")
+    options = re.search(r'Category: (\[.*?\])', prompt).group(1)
+    return prompt[start:end].strip(), options
+
+
+cat2_combined_fields = {
+    "subjectivity": ("Subjectivity", get_prompt_cat2_subjectivity),
+    "domain": ("Domain", get_prompt_cat2_domain),
+    "action": ("Action", get_prompt_cat2_action)
+}
+
+
+def get_prompt_cat2_combined(website, question):
+    """
+    Single prompt asking for subjectivity, domain and action at once, with the definitions of get_prompt_cat2_*
+    """
+    sections = []
+    answer_format = []
+    for classification_type, (label, prompt_function) in cat2_combined_fields.items():
+        definitions, options = get_cat2_definitions(prompt_function)
+        sections.append(f"{label}. Classify the question in one of the following categories:\n\n{definitions}")
+        answer_format.append(f"{label}: {options}")
+
+    sections_text = "\n\n".join(sections)
+    answer_format_text = "\n".join(answer_format)
+    prompt = f"""Below you’ll find a question that a human asked on {website}. The question is causal. Classify it along the following three dimensions.
+
+{sections_text}
+
+Assign one category per dimension to the given question. Answer with the following format, one line per dimension.
+{answer_format_text}
+
+Question: {question}
+"""
+    return prompt
+
+
+def parse_cat2_combined(text):
+    """
+    Parse the answer to get_prompt_cat2_combined into {classification_type: outcome}, with the same outcome values as the
+    separate prompts. A dimension missing from the answer gets the raw text, as process_output_CoT does.
+    """
+    import re
+    outcomes = {}
+    for classification_type, (label, _) in cat2_combined_fields.items():
+        match = re.search(rf'^\s*{label}:\s*(.+?)\s*$', text, re.MULTILINE)
+        if match is None:
+            outcomes[classification_type] = text
+            continue
+        outcomes[classification_type] = parse_cat2_outcome(f"Category: {match.group(1)}", classification_type)
+    return outcomes
+
+
 def get_system_prompt_cat_2():
     prompt = """
 The following is the definition of a causal question.
@@ -480,9 +634,9 @@ This also includes the cases in which the effect is not explicit: any request wi
 3. Given variables, judge their causal relation: questioning the causal link among the given entities (e.g. Does smoking cause cancer? Did my job application get rejected because I lack experience?)"""
     return prompt
 
-def get_gpt_response(prompt, model, system_prompt = None):
+def build_messages(prompt, system_prompt = None):
     """
-        sends the prompt to openai
+        builds the chat messages for a prompt and an optional system prompt
     """
     if system_prompt:
         messages = [
@@ -493,16 +647,180 @@ def get_gpt_response(prompt, model, system_prompt = None):
         messages = [
             {"role": "user", "content": prompt}
         ]
+    return messages
+
+
+def get_gpt_response(prompt, model, system_prompt = None, prompt_version = None):
+    """
+        sends the prompt to the configured backend (openai by default). prompt_version (see prompt_version_id) is recorded
+        with the cached response
+    """
+    messages = build_messages(prompt, system_prompt)
+    chat_backend = get_backend()
+    cache = response_cache if chat_backend.cacheable else None
+
+    if cache is not None:
+        cached = cache.get(model, messages, max_tokens, temperature, seed)
+        if cached is not None:
+            return cached
 
-    caller = client.chat.completions
-    response = caller.create(
-        model=model,
-        messages=messages,
-        max_tokens=max_tokens,
-        temperature=temperature,
-        seed = seed
-    )
+    content = chat_backend.complete(messages, model)
+
+    if cache is not None:
+        cache.put(model, messages, max_tokens, temperature, seed, content, prompt_version)
+    return content
+
+
+def get_backend():
+    """
+        returns the configured inference backend, the OpenAI chat API by default
+    """
+    global backend
+    if backend is None:
+        from backends import OpenAIChatBackend
+        backend = OpenAIChatBackend()
+    return backend
+
+
+def configure_backend(name, **kwargs):
+    """
+        selects the inference backend: "openai", "openai_batch", "hf" or "fake". kwargs go to the backend, see backends.py
+    """
+    global backend
+    from backends import make_backend
+    backend = make_backend(name, **kwargs)
+    return backend
+
+
+def get_client():
+    """
+        returns the shared OpenAI client, creating it on first use. All the callers (and threads) go through the
+        connection pool of its HTTP transport, so keep-alive connections are reused across requests
+    """
+    global client
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(max_retries=0)
+    return client
+
+
+def send_chat_request(messages, model):
+    """
+        sends the chat messages to openai, retrying transient errors according to retry_policy and holding while the
+        circuit breaker is open. The error is raised once the retry budget of its class is spent
+    """
+    attempts = {}
+    while True:
+        circuit_breaker.wait()
+        try:
+            content = send_chat_request_once(messages, model)
+        except Exception as e:
+            kind = error_class(e)
+            if kind is not None:
+                circuit_breaker.record(False)
+            if not retry_policy.can_retry(kind, attempts):
+                raise
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            if kind == "rate_limit" and rate_limiter is not None:
+                # the scheduler holds every request until the limit resets
+                waited = rate_limiter.pause(headers)
+                print(f"Rate limited, pausing requests for {waited:.1f}s")
+            else:
+                wait = retry_policy.delay(attempts.get(kind, 0), headers)
+                print(f"Request failed ({kind}), retrying in {wait:.1f}s")
+                time.sleep(wait)
+            attempts[kind] = attempts.get(kind, 0) + 1
+            continue
+        circuit_breaker.record(True)
+        return content
+
+
+def send_chat_request_once(messages, model):
+    """
+        a single attempt, going through the rate limit scheduler if it is enabled
+    """
+    caller = get_client().chat.completions
+    if rate_limiter is None:
+        start = time.perf_counter()
+        response = caller.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            seed = seed
+        )
+        usage_stats.add(response.usage, time.perf_counter() - start)
+        return response.choices[0].message.content
+
+    # with the scheduler we need the x-ratelimit-* headers, so we go through the raw response
+    cost = rate_limiter.acquire(messages, max_tokens)
+    start = time.perf_counter()
+    try:
+        raw_response = caller.with_raw_response.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            seed = seed
+        )
+    except Exception:
+        rate_limiter.release(cost)
+        raise
+    rate_limiter.release(cost, raw_response.headers)
+    response = raw_response.parse()
+    usage_stats.add(response.usage, time.perf_counter() - start)
     return response.choices[0].message.content
+
+
+def configure_rate_limits(requests_per_minute, tokens_per_minute, model):
+    """
+        enables the client-side requests/minute and tokens/minute scheduler in get_gpt_response
+    """
+    global rate_limiter
+    from rate_limiter import RateLimitScheduler
+    rate_limiter = RateLimitScheduler(requests_per_minute, tokens_per_minute, model)
+    return rate_limiter
+
+
+def configure_retries(budgets=None, base_delay=1.0, max_delay=60.0, breaker_error_rate=0.5, breaker_cooldown=30.0):
+    """
+        sets the retry budgets per error class ("rate_limit", "server", "timeout", "connection"), the backoff and the circuit breaker
+    """
+    global retry_policy, circuit_breaker
+    retry_policy = RetryPolicy(budgets, base_delay, max_delay)
+    circuit_breaker = CircuitBreaker(error_rate=breaker_error_rate, cooldown=breaker_cooldown)
+    return retry_policy, circuit_breaker
+
+
+def configure_prompt_layout(layout):
+    """
+        selects the layout of the prompt templates: "default", or "prefix_cache" to move the variable fields after the
+        static instructions so that the provider-side prompt cache can reuse them across rows (see prompt_registry.py)
+    """
+    if layout not in prompt_layouts:
+        raise ValueError(f"Unknown prompt layout {layout}, possible values: {', '.join(prompt_layouts)}")
+    prompts.layout = layout
+    return layout
+
+
+def configure_cascade(path):
+    """
+        enables the cascade of the causal classification, with the thresholds calibrated by cascade.py
+    """
+    global cascade
+    from cascade import Cascade
+    cascade = Cascade.from_file(path)
+    return cascade
+
+
+def configure_response_cache(path, max_bytes=1024 ** 3, replay=False):
+    """
+        enables the on-disk response cache in get_gpt_response. With replay=True the cache is read-only and misses raise CacheMiss
+    """
+    global response_cache
+    from response_cache import ResponseCache
+    response_cache = ResponseCache(path, max_bytes, replay)
+    return response_cache
         
 
 
@@ -575,40 +893,6 @@ Question: {question}"""
     return prompt
 
 
-def get_prompt_cat2_cot_action(website, question):
-    prompt = f"""Below you’ll find the summary of a question that a human asked on {website}. The question is causal. Classify it in one of the following categories:
-
-Cause-seeking: Explain the cause behind a specific occurrence or phenomenon. The individual asking the question seeks to uncover the underlying cause or rationale for something being the way it is. It can be an explicit “Why” question (e.g., Why do humans engage in wars?; Why do apples fall?). Alternatively, it might seek to understand the underlying explanation or significance of a sentence, an idea, or a creative work, such as the meaning behind the lyrics of a song or the narrative of a story (e.g., What is the meaning behind the song 'Imagine'?, What are the main causes of Alzheimer's?). Essentially, this type of question seeks to uncover the underlying cause or rationale for something being the way it is.
-Formula: given=effect (non-teleological), ask_for=cause(s). 
-
-Steps-seeking: Give the steps to achieve a goal (e.g, How can I learn Spanish in 6 months?). The individual asking the question has a purpose and seeks guidance on the steps required to fulfill it. The question calls for actionable items that can be done for that specific goal. Either there is only one way to achieve the goal, or the question asks only for one possible strategy. It should not imply thinking about several possible strategies and choosing the best one. 
-Formula: given=effect/purpose_of_human (teleological), ask_for=causes_in_the_format_of_guides
-
-Algorithm-seeking: Generate text in a specific format to achieve a goal, like code or recipe. The individual has a purpose and asks for a code or recipe to fulfill it (e.g. Tell me a vegan recipe with Broccoli; Optimize the following code to run faster using GPUs). Differently from steps-seeking, the output is in a constrained space, such as a coding language, or recipes. 
-Formula: given=effect/purpose_of_human (teleological), ask_for=causes_in_the_format_of_code_and_recipes
-
-Recommendation-seeking: Given an explicit or implicit goal and also a set of choices, tell the best one that can achieve the goal (e.g., Should I do a PhD or not for better employment opportunities? What's the best Italian restaurant in London?). The individual has a purpose and a choice to be made and is looking for the choice that maximizes the purpose's satisfaction. It differs from “Steps-seeking” as here there are several different ways in which the goal can be achieved, and the question is looking for the best one. 
-Formula: given=(effect/purpose_of_human (teleological), several_guides) 
-ask_for=argmax_guide(purpose_satisfaction)
-
-Effect-seeking: Predict the effect of a cause, the future given the past or a hypothetical scenario given a counterfactual condition (e.g. Will renewable energy sources become the primary means of power? What would the world look like if the Internet had never been invented?).
-Formula: given=cause(s), ask_for=effect(s)
-
-CausalRelation-seeking: Inquire about the causal relationship between entities. The individual is looking to understand whether there is a causal link between two or more entities (e.g., Does smoking lead to cancer? Does air pollution increase the likelihood of getting respiratory diseases?). This differs from cause-seeking or effect-seeking because the question provides an hypothesis for cause and effect, and wonders about whether a causal relation exists. 
-Formula: given=several_entities, ask_for=causal_relation
-
-Let's think step by step. Answer in the following format:
-Reasoning: [Reasoning]
-Category: [Cause-seeking / Steps-seeking / Algorithm-seeking / Recommendation-seeking / Effect-seeking / CausalRelation-seeking]
-
-Always write "Category" before providing the final answer. 
-Question: {question}"""    
-    return prompt
-
-
-
-
-
 def get_prompt_cat2_cot_action(website, question):
     prompt = f"""Below you’ll find the summary of a question that a human asked on {website}. The question is causal. Classify it in one of the following categories:
 
@@ -719,10 +1003,3 @@ Category: """
     return prompt
 
 
-
-from openai import OpenAI
-
-client = OpenAI()
-seed = 42
-temperature = 0
-max_tokens = 1000
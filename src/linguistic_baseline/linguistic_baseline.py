@@ -1,14 +1,19 @@
 # this file contains the functions for the linguistic baseline of CausalQuest
 
-import nltk
-from nltk.corpus import wordnet as wn
-nltk.download('wordnet')
-nltk.download('omw-1.4')
 import jsonlines
 import pandas as pd
-import spacy
-nlp = spacy.load('en_core_web_sm')
 import re
+import time
+import hashlib
+import json
+import os
+
+# spaCy model and WordNet corpus, loaded (and downloaded for WordNet) on first use by get_nlp and get_wordnet
+nlp = None
+wn = None
+
+# the rules only use the lemmas and the dependency parse
+unused_components = ['ner']
 
 # Based on section 3 
 causal_connective = {'because of', 'thanks to', 'due to', 'because'}
@@ -64,6 +69,91 @@ patterns = {
     'R6': r'\bwhat (will|might)? happen(s)?\b(\bif\b|\bwhen\b)',
     'R7': r'\bwhat (to do|should be done)\b(\bif\b|\bto\b|\bwhen\b)'
 }
+compiled_patterns = {pattern_name: re.compile(pattern, re.IGNORECASE) for pattern_name, pattern in patterns.items()}
+
+# at least two words, so that spaCy finds at least two tokens (is_causal_question rejects single-token questions)
+several_words = re.compile(r'\S\s+\S')
+fast_paths = {}
+
+def get_nlp():
+    """
+    The en_core_web_sm pipeline, loaded on first use.
+    """
+    global nlp
+    if nlp is None:
+        import spacy
+        nlp = spacy.load('en_core_web_sm')
+    return nlp
+
+
+def get_wordnet():
+    """
+    The WordNet corpus reader, downloading the corpus the first time it is missing.
+    """
+    global wn
+    if wn is None:
+        import nltk
+        from nltk.corpus import wordnet
+        try:
+            wordnet.ensure_loaded()
+        except LookupError:
+            nltk.download('wordnet')
+            nltk.download('omw-1.4')
+        wn = wordnet
+    return wn
+
+
+# bump when get_synonyms_antonyms changes, so that the saved expansions are recomputed
+expansion_version = 1
+# outside the source tree, in the user cache directory (or the --lexicon_cache folder of the CLI)
+expansion_cache_dir = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "causalquest", "lexicon_cache")
+wordnet_neighbours_memo = {}
+related_words_memo = {}
+
+
+def wordnet_neighbours(word):
+    """
+    Words one step away from the given word in the WordNet verb graph: the other lemmas of its synsets (synonyms)
+    and the antonyms of all their lemmas.
+    """
+    if word not in wordnet_neighbours_memo:
+        wordnet = get_wordnet()
+        neighbours = set()
+        for synset in wordnet.synsets(word, pos=wordnet.VERB):
+            for lemma in synset.lemmas():
+                # Finding synonyms
+                if lemma.name() != word:
+                    neighbours.add(lemma.name())
+                # Finding antonyms
+                for ant in lemma.antonyms():
+                    neighbours.add(ant.name())
+        wordnet_neighbours_memo[word] = neighbours
+    return wordnet_neighbours_memo[word]
+
+
+def related_words(word, degrees):
+    """
+    Synonyms and antonyms of the given word up to degrees steps away, found with a breadth-first search that
+    expands every word once. Memoized per (word, degrees).
+    """
+    key = (word, degrees)
+    if key not in related_words_memo:
+        visited = {word}
+        related = set()
+        frontier = [word]
+        for _ in range(degrees):
+            next_frontier = []
+            for current in frontier:
+                for neighbour in wordnet_neighbours(current):
+                    # the word itself can come back through a synonym of a synonym, the recursive search counted it
+                    related.add(neighbour)
+                    if neighbour not in visited:
+                        visited.add(neighbour)
+                        next_frontier.append(neighbour)
+            frontier = next_frontier
+        related_words_memo[key] = related
+    return related_words_memo[key]
+
 
 def get_synonyms_antonyms(seed_set, degrees):
     """
@@ -71,46 +161,118 @@ def get_synonyms_antonyms(seed_set, degrees):
     The function will return a set of words that includes the seed set, synonyms and antonyms of the seed set.
     The degrees parameter specifies the depth of the search in the WordNet graph.
     """
-
-    def find_related_words(word, degrees_left):
-        """
-        Find synonyms and antonyms of a given word.
-        """
-        if degrees_left == 0:
-            return set()
-        
-        related_words = set()
-        for synset in wn.synsets(word, pos=wn.VERB):
-            # Finding synonyms
-            for lemma in synset.lemmas():
-                synonym = lemma.name()
-                if synonym != word:
-                    related_words.add(synonym)
-                    related_words.update(find_related_words(synonym, degrees_left - 1))
-                    
-                # Finding antonyms
-                if lemma.antonyms():
-                    for ant in lemma.antonyms():
-                        antonym = ant.name()
-                        related_words.add(antonym)
-                        related_words.update(find_related_words(antonym, degrees_left - 1))
-                        
-        return related_words
-    
     final_synonyms_antonyms = set(seed_set)
     for word in seed_set:
-        final_synonyms_antonyms.update(find_related_words(word, degrees))
+        final_synonyms_antonyms.update(related_words(word, degrees))
     
     return final_synonyms_antonyms
 
+
+def expansion_artifact_path(seed_set, degrees, wordnet_version, cache_dir=None):
+    key = hashlib.sha1(json.dumps([degrees, sorted(seed_set), wordnet_version]).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(cache_dir or expansion_cache_dir, f"wordnet_expansion_v{expansion_version}_{key}.json")
+
+
+def load_synonyms_antonyms(seed_set, degrees, cache_dir=None):
+    """
+    get_synonyms_antonyms, saved as a JSON artifact named after the expansion version, the depth, the seed set (the
+    lexicon) and the WordNet version. Later runs load the artifact instead of walking WordNet (delete it to recompute).
+    """
+    wordnet_version = get_wordnet().get_version()
+    cache_dir = cache_dir or expansion_cache_dir
+    path = expansion_artifact_path(seed_set, degrees, wordnet_version, cache_dir)
+    if os.path.exists(path):
+        with open(path, 'r') as file:
+            return set(json.load(file)['words'])
+
+    words = get_synonyms_antonyms(seed_set, degrees)
+    artifact = {
+        'version': expansion_version,
+        'wordnet_version': wordnet_version,
+        'degrees': degrees,
+        'seed': sorted(seed_set),
+        'words': sorted(words)
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    # written next to its final name and renamed, so that a concurrent run never reads half a file
+    with open(path + '.tmp', 'w') as file:
+        json.dump(artifact, file)
+    os.replace(path + '.tmp', path)
+    return words
+
+class LemmaMatcher:
+    """
+    Trie over the lemma sequences of the lexicon entries, so that the multiword entries ('lead to', 'give rise to',
+    'because of', WordNet's 'bring_about') match as well as the single words. Every entry is added as written and as
+    lemmatized by spaCy, and labelled with the lexicons it comes from.
+    """
+
+    def __init__(self, lexicons):
+        self.root = {}
+        entries = [(entry.lower().replace('_', ' ').split(), label) for label, lexicon in lexicons.items() for entry in lexicon]
+        docs = get_nlp().pipe((' '.join(words) for words, _ in entries), disable=unused_components)
+        for (words, label), doc in zip(entries, docs):
+            self.add(words, label)
+            self.add([token.lemma_.lower() for token in doc], label)
+
+    def add(self, words, label):
+        node = self.root
+        for word in words:
+            node = node.setdefault(word, {})
+        # the None key of a node holds the labels of the entries ending there
+        node.setdefault(None, set()).add(label)
+
+    def matches(self, lemmas):
+        """
+        (start, end, labels) of every entry found in the list of lemmas, in one pass over the lemmas (the trie is only
+        as deep as the longest entry)
+        """
+        for start in range(len(lemmas)):
+            node = self.root
+            for end in range(start, len(lemmas)):
+                node = node.get(lemmas[end])
+                if node is None:
+                    break
+                if None in node:
+                    yield start, end + 1, node[None]
+
+
+# matchers by lexicons, built once: the lexicon objects are kept with their matcher, so that their ids stay valid
+lemma_matchers = {}
+
+
+def get_lemma_matcher(causal_verbs, causal_keywords=None):
+    """
+    The LemmaMatcher of the causal verbs (label "verb") and causal keywords (label "keyword").
+    """
+    key = (id(causal_verbs), id(causal_keywords))
+    if key not in lemma_matchers:
+        lexicons = {"verb": causal_verbs, "keyword": causal_keywords or ()}
+        lemma_matchers[key] = (causal_verbs, causal_keywords, LemmaMatcher(lexicons))
+    return lemma_matchers[key][2]
+
+
+def lexicon_rules(doc, causal_verbs, causal_keywords):
+    """
+    Whether the document contains a causal keyword, and whether it has a causal structure: a causal verb (or multiword
+    verb, starting with its head) that is the subject or the clausal complement of its sentence.
+    """
+    lemmas = [token.lemma_.lower() for token in doc]
+    keyword = False
+    structure = False
+    for start, _, labels in get_lemma_matcher(causal_verbs, causal_keywords).matches(lemmas):
+        keyword = keyword or "keyword" in labels
+        structure = structure or ("verb" in labels and doc[start].dep_ in {"nsubj", "ccomp"})
+        if keyword and structure:
+            break
+    return keyword, structure
+
+
 def has_causal_structure(doc, causal_verbs):
     """
     Check if the given document has a causal structure.
     """
-    for token in doc:
-        if token.dep_ in {"nsubj", "ccomp"} and token.lemma_.lower() in causal_verbs:
-            return True
-    return False
+    return lexicon_rules(doc, causal_verbs, None)[1]
 
 def match_causal_patterns(doc):
     """
@@ -132,72 +294,183 @@ def match_patterns(sentence):
     Check if the given sentence matches any of the causal patterns.
     """
     matches = []
-    for pattern_name, pattern in patterns.items():
-        if re.search(pattern, sentence, re.IGNORECASE):
+    for pattern_name, pattern in compiled_patterns.items():
+        if pattern.search(sentence):
             matches.append(pattern_name)
     return matches
 
-def is_causal_question(question, causal_verbs, causal_keywords):
+
+def get_fast_path(causal_keywords):
     """
-    Check if the given question is a causal question.
+    One precompiled alternation of the rules of is_causal_question that can be checked on the raw string: the
+    patterns R1-R7, "how" as first word and the single-word causal keywords. A match means that the question is
+    causal without parsing it; no match means that the parse has to decide.
     """
-    doc = nlp(question)
+    key = frozenset(causal_keywords)
+    if key not in fast_paths:
+        alternatives = [r'^how\b'] + list(patterns.values())
+        # the keywords are compared to the token lemmas, which are the words themselves for these single-word
+        # connectives and adverbs. The multiword keywords are left to the lemma matcher, after the parse
+        words = sorted(keyword for keyword in causal_keywords if ' ' not in keyword)
+        if words:
+            alternatives.append(r'\b(?:' + '|'.join(re.escape(word) for word in words) + r')\b')
+        fast_paths[key] = re.compile('|'.join(f'(?:{alternative})' for alternative in alternatives), re.IGNORECASE)
+    return fast_paths[key]
+
+
+def fast_path_match(question, fast_path):
+    """
+    Whether the fast path alone classifies the question as causal.
+    """
+    return fast_path.search(question) is not None and several_words.search(question) is not None
+
+def causal_rules(question, causal_verbs, causal_keywords, first_only=False, doc=None):
+    """
+    Names of the rules of is_causal_question that fire on the given question, in the order they are checked:
+    "keyword", "first_why" / "first_how", "causal_structure" and the CausalQA patterns R1-R7. Empty for a non-causal
+    question. With first_only, stops at the first rule that fires. doc is the parsed question, when already available.
+    The rules do not have the same precision, which the cascade of labeling_scripts/cascade.py calibrates.
+    """
+    if doc is None:
+        doc = get_nlp()(question, disable=unused_components)
 
     if len(doc) < 2:
-        return False
-    
-    for token in doc:
-        if token.lemma_.lower() in causal_keywords:
-            return True
-        
-    if doc[0].lemma_.lower() in {"why", "how"}:
-        return True
+        return []
 
-    if has_causal_structure(doc, causal_verbs):
-        return True
-    
+    rules = []
+    keyword, structure = lexicon_rules(doc, causal_verbs, causal_keywords)
+    if keyword:
+        rules.append("keyword")
+        if first_only:
+            return rules
+
+    first = doc[0].lemma_.lower()
+    if first in {"why", "how"}:
+        rules.append(f"first_{first}")
+        if first_only:
+            return rules
+
+    if structure:
+        rules.append("causal_structure")
+        if first_only:
+            return rules
 
-    if match_patterns(question):
+    rules.extend(match_patterns(question))
+    return rules
+
+
+def is_causal_question(question, causal_verbs, causal_keywords, doc=None, fast_path=None):
+    """
+    Check if the given question is a causal question.
+    The regex fast path runs first, the question is only parsed when it is inconclusive.
+    """
+    if doc is None and fast_path_match(question, fast_path or get_fast_path(causal_keywords)):
         return True
-    
-    return False
+    return bool(causal_rules(question, causal_verbs, causal_keywords, first_only=True, doc=doc))
 
 
-def classify_and_compute(jsonl_input_file, jsonl_output_file):
+def parse_questions(items, batch_size=256, n_process=1):
+    """
+    Parse (question, context) pairs with nlp.pipe, in batches and optionally in several processes.
+    Yields (doc, context) in the input order.
+    """
+    return get_nlp().pipe(items, as_tuples=True, batch_size=batch_size, n_process=n_process, disable=unused_components)
+
+
+def causal_rules_batch(questions, causal_verbs, causal_keywords, first_only=False, batch_size=256, n_process=1):
+    """
+    causal_rules of every question, parsed with nlp.pipe. Returns a list in the order of the questions.
+    """
+    return [causal_rules(question, causal_verbs, causal_keywords, first_only, doc)
+            for doc, question in parse_questions(((question, question) for question in questions), batch_size, n_process)]
+
+
+causal_lexicons = None
+
+
+def get_causal_lexicons():
+    """
+    The causal verbs and causal keywords used by is_causal_question, built once per process.
+    """
+    global causal_lexicons
+    if causal_lexicons is None:
+        synonyms_antonyms = load_synonyms_antonyms(causal_verbs_sec3, 2)
+        causal_verbs = causal_lexico_syntactic.union(morph_causatives,synonyms_antonyms)
+        causal_keywords = causal_connective.union(causal_adverbs)
+        causal_lexicons = (causal_verbs, causal_keywords)
+    return causal_lexicons
+
+
+def read_labeled_queries(jsonl_input_file):
+    """
+    The (query, object) pairs of the input file that have a query and a gold label.
+    """
+    with jsonlines.open(jsonl_input_file, 'r') as reader:
+        for obj in reader:
+            if obj.get('query') and obj.get('is_causal') is not None:
+                yield obj['query'], obj
+
+
+def classify_and_compute(jsonl_input_file, jsonl_output_file, batch_size=256, n_process=1):
     """
     Classify the given sentences as causal or non-causal and compute the accuracy and precision of the classification.
-    
+    The sentences the regex fast path classifies are not parsed, the others are streamed through nlp.pipe in batches
+    of batch_size, in n_process processes. Every result is written to the output file as soon as it is available,
+    in the input order.
     """
     total_sentences = 0
     true_positives = 0
     false_positives = 0
-
-    synonyms_antonyms = get_synonyms_antonyms(causal_verbs_sec3, 2)
-    causal_verbs = causal_lexico_syntactic.union(morph_causatives,synonyms_antonyms)
-    causal_keywords = causal_connective.union(causal_adverbs)
-    
-    with jsonlines.open(jsonl_input_file, 'r') as reader, jsonlines.open(jsonl_output_file, 'w') as writer:
-        for obj in reader:
-            sentence = obj.get('query')
+    fast_path_hits = 0
+
+    causal_verbs, causal_keywords = get_causal_lexicons()
+    fast_path = get_fast_path(causal_keywords)
+
+    # objects and predictions by input index, until they are written. Only the index goes through nlp.pipe: with
+    # n_process > 1 the contexts come back as pickled copies, so the results are stored by index in this process
+    objects = {}
+    predictions = {}
+    next_index = 0
+
+    def sentences_to_parse():
+        nonlocal fast_path_hits
+        for index, (sentence, obj) in enumerate(read_labeled_queries(jsonl_input_file)):
+            objects[index] = obj
+            if fast_path_match(sentence, fast_path):
+                predictions[index] = True
+                fast_path_hits += 1
+            else:
+                yield sentence, index
+
+    def write_ready(writer):
+        nonlocal next_index, total_sentences, true_positives, false_positives
+        while next_index in predictions:
+            obj = objects.pop(next_index)
+            predicted_label = predictions.pop(next_index)
+            next_index += 1
             gold_label = obj.get('is_causal')
-            
-            if sentence and gold_label is not None:
-                total_sentences += 1
-                predicted_label = is_causal_question(sentence, causal_verbs, causal_keywords)
-                obj['predicted_is_causal'] = predicted_label
-                writer.write(obj)
-                
-                if predicted_label == gold_label:
-                    if predicted_label:
-                        true_positives += 1
-                else:
-                    if predicted_label:
-                        false_positives += 1
+            total_sentences += 1
+            obj['predicted_is_causal'] = predicted_label
+            writer.write(obj)
+
+            if predicted_label == gold_label:
+                if predicted_label:
+                    true_positives += 1
+            else:
+                if predicted_label:
+                    false_positives += 1
+
+    with jsonlines.open(jsonl_output_file, 'w', flush=True) as writer:
+        for doc, index in parse_questions(sentences_to_parse(), batch_size, n_process):
+            predictions[index] = is_causal_question(objects[index]['query'], causal_verbs, causal_keywords, doc=doc)
+            write_ready(writer)
+        write_ready(writer)
     
     accuracy = true_positives / total_sentences if total_sentences > 0 else 0
     precision = true_positives / (true_positives + false_positives) if (true_positives + false_positives) > 0 else 0
     
     print(f"Total sentences: {total_sentences}")
+    print(f"Classified by the fast path without parsing: {fast_path_hits}")
     print(f"True positives: {true_positives}")
     print(f"False positives: {false_positives}")
     print(f"Accuracy: {accuracy}")
@@ -205,6 +478,55 @@ def classify_and_compute(jsonl_input_file, jsonl_output_file):
     print(f"Classification results saved to: {jsonl_output_file}")
 
 
+def benchmark_parsing(jsonl_input_file, batch_sizes=(32, 256, 1024), n_processes=(1, 2), limit=5000):
+    """
+    Docs per second of the classification of the first limit queries of the input file: one nlp() call per query
+    with the full pipeline (the former classify_and_compute), against nlp.pipe without the unused components, for
+    every batch size and number of processes, and against the regex fast path followed by nlp.pipe, with the share
+    of the queries that never reach the parser.
+    """
+    causal_verbs, causal_keywords = get_causal_lexicons()
+    queries = []
+    for query, _ in read_labeled_queries(jsonl_input_file):
+        queries.append(query)
+        if len(queries) >= limit:
+            break
+
+    start = time.perf_counter()
+    reference = [bool(causal_rules(query, causal_verbs, causal_keywords, first_only=True, doc=get_nlp()(query))) for query in queries]
+    elapsed = time.perf_counter() - start
+    results = [{"mode": "nlp() per query, full pipeline", "docs_per_second": len(queries) / elapsed}]
+
+    for n_process in n_processes:
+        for batch_size in batch_sizes:
+            start = time.perf_counter()
+            predicted = [bool(rules) for rules in causal_rules_batch(queries, causal_verbs, causal_keywords, True, batch_size, n_process)]
+            elapsed = time.perf_counter() - start
+            results.append({"mode": f"nlp.pipe batch_size={batch_size} n_process={n_process}",
+                            "docs_per_second": len(queries) / elapsed,
+                            "same_predictions": predicted == reference})
+
+    # regex fast path, then nlp.pipe on the queries it leaves
+    fast_path = get_fast_path(causal_keywords)
+    start = time.perf_counter()
+    predicted = [fast_path_match(query, fast_path) for query in queries]
+    parsed = [index for index, match in enumerate(predicted) if not match]
+    for index, rules in zip(parsed, causal_rules_batch([queries[index] for index in parsed], causal_verbs,
+                                                       causal_keywords, True, max(batch_sizes), 1)):
+        predicted[index] = bool(rules)
+    elapsed = time.perf_counter() - start
+    results.append({"mode": f"fast path + nlp.pipe batch_size={max(batch_sizes)} n_process=1",
+                    "docs_per_second": len(queries) / elapsed,
+                    "same_predictions": predicted == reference,
+                    "never_parsed": 1 - len(parsed) / len(queries) if queries else 0})
+
+    for result in results:
+        same = "" if "same_predictions" not in result else f", same predictions: {result['same_predictions']}"
+        never_parsed = "" if "never_parsed" not in result else f", {result['never_parsed']:.1%} of the queries never parsed"
+        print(f"{result['mode']}: {result['docs_per_second']:.1f} docs/s{same}{never_parsed}")
+    return results
+
+
 def inspect_false_positives(jsonl_output_file, false_positives_output_file, misclassified_output_file):
     """
     Inspect the false positives and misclassified instances in the output file.
@@ -266,6 +588,7 @@ def get_causative_pairs():
 
     causative_pairs = []
     
+    wn = get_wordnet()
     for synset in wn.all_synsets('v'):  # 'v' for verbs
         for lemma in synset.lemmas():
             if lemma.derivationally_related_forms():
@@ -281,8 +604,8 @@ def extract_lexico_syntactic_patterns(causative_pairs):
     patterns = []
     
     for verb1, verb2 in causative_pairs:
-        synset1 = wn.synsets(verb1, pos='v')[0]
-        synset2 = wn.synsets(verb2, pos='v')[0]
+        synset1 = get_wordnet().synsets(verb1, pos='v')[0]
+        synset2 = get_wordnet().synsets(verb2, pos='v')[0]
         
         if synset1 and synset2:
             hypernyms1 = synset1.hypernyms()
@@ -315,3 +638,26 @@ def main_lexico_syntactic_patterns():
     print("Lexico-Syntactic Patterns expressing causation:")
     for pattern in patterns:
         print(pattern)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Linguistic baseline of the causal classification')
+    parser.add_argument('input_file', type=str, help='JSONL with query and the gold label is_causal')
+    parser.add_argument('output_file', type=str, nargs='?', default=None, help='Where to write the predictions, required unless --benchmark')
+    parser.add_argument('--batch_size', type=int, default=256, help='Queries per nlp.pipe batch')
+    parser.add_argument('--n_process', type=int, default=1, help='spaCy worker processes')
+    parser.add_argument('--benchmark', action='store_true', help='Measure docs/s of the per-query and batched parsing instead')
+    parser.add_argument('--limit', type=int, default=5000, help='Queries of the benchmark')
+    parser.add_argument('--lexicon_cache', type=str, default=None, help=f'Folder of the saved WordNet expansion, {expansion_cache_dir} by default')
+    args = parser.parse_args()
+    if args.lexicon_cache:
+        expansion_cache_dir = args.lexicon_cache
+    if not args.benchmark and args.output_file is None:
+        parser.error("output_file is required unless --benchmark is given")
+
+    if args.benchmark:
+        benchmark_parsing(args.input_file, limit=args.limit)
+    else:
+        classify_and_compute(args.input_file, args.output_file, args.batch_size, args.n_process)